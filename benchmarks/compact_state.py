@@ -0,0 +1,79 @@
+"""
+Compares the memory footprint and replay speed of DialogState trees and
+compact, array-backed trees of the same conversation.
+
+Run with:
+
+    python -m benchmarks.compact_state
+"""
+import tracemalloc
+from copy import deepcopy
+from time import perf_counter
+
+from dialogs_framework import dialog, send_message, get_client_response, run_gen_dialog
+from dialogs_framework import InMemoryPersistence
+from dialogs_framework.compact_state import compact_state
+
+TURNS = 500
+REPLAYS = 20
+
+
+@dialog(version="1.0")
+def prompt(text: str):
+    yield send_message(text)
+    response = yield get_client_response()
+    return response
+
+
+@dialog(version="1.0")
+def chatty_dialog():
+    while True:
+        yield send_message("Let's talk.")
+        yield prompt("How are you?")
+        yield prompt("Anything else?")
+
+
+def build_conversation():
+    persistence = InMemoryPersistence[str]()
+    for _ in range(TURNS):
+        run_gen_dialog(chatty_dialog(), persistence, "fine")
+    return persistence.state
+
+
+def measure_memory(build) -> int:
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    state = build()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    del state
+    return size
+
+
+def measure_replay(state) -> float:
+    elapsed = 0.0
+    for _ in range(REPLAYS):
+        persistence = InMemoryPersistence(deepcopy(state))
+        start = perf_counter()
+        run_gen_dialog(chatty_dialog(), persistence, "fine")
+        elapsed += perf_counter() - start
+    return elapsed / REPLAYS
+
+
+def main():
+    state = build_conversation()
+    compact = compact_state(state)
+    nodes = len(compact.tree)
+
+    state_bytes = measure_memory(lambda: deepcopy(state))
+    compact_bytes = measure_memory(lambda: compact_state(state))
+
+    print(f"conversation: {TURNS} turns, {nodes} states")
+    print(f"{'':>14} {'bytes/state':>12} {'ms/replay':>10}")
+    print(f"{'DialogState':>14} {state_bytes / nodes:12.1f} {measure_replay(state) * 1e3:10.2f}")
+    print(f"{'compact':>14} {compact_bytes / nodes:12.1f} {measure_replay(compact) * 1e3:10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+Measures the per-step overhead of replaying deeply nested generator dialogs.
+
+Run with:
+
+    python -m benchmarks.deep_dialogs
+"""
+import asyncio
+import sys
+from time import perf_counter
+
+from dialogs_framework import (
+    dialog,
+    send_message,
+    get_client_response,
+    run_gen_dialog,
+    run_async_gen_dialog,
+    InMemoryPersistence,
+)
+
+TURNS = 20
+DEPTHS = [1, 10, 100, 500, 2000]
+
+
+@dialog(version="1.0")
+def nested(depth: int):
+    if depth == 0:
+        while True:
+            yield send_message("ping")
+            yield get_client_response()
+
+    yield nested(depth - 1)
+
+
+def count_steps(state) -> int:
+    steps = 0
+    pending = [state]
+    while pending:
+        subdialogs = pending.pop().subdialogs
+        steps += len(subdialogs)
+        pending.extend(subdialogs)
+    return steps
+
+
+def bench_gen(depth: int) -> float:
+    persistence = InMemoryPersistence[str]()
+    steps = 0
+    elapsed = 0.0
+    for _ in range(TURNS):
+        start = perf_counter()
+        run_gen_dialog(nested(depth), persistence, "pong")
+        elapsed += perf_counter() - start
+        steps += count_steps(persistence.state)
+    return elapsed / steps
+
+
+def bench_async_gen(depth: int) -> float:
+    async def play():
+        persistence = InMemoryPersistence[str]()
+        steps = 0
+        elapsed = 0.0
+        for _ in range(TURNS):
+            start = perf_counter()
+            await run_async_gen_dialog(nested(depth), persistence, "pong")
+            elapsed += perf_counter() - start
+            steps += count_steps(persistence.state)
+        return elapsed / steps
+
+    return asyncio.run(play())
+
+
+def main():
+    print(f"{'depth':>8} {'gen us/step':>14} {'async us/step':>14}")
+    for depth in DEPTHS:
+        try:
+            gen = f"{bench_gen(depth) * 1e6:14.2f}"
+        except RecursionError:
+            gen = f"{'RecursionError':>14}"
+        try:
+            async_gen = f"{bench_async_gen(depth) * 1e6:14.2f}"
+        except RecursionError:
+            async_gen = f"{'RecursionError':>14}"
+        print(f"{depth:>8} {gen} {async_gen}")
+
+
+if __name__ == "__main__":
+    sys.setrecursionlimit(1000)
+    main()
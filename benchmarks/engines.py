@@ -0,0 +1,391 @@
+"""
+Measures run_dialog, run_gen_dialog and run_async_gen_dialog on synthetic
+dialogs: deep nesting, long while True loops, wide chains, many messages per
+turn and async steps. For each dialog and engine it reports the turn latency,
+how it grows with the length of the conversation as more steps are replayed,
+the memory allocated by a turn, and the peak size of the state.
+
+Run with:
+
+    python -m benchmarks.engines --output results.json
+
+and compare two runs, failing if a turn got slower by more than the threshold:
+
+    python -m benchmarks.engines --output new.json --compare old.json
+"""
+import argparse
+import asyncio
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from dataclasses import dataclass, field
+from time import perf_counter
+from typing import Any, Callable, Dict, List, Optional
+
+from dialogs_framework import (
+    dialog,
+    run,
+    send_message,
+    get_client_response,
+    run_dialog,
+    run_gen_dialog,
+    run_async_gen_dialog,
+    InMemoryPersistence,
+    JsonStateCodec,
+    BinaryStateCodec,
+)
+
+ENGINES = ["run_dialog", "run_gen_dialog", "run_async_gen_dialog"]
+WARMUP_TURNS = 3
+ALLOCATION_TURNS = 5
+DEFAULT_THRESHOLD = 0.2
+
+
+# Each dialog is written with run for run_dialog, and with yield for the generator engines
+
+
+@dialog(version="1.0")
+def deep_run(depth: int):
+    if depth == 0:
+        while True:
+            run(send_message("ping"))
+            run(get_client_response())
+    run(deep_run(depth - 1))
+
+
+@dialog(version="1.0")
+def deep_gen(depth: int):
+    if depth == 0:
+        while True:
+            yield send_message("ping")
+            yield get_client_response()
+    yield deep_gen(depth - 1)
+
+
+@dialog(version="1.0")
+def prompt_run(text: str):
+    run(send_message(text))
+    return run(get_client_response())
+
+
+@dialog(version="1.0")
+def prompt_gen(text: str):
+    yield send_message(text)
+    return (yield get_client_response())
+
+
+@dialog(version="1.0")
+def loop_run():
+    while True:
+        run(prompt_run("How are you?"))
+
+
+@dialog(version="1.0")
+def loop_gen():
+    while True:
+        yield prompt_gen("How are you?")
+
+
+@dialog(version="1.0")
+def chain_run(width: int):
+    return [run(prompt_run(f"Question {i}")) for i in range(width)]
+
+
+@dialog(version="1.0")
+def chain_gen(width: int):
+    answers = []
+    for i in range(width):
+        answers.append((yield prompt_gen(f"Question {i}")))
+    return answers
+
+
+@dialog(version="1.0")
+def chatty_run(messages: int):
+    while True:
+        for i in range(messages):
+            run(send_message(f"Message {i}"))
+        run(get_client_response())
+
+
+@dialog(version="1.0")
+def chatty_gen(messages: int):
+    while True:
+        for i in range(messages):
+            yield send_message(f"Message {i}")
+        yield get_client_response()
+
+
+@dialog(version="1.0")
+def compute(i: int):
+    return i * i
+
+
+@dialog(version="1.0")
+async def fetch(i: int):
+    await asyncio.sleep(0)
+    return i * i
+
+
+@dialog(version="1.0")
+def steps_run(steps: int):
+    while True:
+        total = sum(run(compute(i)) for i in range(steps))
+        run(send_message(f"Total {total}"))
+        run(get_client_response())
+
+
+@dialog(version="1.0")
+def steps_gen(steps: int, step):
+    while True:
+        total = 0
+        for i in range(steps):
+            total += yield step(i)
+        yield send_message(f"Total {total}")
+        yield get_client_response()
+
+
+@dataclass
+class Scenario:
+    name: str
+    params: Dict[str, int]
+    turns: int
+    dialogs: Dict[str, Callable[[], Any]] = field(default_factory=dict)
+
+
+def scenarios(quick: bool) -> List[Scenario]:
+    scale = 10 if quick else 1
+    depth, width, messages, steps = 100, 200 // scale, 50, 20
+    loop_turns, turns = 500 // scale, 50 // scale
+
+    def both(sync_factory, gen_factory):
+        return {
+            "run_dialog": sync_factory,
+            "run_gen_dialog": gen_factory,
+            "run_async_gen_dialog": gen_factory,
+        }
+
+    async_steps = both(lambda: steps_run(steps), lambda: steps_gen(steps, compute))
+    async_steps["run_async_gen_dialog"] = lambda: steps_gen(steps, fetch)
+    return [
+        Scenario(
+            "deep_nesting",
+            {"depth": depth},
+            turns,
+            both(lambda: deep_run(depth), lambda: deep_gen(depth)),
+        ),
+        Scenario("long_loop", {}, loop_turns, both(loop_run, loop_gen)),
+        Scenario(
+            "wide_chain",
+            {"width": width},
+            width,
+            both(lambda: chain_run(width), lambda: chain_gen(width)),
+        ),
+        Scenario(
+            "many_messages",
+            {"messages": messages},
+            turns,
+            both(lambda: chatty_run(messages), lambda: chatty_gen(messages)),
+        ),
+        Scenario("async_steps", {"steps": steps}, turns, async_steps),
+    ]
+
+
+def turn_runner(engine: str, loop: asyncio.AbstractEventLoop) -> Callable[..., Any]:
+    if engine == "run_dialog":
+        return run_dialog
+    if engine == "run_gen_dialog":
+        return run_gen_dialog
+
+    # the loop is created once, so the timings do not include starting one per turn
+    def run_async_turn(dialog, persistence, client_response):
+        return loop.run_until_complete(run_async_gen_dialog(dialog, persistence, client_response))
+
+    return run_async_turn
+
+
+def count_nodes(state) -> int:
+    nodes = 0
+    pending = [state]
+    while pending:
+        node = pending.pop()
+        nodes += 1
+        pending.extend(node.subdialogs)
+    return nodes
+
+
+def slope(ys: List[float]) -> float:
+    """
+    The least squares slope of the values by their index.
+    """
+    if len(ys) < 2:
+        return 0.0
+    mean_x = (len(ys) - 1) / 2
+    mean_y = statistics.mean(ys)
+    covariance = sum((x - mean_x) * (y - mean_y) for x, y in enumerate(ys))
+    variance = sum((x - mean_x) ** 2 for x in range(len(ys)))
+    return covariance / variance
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def bench(scenario: Scenario, engine: str) -> Dict[str, Any]:
+    loop = asyncio.new_event_loop()
+    try:
+        return bench_turns(scenario, engine, turn_runner(engine, loop))
+    finally:
+        loop.close()
+
+
+def bench_turns(scenario: Scenario, engine: str, run_turn: Callable[..., Any]) -> Dict[str, Any]:
+    dialog_factory = scenario.dialogs[engine]
+    json_codec, binary_codec = JsonStateCodec(), BinaryStateCodec()
+
+    warmup = InMemoryPersistence[str]()
+    for _ in range(min(WARMUP_TURNS, scenario.turns)):
+        run_turn(dialog_factory(), warmup, "fine")
+
+    persistence = InMemoryPersistence[str]()
+    latencies = []
+    peak_nodes = peak_json_bytes = peak_binary_bytes = 0
+    for _ in range(scenario.turns):
+        start = perf_counter()
+        run_turn(dialog_factory(), persistence, "fine")
+        latencies.append((perf_counter() - start) * 1e6)
+
+        state = persistence.state
+        assert state is not None
+        peak_nodes = max(peak_nodes, count_nodes(state))
+        peak_json_bytes = max(peak_json_bytes, len(json_codec.encode(state)))
+        peak_binary_bytes = max(peak_binary_bytes, len(binary_codec.encode(state)))
+
+    # a few more turns of the same conversation, traced apart since tracing slows them down
+    allocated = []
+    tracemalloc.start()
+    try:
+        for _ in range(ALLOCATION_TURNS):
+            tracemalloc.clear_traces()
+            before, _ = tracemalloc.get_traced_memory()
+            run_turn(dialog_factory(), persistence, "fine")
+            _, peak = tracemalloc.get_traced_memory()
+            allocated.append(peak - before)
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "scenario": scenario.name,
+        "engine": engine,
+        "params": scenario.params,
+        "turns": scenario.turns,
+        "latency_us": {
+            "mean": statistics.mean(latencies),
+            "p50": percentile(latencies, 0.5),
+            "p95": percentile(latencies, 0.95),
+            "first": latencies[0],
+            "last": latencies[-1],
+        },
+        "replay_us_per_turn": slope(latencies),
+        "allocated_peak_bytes": max(allocated),
+        "state": {
+            "peak_nodes": peak_nodes,
+            "peak_json_bytes": peak_json_bytes,
+            "peak_binary_bytes": peak_binary_bytes,
+        },
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        output = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        )
+        return output.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(quick: bool, only: Optional[List[str]] = None) -> Dict[str, Any]:
+    results = []
+    for scenario in scenarios(quick):
+        if only and scenario.name not in only:
+            continue
+        for engine in ENGINES:
+            results.append(bench(scenario, engine))
+    return {
+        "meta": {
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "quick": quick,
+        },
+        "results": results,
+    }
+
+
+def print_results(report: Dict[str, Any]) -> None:
+    print(
+        f"{'scenario':<15} {'engine':<21} {'mean us':>10} {'p95 us':>10} {'replay us/turn':>15} "
+        f"{'alloc KB':>9} {'nodes':>7} {'binary KB':>10}"
+    )
+    for result in report["results"]:
+        print(
+            f"{result['scenario']:<15} {result['engine']:<21} "
+            f"{result['latency_us']['mean']:>10.1f} {result['latency_us']['p95']:>10.1f} "
+            f"{result['replay_us_per_turn']:>15.3f} "
+            f"{result['allocated_peak_bytes'] / 1024:>9.1f} {result['state']['peak_nodes']:>7} "
+            f"{result['state']['peak_binary_bytes'] / 1024:>10.1f}"
+        )
+
+
+def compare(report: Dict[str, Any], baseline: Dict[str, Any], threshold: float) -> bool:
+    """
+    Print the change of the median turn latency from the baseline, and return
+    whether any of them got slower by more than the threshold.
+    """
+    baseline_results = {(r["scenario"], r["engine"]): r for r in baseline["results"]}
+    regressed = False
+    print(f"\ncompared to {baseline['meta'].get('commit') or 'baseline'}:")
+    for result in report["results"]:
+        old = baseline_results.get((result["scenario"], result["engine"]))
+        if old is None:
+            continue
+        ratio = result["latency_us"]["p50"] / old["latency_us"]["p50"]
+        flag = ""
+        if ratio > 1 + threshold:
+            regressed = True
+            flag = "  REGRESSION"
+        print(f"{result['scenario']:<15} {result['engine']:<21} {ratio:>7.2f}x{flag}")
+    return regressed
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="a JSON file of an earlier run to compare to")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+    parser.add_argument("--quick", action="store_true", help="shorter conversations")
+    parser.add_argument("--scenario", action="append", help="run only these scenarios")
+    args = parser.parse_args(argv)
+
+    report = run_suite(args.quick, args.scenario)
+    print_results(report)
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+
+    if args.compare:
+        with open(args.compare) as baseline:
+            if compare(report, json.load(baseline), args.threshold):
+                return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,66 @@
+"""
+Compares loading a long conversation with state_from_dict, which builds the
+whole tree, and lazy_state_from_dict, which builds only the states replay
+walks into.
+
+Run with:
+
+    python -m benchmarks.lazy_state
+"""
+from dataclasses import asdict
+from time import perf_counter
+
+from dialogs_framework import dialog, send_message, get_client_response, run_gen_dialog
+from dialogs_framework import InMemoryPersistence
+from dialogs_framework.dialog_state import state_from_dict, lazy_state_from_dict
+
+TURNS = 500
+REPLAYS = 20
+
+
+@dialog(version="1.0")
+def prompt(text: str):
+    yield send_message(text)
+    response = yield get_client_response()
+    return response
+
+
+@dialog(version="1.0")
+def chatty_dialog():
+    while True:
+        yield send_message("Let's talk.")
+        yield prompt("How are you?")
+        yield prompt("Anything else?")
+
+
+def build_conversation() -> dict:
+    persistence = InMemoryPersistence[str]()
+    for _ in range(TURNS):
+        run_gen_dialog(chatty_dialog(), persistence, "fine")
+    return asdict(persistence.state)
+
+
+def measure_turn(raw_state: dict, load) -> float:
+    elapsed = 0.0
+    for _ in range(REPLAYS):
+        start = perf_counter()
+        persistence = InMemoryPersistence(load(raw_state))
+        run_gen_dialog(chatty_dialog(), persistence, "fine")
+        elapsed += perf_counter() - start
+    return elapsed / REPLAYS
+
+
+def main():
+    raw_state = build_conversation()
+
+    print(f"conversation: {TURNS} turns")
+    print(f"{'':>20} {'ms/turn':>10}")
+    for label, load in (
+        ("state_from_dict", state_from_dict),
+        ("lazy_state_from_dict", lazy_state_from_dict),
+    ):
+        print(f"{label:>20} {measure_turn(raw_state, load) * 1e3:10.2f}")
+
+
+if __name__ == "__main__":
+    main()
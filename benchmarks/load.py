@@ -0,0 +1,336 @@
+"""
+Simulates many concurrent scripted conversations with the example chat servers,
+in-process, without a network. The guessbot apps are called through httpx's
+ASGI transport, as a server would call them, and the dragons dialog, which has
+no app of its own, is run with run_gen_dialog_in_executor.
+
+It reports the throughput, the turn latency percentiles, the lag of the event
+loop and the memory of the process over time. A lag that grows with the load
+shows a call blocking the event loop, such as running a sync engine directly in
+an async route.
+
+Run with:
+
+    python -m benchmarks.load --target adf --conversations 1000
+    python -m benchmarks.load --target df --conversations 2000 --output load.json
+
+The targets are adf, the async route of server_adf, adf-stream, its streaming
+route, df, the route of server_df, and dragons.
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import os
+import resource
+import statistics
+import sys
+import uuid
+from dataclasses import dataclass, field
+from time import perf_counter
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional
+
+import httpx
+
+from dialogs_framework import KeyedInMemoryPersistence, run_gen_dialog_in_executor
+
+# A conversation sends a message and receives the messages of the server
+Send = Callable[[str], Awaitable[List[str]]]
+
+DEFAULT_SAMPLE_INTERVAL = 0.5
+
+
+def guessbot_script() -> Iterator[str]:
+    """
+    Starts the game, then guesses 1 to 10 in order.
+    """
+    yield "hi"
+    for guess in range(1, 11):
+        yield str(guess)
+
+
+def guessbot_done(messages: List[str]) -> bool:
+    return any(message.startswith("Awesome") for message in messages)
+
+
+def dragons_script() -> Iterator[str]:
+    yield ""
+    yield "Johnny"
+    yield "yes"
+    yield "1"
+    while True:
+        yield "yes"
+
+
+@dataclass
+class Target:
+    script: Callable[[], Iterator[str]]
+    is_done: Callable[[List[str]], bool]
+    connect: Callable[[], Callable[[str], Send]]
+
+
+def http_target(
+    module: str, path: str, stream: bool = False
+) -> Callable[[], Callable[[str], Send]]:
+    def connect() -> Callable[[str], Send]:
+        app = importlib.import_module(module).app  # type: ignore
+        client = httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=app), base_url="http://load", timeout=None
+        )
+
+        def conversation(chat_id: str) -> Send:
+            async def send(message: str) -> List[str]:
+                response = await client.post(path, params={"message": message, "chat_id": chat_id})
+                response.raise_for_status()
+                if stream:
+                    return response.text.splitlines()
+                return response.json()
+
+            return send
+
+        return conversation
+
+    return connect
+
+
+def dragons_target() -> Callable[[str], Send]:
+    chat_server = importlib.import_module("examples.dragons_gen.chat_server")
+    store = KeyedInMemoryPersistence()
+
+    def conversation(chat_id: str) -> Send:
+        async def send(message: str) -> List[str]:
+            step = await run_gen_dialog_in_executor(
+                chat_server.intelligent_dialog(),
+                store.for_conversation(chat_id),
+                message,
+                conversation_id=chat_id,
+            )
+            if step.is_done:
+                return step.messages + ["Ciao!"]
+            return step.messages
+
+        return send
+
+    return conversation
+
+
+TARGETS = {
+    "adf": Target(
+        guessbot_script, guessbot_done, http_target("examples.guessbot.server.server_adf", "/async")
+    ),
+    "adf-stream": Target(
+        guessbot_script,
+        guessbot_done,
+        http_target("examples.guessbot.server.server_adf", "/async/stream", stream=True),
+    ),
+    "df": Target(
+        guessbot_script, guessbot_done, http_target("examples.guessbot.server.server_df", "/")
+    ),
+    "dragons": Target(dragons_script, lambda messages: "Ciao!" in messages, dragons_target),
+}
+
+
+@dataclass
+class Sample:
+    time: float
+    rss_mb: float
+    loop_lag_ms: float
+    turns: int
+    active: int
+
+
+@dataclass
+class LoadStats:
+    latencies: List[float] = field(default_factory=list)
+    lags: List[float] = field(default_factory=list)
+    samples: List[Sample] = field(default_factory=list)
+    completed: int = 0
+    errors: int = 0
+    first_error: Optional[str] = None
+    active: int = 0
+
+
+def rss_mb() -> float:
+    """
+    The resident memory of the process, or its peak where /proc is missing.
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # bytes on macOS, kilobytes elsewhere
+        return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+async def converse(
+    target: Target, send: Send, stats: LoadStats, think_time: float, deadline: float
+) -> None:
+    stats.active += 1
+    try:
+        for message in target.script():
+            if perf_counter() > deadline:
+                return
+            start = perf_counter()
+            messages = await send(message)
+            stats.latencies.append(perf_counter() - start)
+            if target.is_done(messages):
+                stats.completed += 1
+                return
+            if think_time:
+                await asyncio.sleep(think_time)
+    except Exception as e:
+        stats.errors += 1
+        stats.first_error = stats.first_error or repr(e)
+    finally:
+        stats.active -= 1
+
+
+async def monitor(stats: LoadStats, interval: float, start: float) -> None:
+    """
+    Measure how late the loop wakes up from each sleep, and sample the memory.
+    """
+    while True:
+        before = perf_counter()
+        await asyncio.sleep(interval)
+        lag = perf_counter() - before - interval
+        stats.lags.append(lag)
+        stats.samples.append(
+            Sample(
+                time=perf_counter() - start,
+                rss_mb=rss_mb(),
+                loop_lag_ms=lag * 1000,
+                turns=len(stats.latencies),
+                active=stats.active,
+            )
+        )
+
+
+async def run_load(
+    target_name: str,
+    conversations: int,
+    concurrency: int,
+    think_time: float,
+    duration: float,
+    sample_interval: float,
+) -> Dict[str, Any]:
+    target = TARGETS[target_name]
+    conversation = target.connect()
+    stats = LoadStats()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    start = perf_counter()
+    deadline = start + duration
+    monitor_task = asyncio.ensure_future(monitor(stats, sample_interval, start))
+
+    async def limited() -> None:
+        async with semaphore:
+            await converse(target, conversation(str(uuid.uuid4())), stats, think_time, deadline)
+
+    await asyncio.gather(*(limited() for _ in range(conversations)))
+    elapsed = perf_counter() - start
+    monitor_task.cancel()
+
+    return report(target_name, conversations, concurrency, elapsed, stats)
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def report(
+    target_name: str, conversations: int, concurrency: int, elapsed: float, stats: LoadStats
+) -> Dict[str, Any]:
+    milliseconds = [latency * 1000 for latency in stats.latencies]
+    lags = [lag * 1000 for lag in stats.lags]
+    return {
+        "target": target_name,
+        "conversations": conversations,
+        "concurrency": concurrency,
+        "elapsed_s": elapsed,
+        "completed": stats.completed,
+        "errors": stats.errors,
+        "first_error": stats.first_error,
+        "turns": len(stats.latencies),
+        "turns_per_s": len(stats.latencies) / elapsed,
+        "latency_ms": {
+            "mean": statistics.mean(milliseconds) if milliseconds else 0.0,
+            "p50": percentile(milliseconds, 0.5),
+            "p95": percentile(milliseconds, 0.95),
+            "p99": percentile(milliseconds, 0.99),
+            "max": max(milliseconds, default=0.0),
+        },
+        "loop_lag_ms": {
+            "mean": statistics.mean(lags) if lags else 0.0,
+            "p99": percentile(lags, 0.99),
+            "max": max(lags, default=0.0),
+        },
+        "peak_rss_mb": max((sample.rss_mb for sample in stats.samples), default=rss_mb()),
+        "samples": [vars(sample) for sample in stats.samples],
+    }
+
+
+def print_report(result: Dict[str, Any]) -> None:
+    print(f"{'time s':>8} {'rss MB':>8} {'lag ms':>8} {'turns':>8} {'active':>7}")
+    for sample in result["samples"]:
+        print(
+            f"{sample['time']:>8.1f} {sample['rss_mb']:>8.1f} {sample['loop_lag_ms']:>8.2f} "
+            f"{sample['turns']:>8} {sample['active']:>7}"
+        )
+
+    latency, lag = result["latency_ms"], result["loop_lag_ms"]
+    print(
+        f"\n{result['target']}: {result['conversations']} conversations, "
+        f"{result['concurrency']} at a time, in {result['elapsed_s']:.1f}s"
+    )
+    print(
+        f"completed {result['completed']}, errors {result['errors']}, "
+        f"{result['turns']} turns, {result['turns_per_s']:.1f} turns/s"
+    )
+    print(
+        f"turn latency ms: p50 {latency['p50']:.2f}, p95 {latency['p95']:.2f}, "
+        f"p99 {latency['p99']:.2f}, max {latency['max']:.2f}"
+    )
+    print(f"loop lag ms: mean {lag['mean']:.2f}, p99 {lag['p99']:.2f}, max {lag['max']:.2f}")
+    print(f"peak rss MB: {result['peak_rss_mb']:.1f}")
+    if result["first_error"]:
+        print(f"first error: {result['first_error']}")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--target", choices=sorted(TARGETS), default="adf")
+    parser.add_argument("--conversations", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, help="defaults to all the conversations")
+    parser.add_argument(
+        "--think-time", type=float, default=0.0, help="seconds between the turns of a client"
+    )
+    parser.add_argument(
+        "--duration", type=float, default=60.0, help="stop starting turns after this many seconds"
+    )
+    parser.add_argument("--sample-interval", type=float, default=DEFAULT_SAMPLE_INTERVAL)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    result = asyncio.run(
+        run_load(
+            args.target,
+            args.conversations,
+            args.concurrency or args.conversations,
+            args.think_time,
+            args.duration,
+            args.sample_interval,
+        )
+    )
+    print_report(result)
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(result, output, indent=2)
+    return 1 if result["errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,62 @@
+"""
+Measures the turns per second of SqlitePersistence with 1, 8 and 64
+conversations running concurrently on threads, with and without group commit,
+syncing every commit to disk.
+
+Run with:
+
+    python -m benchmarks.sqlite_persistence
+"""
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+from dialogs_framework import dialog, send_message, get_client_response, run_gen_dialog
+from dialogs_framework.persistence.sqlite import SqlitePersistence
+
+TURNS = 50
+CONCURRENCY = (1, 8, 64)
+
+
+@dialog(version="1.0")
+def chatty_dialog():
+    while True:
+        yield send_message("How are you?")
+        yield get_client_response()
+
+
+def measure(directory: str, concurrency: int, **options) -> float:
+    store = SqlitePersistence(
+        os.path.join(directory, f"{concurrency}-{len(options)}.db"), **options
+    )
+
+    def converse(conversation_id: int) -> None:
+        persistence = store.for_conversation(conversation_id)
+        for _ in range(TURNS):
+            run_gen_dialog(chatty_dialog(), persistence, "fine")
+
+    start = perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(converse, range(concurrency)))
+    elapsed = perf_counter() - start
+    store.close()
+    return concurrency * TURNS / elapsed
+
+
+def main():
+    configurations = (
+        ("no group commit", {"group_commit": False, "synchronous": "FULL"}),
+        ("group commit", {"synchronous": "FULL"}),
+        ("4 shards", {"shards": 4, "pool_size": 8, "synchronous": "FULL"}),
+    )
+    print(f"turns per second, {TURNS} turns per conversation")
+    print(f"{'conversations':>16}" + "".join(f"{label:>18}" for label, _ in configurations))
+    with tempfile.TemporaryDirectory() as directory:
+        for concurrency in CONCURRENCY:
+            results = [measure(directory, concurrency, **options) for _, options in configurations]
+            print(f"{concurrency:>16}" + "".join(f"{result:18.0f}" for result in results))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Compares the size and the encode and decode times of the state codecs
+on a long synthetic conversation.
+
+Run with:
+
+    python -m benchmarks.state_codecs
+"""
+import json
+from dataclasses import asdict
+from time import perf_counter
+
+from dialogs_framework import dialog, send_message, get_client_response, run_gen_dialog
+from dialogs_framework import InMemoryPersistence, state_from_dict
+from dialogs_framework.state_codecs import BinaryStateCodec, JsonStateCodec
+
+TURNS = 1000
+REPEATS = 5
+
+
+class AsdictCodec:
+    """
+    The baseline: dataclasses.asdict and state_from_dict with plain JSON.
+    """
+
+    def encode(self, state):
+        return json.dumps(asdict(state)).encode()
+
+    def decode(self, data):
+        return state_from_dict(json.loads(data))
+
+
+@dialog(version="1.0")
+def prompt(text: str):
+    yield send_message(text)
+    yield send_message("Take your time.")
+    response = yield get_client_response()
+    return response
+
+
+@dialog(version="1.0")
+def chatty_dialog():
+    while True:
+        yield send_message("Let's talk.")
+        yield send_message("About anything.")
+        yield prompt("How are you?")
+        yield prompt("Anything else?")
+
+
+def build_conversation():
+    persistence = InMemoryPersistence[str]()
+    for turn in range(TURNS):
+        run_gen_dialog(chatty_dialog(), persistence, f"answer {turn}")
+    return persistence.state
+
+
+def measure(codec, state):
+    start = perf_counter()
+    for _ in range(REPEATS):
+        data = codec.encode(state)
+    encode_time = (perf_counter() - start) / REPEATS
+
+    start = perf_counter()
+    for _ in range(REPEATS):
+        codec.decode(data)
+    decode_time = (perf_counter() - start) / REPEATS
+
+    return len(data), encode_time, decode_time
+
+
+def main():
+    state = build_conversation()
+
+    print(f"conversation: {TURNS} turns")
+    print(f"{'':>14} {'bytes':>10} {'encode ms':>10} {'decode ms':>10}")
+    for label, codec in (
+        ("asdict+json", AsdictCodec()),
+        ("json", JsonStateCodec(interned=False)),
+        ("interned json", JsonStateCodec()),
+        ("binary", BinaryStateCodec()),
+    ):
+        size, encode_time, decode_time = measure(codec, state)
+        print(f"{label:>14} {size:10d} {encode_time * 1e3:10.2f} {decode_time * 1e3:10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,69 @@
-from .dialogs import run_dialog, run
-from .gen_dialogs import run_gen_dialog
-from .async_gen_dialogs import run_async_gen_dialog, dialog_result
+from .dialogs import run_dialog, run, step_handlers
+from .gen_dialogs import run_gen_dialog, gen_step_handlers
+from .async_gen_dialogs import (
+    run_async_gen_dialog,
+    dialog_result,
+    gather,
+    async_gen_step_handlers,
+)
 from .types import (
     dialog,
     send_message,
     get_client_response,
+    checkpoint,
     BaseDialog,
     Dialog,
     DialogStateException,
+    StaleStateException,
+    DialogTimeoutException,
+    DialogStepDone,
+    DialogStepNotDone,
     GenDialog,
     AsyncDialog,
     AsyncGenDialog,
 )
-from .dialog_state import DialogState, new_empty_state, state_from_dict, Result
+from .dialog_state import (
+    DialogState,
+    new_empty_state,
+    state_from_dict,
+    state_to_dict,
+    lazy_state_from_dict,
+    LazyDialogState,
+    intern_state_dict,
+    Result,
+    BlobResult,
+    StateChanges,
+    record_update,
+)
+from .batch import BatchResult, run_many
+from .blobs import BlobStore, InMemoryBlobStore, DirectoryBlobStore
+from .compact_state import CompactDialogState, compact_state, new_compact_state
 from .persistence.persistence import PersistenceProvider
-from .persistence.in_memory import InMemoryPersistence
+from .persistence.in_memory import InMemoryPersistence, KeyedInMemoryPersistence
+from .persistence.async_persistence import AsyncPersistenceProvider, ThreadPoolPersistence
+from .persistence.keyed import KeyedPersistenceProvider
+from .persistence.sqlite import SqlitePersistence
+from .persistence.journal import JournalPersistence
+from .executor import (
+    DialogExecutor,
+    ExecutorStats,
+    run_dialog_in_executor,
+    run_gen_dialog_in_executor,
+)
+from .metrics import DialogMetrics, MetricsRegistry, set_metrics
+from .process_pool import ProcessPoolEngine
+from .session_cache import SessionCache
+from .streaming import stream_async_gen_dialog, stream_gen_dialog
+from .state_codecs import StateCodec, JsonStateCodec, BinaryStateCodec
+from .step_registry import StepRegistry
+from .generic_types import StepContext
+from .symbols import SymbolTable, dialog_symbols
+from .tracing import (
+    Tracer,
+    StepEvent,
+    AggregatingTracer,
+    MultiTracer,
+    StepStats,
+    set_tracer,
+    tracing,
+)
@@ -1,5 +1,6 @@
+import asyncio
 from dataclasses import dataclass
-from typing import Optional, Union, cast, overload
+from typing import Any, Awaitable, Hashable, List, Optional, Sequence, Union, cast
 
 from .types import (
     AsyncDialog,
@@ -9,27 +10,43 @@ from .types import (
     DialogStepDone,
     ServerMessage,
     DialogStepNotDone,
+    DialogTimeoutException,
     SendMessageFunction,
     SendToClientException,
+    StaleStateException,
     Dialog,
     VersionMismatchException,
+    checkpoint,
     get_client_response,
     send_message,
 )
 from .message_queue import MessageQueue
-from .persistence.persistence import PersistenceProvider
+from .persistence.async_persistence import (
+    AnyPersistenceProvider,
+    async_get_state,
+    async_save_turn,
+)
 
 from .generic_types import (
     T,
     ClientResponse,
-    DialogContext,
+    DialogFrame,
+    TurnContext,
     RunDialogReturnType,
     ServerResponse,
-    build_dialog_context,
 )
-from .dialog_state import DialogState
-
-from .gen_dialogs import run_gen_dialog_step
+from .dialog_state import DialogState, tracking_changes
+from .session_cache import SessionCache
+
+from .gen_dialogs import (
+    checkpoint_value,
+    enter_step,
+    exit_frame_step,
+    gen_step_handlers,
+    root_dialog,
+)
+from .step_registry import StepRegistry
+from . import metrics, tracing
 
 
 @dataclass(frozen=True)
@@ -39,159 +56,346 @@ class dialog_result(BaseDialog[T]):
     version: str = "1.0"
 
 
+@dataclass
+class gather(BaseDialog[List[Any]]):
+    """
+    Runs independent subdialogs concurrently, returning their return values in order.
+
+    Each subdialog has its own state, in the order they are given, so replays are
+    deterministic, and the subdialogs that are done are not run again. If some of
+    them wait for a client response, the others still run until they are done or
+    wait too, and they all get the next client response.
+    """
+
+    dialogs: Sequence[BaseDialog[Any]]
+    name: str = "gather"
+    version: str = "1.0"
+
+
 _AsyncGenInputDialogType = Union[
-    get_client_response[T], Dialog[T], GenDialog[T], AsyncDialog, AsyncGenDialog, dialog_result
+    get_client_response[T],
+    Dialog[T],
+    GenDialog[T],
+    AsyncDialog,
+    AsyncGenDialog,
+    dialog_result,
+    gather,
+    checkpoint[T],
 ]
 AsyncGenInputDialogType = Union[_AsyncGenInputDialogType, send_message[ServerMessage]]
 
 
+@metrics.measure_turns("run_async_gen_dialog")
 async def run_async_gen_dialog(
     dialog: AsyncGenInputDialogType,
-    persistence: PersistenceProvider,
+    persistence: AnyPersistenceProvider,
     client_response: ClientResponse,
     fallback_dialog: Optional[AsyncGenInputDialogType] = None,
+    session_cache: Optional[SessionCache] = None,
+    conversation_id: Optional[Hashable] = None,
+    stale_retries: int = 3,
+    deadline: Optional[float] = None,
+    flush_on_timeout: bool = False,
 ) -> Union[DialogStepDone[T, ServerMessage], DialogStepNotDone[ServerMessage]]:
     """
     This is the interface for calling a generator based dialog from an external location.
     It returns an awaitable and allows running dialogs and subdialogs containg async io statements.
 
+    The persistence can be an AsyncPersistenceProvider, which is awaited, or a
+    PersistenceProvider, which is called directly on the event loop.
+
+    If a session_cache is given, the suspended generators of the conversation are kept
+    alive between turns, and resumed instead of replayed whenever possible.
+
+    If saving the state raises StaleStateException, because another turn of the
+    conversation was saved since it was loaded, the turn is run again on the new
+    state, up to stale_retries times.
+
+    If the turn runs for more than deadline seconds, the running step is cancelled
+    and DialogTimeoutException is raised. With flush_on_timeout, the state is saved
+    as it was when the turn was cancelled, so the steps that are done are not run
+    again, and the messages the turn sent are given in the exception. Otherwise
+    the turn runs on a copy of the state, so nothing is changed, even for providers
+    that keep the state in memory, and the next turn starts over.
+
     The returned DialogStep object indicates:
     1. Whether the dialog is done
     2. If it's done, what the return value is
     3. If it's not done, what the next server messages are
     """
+    if session_cache is not None and conversation_id is None:
+        raise ValueError("conversation_id is required when using a session_cache")
 
     queue = MessageQueue[ServerMessage]()
     send: SendMessageFunction = queue.enqueue
 
-    state = persistence.get_state(dialog)
+    state = await async_get_state(persistence, dialog)
     if state.handling_fallback and fallback_dialog is not None:
-        return await _run_fallback_dialog(
-            client_response, dialog, persistence, fallback_dialog, state
-        )
-
-    is_done = False
-    try:
-        return_value = await _run_base_dialog(
-            dialog, build_dialog_context(send, client_response, state)
-        )
-        is_done = True
-    except VersionMismatchException:
-        state.reset(dialog, fallback_mode=True)
-        return await _run_fallback_dialog(
-            client_response, dialog, persistence, fallback_dialog, state
-        )
+        return await _run_fallback_dialog(client_response, dialog, persistence, fallback_dialog)
+
+    if deadline is not None and not flush_on_timeout:
+        state = state.copy()
+
+    with tracking_changes(state) as changes:
+        stack: List[DialogFrame] = []
+        if session_cache is not None:
+            stack = session_cache.resume(conversation_id, dialog, state, allow_async=True) or stack
+
+        is_done = False
+        try:
+            turn = TurnContext(send, client_response, stack)
+            if stack:
+                running = _resume_dialog(turn)
+            else:
+                stack.append(DialogFrame(root_dialog(dialog), state))
+                running = _drive_dialog(turn, None)
+            if deadline is None:
+                return_value = await running
+            else:
+                return_value = await _within_deadline(running, deadline)
+            is_done = True
+        except _DeadlineExceeded:
+            if session_cache is not None:
+                session_cache.discard(conversation_id)
+            if not flush_on_timeout:
+                raise DialogTimeoutException()
+            await async_save_turn(persistence, state, changes)
+            raise DialogTimeoutException(queue.dequeue_all())
+
+        except VersionMismatchException:
+            metrics.version_mismatch(dialog)
+            state.reset(dialog, fallback_mode=True)
+            # providers that load a new copy on every get_state would replay the old state
+            await async_save_turn(persistence, state, None)
+            return await _run_fallback_dialog(client_response, dialog, persistence, fallback_dialog)
+
+        except SendToClientException:
+            if session_cache is not None:
+                session_cache.suspend(conversation_id, dialog, stack)
+
+        try:
+            await async_save_turn(persistence, state, changes)
+        except StaleStateException:
+            if session_cache is not None:
+                session_cache.discard(conversation_id)
+            if stale_retries == 0:
+                raise
+            return await run_async_gen_dialog(
+                dialog,
+                persistence,
+                client_response,
+                fallback_dialog,
+                session_cache,
+                conversation_id,
+                stale_retries - 1,
+                deadline,
+                flush_on_timeout,
+            )
+
+        messages = queue.dequeue_all()
+        if is_done:
+            return DialogStepDone(return_value=cast(T, return_value), messages=messages)
+        else:
+            return DialogStepNotDone(messages=messages)
+
+
+class _DeadlineExceeded(Exception):
+    pass
+
+
+async def _within_deadline(running: Awaitable[T], deadline: float) -> T:
+    """
+    Like asyncio.wait_for, but raises _DeadlineExceeded only if the deadline cancelled
+    running, so a TimeoutError raised by a step is not taken for it. Used for the
+    deadline of a turn and for the timeouts of steps.
+    """
+    task = asyncio.ensure_future(running)
+    expired = False
 
-    except SendToClientException:
-        pass
+    def expire() -> None:
+        nonlocal expired
+        expired = True
+        task.cancel()
 
-    messages = queue.dequeue_all()
-    persistence.save_state(state)
-    if is_done:
-        return DialogStepDone(return_value=cast(T, return_value), messages=messages)
-    else:
-        return DialogStepNotDone(messages=messages)
+    timer = asyncio.get_running_loop().call_later(deadline, expire)
+    try:
+        return await task
+    except asyncio.CancelledError:
+        if expired:
+            raise _DeadlineExceeded() from None
+        raise
+    finally:
+        timer.cancel()
 
 
-async def _run_fallback_dialog(
-    client_response, dialog, persistence, fallback_dialog, state: DialogState
-):
+async def _run_fallback_dialog(client_response, dialog, persistence, fallback_dialog):
     messages: ServerResponse = []
     if fallback_dialog is not None:
+        metrics.fallback_turn(dialog)
         next_step: RunDialogReturnType = await run_async_gen_dialog(
             fallback_dialog, persistence, client_response
         )
         if not next_step.is_done:
             return next_step
         messages = next_step.messages
-        # Fallback dialog completed
+        # Fallback dialog completed, the turn of the fallback saved its own copy of the state
+        state = await async_get_state(persistence, dialog)
         state.reset(dialog, fallback_mode=False)
+        await async_save_turn(persistence, state, None)
 
     next_step = await run_async_gen_dialog(dialog, persistence, client_response, fallback_dialog)
     next_step.messages = messages + next_step.messages
     return next_step
 
 
-@overload
-async def _run_base_dialog(subdialog: send_message[ServerMessage], context: DialogContext) -> None:
-    ...
-
-
-@overload
-async def _run_base_dialog(
-    subdialog: _AsyncGenInputDialogType,
-    context: DialogContext,
-) -> T:
-    ...
-
+async def _drive_dialog(turn: TurnContext, value_for_next_step):
+    """
+    Run the generator and async generator frames of the stack until its bottom frame
+    returns, awaiting async steps along the way.
+    """
+    stack = turn.stack
+    lookup = async_gen_step_handlers.lookup
+    tracer = tracing.active_tracer
+    # When tracing, the event of the step of each frame, aligned with the stack
+    events: List[Optional[tracing.StepEvent]] = [None] * len(stack) if tracer else []
+    try:
+        while True:
+            frame = stack[-1]
+            try:
+                if frame.is_async:
+                    step = await frame.instance.asend(value_for_next_step)
+                else:
+                    step = frame.instance.send(value_for_next_step)
+            except StopIteration as ex:
+                stack.pop()
+                if tracer is not None:
+                    exit_frame_step(tracer, events)
+                if not stack:
+                    return ex.value
+                frame.state.return_value = ex.value
+                value_for_next_step = ex.value
+                continue
+            except StopAsyncIteration:
+                # async generators cannot return a value (https://www.python.org/dev/peps/pep-0525/#asynchronous-generators).
+                # if dialog_result was used then the state is already done with the actual value.
+                stack.pop()
+                if tracer is not None:
+                    exit_frame_step(tracer, events)
+                if not frame.state.is_done:
+                    frame.state.return_value = None
+                value_for_next_step = frame.state.return_value
+                if not stack:
+                    return value_for_next_step
+                continue
+
+            call_index = frame.call_index
+            step_state = enter_step(frame, step)
+            if step_state is None:
+                value_for_next_step = None
+            elif isinstance(step, checkpoint):
+                value_for_next_step = checkpoint_value(step_state)
+            elif step_state.is_done:
+                if tracer is not None:
+                    tracing.step_replayed(tracer, step, call_index, len(stack) - 1)
+                value_for_next_step = step_state.return_value
+            else:
+                handler, is_async = lookup(type(step))
+                if tracer is not None:
+                    events.append(tracing.step_entered(tracer, step, call_index, len(stack) - 1))
+                if is_async:
+                    value_for_next_step = await handler(step, step_state, turn)
+                else:
+                    value_for_next_step = handler(step, step_state, turn)
+                # the step is done, unless the handler pushed a subdialog frame or ran it to its end
+                if stack[-1] is frame:
+                    if not step_state.is_done:
+                        step_state.return_value = value_for_next_step
+                    if tracer is not None:
+                        exit_frame_step(tracer, events)
+    except BaseException as e:
+        if tracer is not None:
+            tracing.steps_interrupted(tracer, events, e)
+        raise
+
+
+async def _resume_dialog(turn: TurnContext):
+    """
+    Continue a session from a session cache, by sending the client response into the
+    innermost suspended generator.
+    """
+    pending_state = turn.stack[-1].state.subdialogs[-1]
+    pending_state.return_value = turn.client_response
+    return await _drive_dialog(turn, turn.client_response)
 
-async def _run_base_dialog(
-    subdialog: AsyncGenInputDialogType,
-    context: DialogContext,
-) -> Optional[T]:
-    state = context.state
-    client_response = context.client_response
-    send = context.send
-    call_counter = context.call_counter
 
-    subdialog_state = state.get_subdialog_state(next(call_counter), subdialog)
+"""
+The handlers of the steps that run_async_gen_dialog supports, on top of the ones of
+run_gen_dialog. Handlers registered as coroutine functions are awaited.
+"""
+async_gen_step_handlers = StepRegistry(parent=gen_step_handlers)
 
-    if subdialog.version != subdialog_state.version:
-        raise VersionMismatchException
 
-    if subdialog_state.is_done:
-        return subdialog_state.return_value
+@async_gen_step_handlers.register(AsyncDialog)
+async def _run_async_dialog(step: AsyncDialog[T], step_state: DialogState, turn: TurnContext) -> T:
+    if step.timeout is None:
+        return await step.dialog()  # type: ignore
 
-    return_value: T
-    if isinstance(subdialog, GenDialog):
-        # for gen_dialog we still need to await, in case it has a subdialog that awaits
-        return_value = await _run_gen_dialog(
-            subdialog, build_dialog_context(send, client_response, subdialog_state)
-        )
-    elif isinstance(subdialog, AsyncDialog):
-        return_value = await subdialog.dialog()  # type: ignore
-    elif isinstance(subdialog, AsyncGenDialog):
-        # async generators cannot return a value (https://www.python.org/dev/peps/pep-0525/#asynchronous-generators).
-        # use yield to dialog_result keeping the result value for when this policy will change.
-        return_value = await _run_async_gen_dialog(
-            subdialog, build_dialog_context(send, client_response, subdialog_state)
-        )
-        if (
-            subdialog_state.is_done
-        ):  # if dialog_result was used then this is the actual value. stop here
-            return subdialog_state.return_value
-    elif isinstance(subdialog, dialog_result):
-        # a solution for async generators not having return value, this step sets the
-        # parent dialog value
-        return_value = subdialog.value
-        state.return_value = subdialog.value
-    else:
-        # the rest is executed in the same manner as regular gen dialogs
-        return_value = run_gen_dialog_step(subdialog, subdialog_state, client_response, send)
-
-    subdialog_state.return_value = return_value
-    return return_value
-
-
-async def _run_gen_dialog(dialog: GenDialog[T], context: DialogContext) -> T:
-    instance = dialog.dialog()  # type: ignore
     try:
-        value_for_next_step = None
-        while True:
-            next_step = instance.send(value_for_next_step)
-            value_for_next_step = await _run_base_dialog(next_step, context)
-    except StopIteration as ex:
-        return ex.value
+        return await _within_deadline(step.dialog(), step.timeout)  # type: ignore
+    except _DeadlineExceeded:
+        return step.timeout_result
 
 
-async def _run_async_gen_dialog(dialog: AsyncGenDialog[T], context: DialogContext):
-    instance = dialog.dialog()  # type: ignore
+@async_gen_step_handlers.register(AsyncGenDialog)
+async def _enter_async_gen_dialog(
+    step: AsyncGenDialog[T], step_state: DialogState, turn: TurnContext
+) -> Optional[T]:
+    frame = DialogFrame(step.dialog(), step_state, is_async=True)  # type: ignore
+    if step.timeout is None:
+        turn.stack.append(frame)
+        return None
+
+    # A dialog with a timeout runs on a stack of its own, so it can be cancelled as a whole
+    subdialog_turn = TurnContext(turn.send, turn.client_response, [frame])
     try:
-        value_for_next_step = None
-        while True:
-            next_step = await instance.asend(value_for_next_step)
-            value_for_next_step = await _run_base_dialog(next_step, context)
-    except StopAsyncIteration:
-        # async iterator does not return a value...so just return. use yield dialog_result
-        # to setup a dialog result, instead
-        pass
+        return await _within_deadline(_drive_dialog(subdialog_turn, None), step.timeout)
+    except _DeadlineExceeded:
+        # dialog_result may have set the return value before the dialog was cancelled
+        return step_state.return_value if step_state.is_done else step.timeout_result
+
+
+@async_gen_step_handlers.register(dialog_result)
+def _run_dialog_result(step: dialog_result[T], step_state: DialogState, turn: TurnContext) -> T:
+    # a solution for async generators not having return value, this step sets the
+    # parent dialog value
+    turn.stack[-1].state.return_value = step.value
+    return step.value
+
+
+@async_gen_step_handlers.register(gather)
+async def _run_gather(step: gather, step_state: DialogState, turn: TurnContext) -> List[Any]:
+    # The states of all the subdialogs are created up front, in order
+    for index, subdialog in enumerate(step.dialogs):
+        step_state.get_subdialog_state(index, subdialog)
+
+    pending = []
+    for index, subdialog in enumerate(step.dialogs):
+        if step_state.subdialogs[index].is_done:
+            continue
+        frame = DialogFrame(root_dialog(subdialog), step_state)
+        frame.call_index = index
+        subdialog_turn = TurnContext(turn.send, turn.client_response, [frame])
+        pending.append(asyncio.ensure_future(_drive_dialog(subdialog_turn, None)))
+
+    errors = [
+        error
+        for error in await asyncio.gather(*pending, return_exceptions=True)
+        if isinstance(error, BaseException)
+    ]
+    for error in errors:
+        if not isinstance(error, SendToClientException):
+            raise error
+    if errors:
+        raise SendToClientException
+
+    return [state.return_value for state in step_state.subdialogs]
@@ -0,0 +1,114 @@
+import asyncio
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from typing import (
+    AsyncIterator,
+    Callable,
+    Deque,
+    Dict,
+    Generic,
+    Hashable,
+    Iterable,
+    Optional,
+    Tuple,
+    Union,
+)
+
+from .async_gen_dialogs import run_async_gen_dialog, AsyncGenInputDialogType
+from .generic_types import ClientResponse, RunDialogReturnType
+from .persistence.async_persistence import AnyPersistenceProvider
+from .persistence.keyed import KeyedPersistenceProvider
+from .session_cache import SessionCache
+
+
+@dataclass
+class BatchResult(Generic[ClientResponse]):
+    """
+    The outcome of a single message of a batch: the step of the dialog, or the
+    exception raised while running it.
+    """
+
+    conversation_id: Hashable
+    client_response: ClientResponse
+    step: Optional[RunDialogReturnType] = None
+    error: Optional[Exception] = None
+
+
+ConversationPersistence = Union[
+    KeyedPersistenceProvider, Callable[[Hashable], AnyPersistenceProvider]
+]
+
+
+async def run_many(
+    dialog_factory: Callable[[], AsyncGenInputDialogType],
+    persistence: ConversationPersistence,
+    messages: Iterable[Tuple[Hashable, ClientResponse]],
+    concurrency: int = 16,
+    fallback_dialog_factory: Optional[Callable[[], AsyncGenInputDialogType]] = None,
+    session_cache: Optional[SessionCache] = None,
+) -> AsyncIterator[BatchResult[ClientResponse]]:
+    """
+    Run the turns of a batch of messages of many conversations with
+    run_async_gen_dialog, yielding their results as they finish.
+
+    At most concurrency turns run at the same time. The messages of a single
+    conversation are run one after the other, in the order they appear in the
+    batch, while the conversations take turns so that a long one does not hold
+    back the others.
+
+    persistence is a KeyedPersistenceProvider, or a function returning the
+    provider of a conversation id. An exception raised by a turn is reported in
+    its result and does not stop the batch.
+    """
+    if concurrency < 1:
+        raise ValueError("concurrency must be at least 1")
+
+    provider_of: Callable[[Hashable], AnyPersistenceProvider]
+    if isinstance(persistence, KeyedPersistenceProvider):
+        provider_of = persistence.for_conversation
+    else:
+        provider_of = persistence
+
+    pending: Dict[Hashable, Deque[ClientResponse]] = OrderedDict()
+    for conversation_id, client_response in messages:
+        pending.setdefault(conversation_id, deque()).append(client_response)
+    ready = deque(pending)
+
+    results: "asyncio.Queue[Optional[BatchResult]]" = asyncio.Queue()
+
+    async def run_turns() -> None:
+        try:
+            while ready:
+                conversation_id = ready.popleft()
+                client_response = pending[conversation_id].popleft()
+                result = BatchResult(conversation_id, client_response)
+                try:
+                    result.step = await run_async_gen_dialog(
+                        dialog_factory(),
+                        provider_of(conversation_id),
+                        client_response,
+                        fallback_dialog_factory() if fallback_dialog_factory else None,
+                        session_cache,
+                        conversation_id if session_cache is not None else None,
+                    )
+                except Exception as e:
+                    result.error = e
+                # The conversation is ready again only once its turn is done
+                if pending[conversation_id]:
+                    ready.append(conversation_id)
+                await results.put(result)
+        finally:
+            await results.put(None)
+
+    workers = [asyncio.ensure_future(run_turns()) for _ in range(min(concurrency, len(ready)))]
+    try:
+        running = len(workers)
+        while running:
+            result = await results.get()
+            if result is None:
+                running -= 1
+            else:
+                yield result
+    finally:
+        for worker in workers:
+            worker.cancel()
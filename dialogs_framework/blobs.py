@@ -0,0 +1,78 @@
+import hashlib
+import os
+import threading
+from abc import abstractmethod
+from typing import Dict
+
+
+class BlobStore:
+    """
+    This is an interface for storing the large return values of steps outside of
+    the dialog states, keyed by the hash of their content.
+
+    Since the keys are content hashes, a value that is stored twice, by the same
+    conversation or by different ones, is only kept once.
+    """
+
+    @abstractmethod
+    def put(self, key: str, data: bytes) -> None:
+        pass
+
+    @abstractmethod
+    def get(self, key: str) -> bytes:
+        pass
+
+    @abstractmethod
+    def __contains__(self, key: str) -> bool:
+        pass
+
+
+def blob_key(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+class InMemoryBlobStore(BlobStore):
+    def __init__(self) -> None:
+        self.blobs: Dict[str, bytes] = {}
+
+    def put(self, key: str, data: bytes) -> None:
+        self.blobs[key] = data
+
+    def get(self, key: str) -> bytes:
+        return self.blobs[key]
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.blobs
+
+    def __len__(self) -> int:
+        return len(self.blobs)
+
+
+class DirectoryBlobStore(BlobStore):
+    """
+    Stores each blob in a file named by its key, in subdirectories by the first
+    two characters of the key. Files are written to a temporary name and renamed,
+    so a blob is either missing or whole.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def put(self, key: str, data: bytes) -> None:
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporary_path, "wb") as blob_file:
+            blob_file.write(data)
+        os.replace(temporary_path, path)
+
+    def get(self, key: str) -> bytes:
+        with open(self._path(key), "rb") as blob_file:
+            return blob_file.read()
+
+    def __contains__(self, key: str) -> bool:
+        return os.path.exists(self._path(key))
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key)
@@ -0,0 +1,297 @@
+from array import array
+from typing import Any, Dict, Generic, List, Optional, Sequence, TypeVar
+
+from .dialog_state import DialogState, Result
+from .types import BaseDialog, DialogStateException, checkpoint, is_checkpoint_name
+from .symbols import dialog_symbols
+
+T = TypeVar("T")
+
+_DONE = 1
+_SENT_TO_CLIENT = 2
+_HANDLING_FALLBACK = 4
+
+_NO_PARENT = -1
+
+_CHECKPOINT_NAME = dialog_symbols.intern(checkpoint.name)
+
+
+class CompactStateTree:
+    """
+    This class stores a whole tree of dialog states as parallel flat arrays,
+    instead of one object per state.
+
+    Each state is a node index into the arrays: its parent, the ids of its name and
+    version in dialog_symbols, a bitfield of its flags, and its result. Only states
+    that have subdialogs get an array of their children.
+
+    The nodes of the states that are dropped, when a checkpoint folds them or a
+    state is reset, are released and reused by the next states that are added, so
+    a dialog that loops through a checkpoint does not grow the arrays.
+    """
+
+    __slots__ = (
+        "parents",
+        "names",
+        "versions",
+        "flags",
+        "results",
+        "children",
+        "free",
+    )
+
+    def __init__(self) -> None:
+        self.parents = array("i")
+        self.names = array("i")
+        self.versions = array("i")
+        self.flags = bytearray()
+        self.results: List[Any] = []
+        self.children: Dict[int, array] = {}
+        self.free: List[int] = []
+
+    def __len__(self) -> int:
+        return len(self.flags)
+
+    def add_node(self, parent: int, name: str, version: str) -> int:
+        if self.free:
+            node = self.free.pop()
+            self.parents[node] = parent
+            self.names[node] = dialog_symbols.intern(name)
+            self.versions[node] = dialog_symbols.intern(version)
+        else:
+            node = len(self.flags)
+            self.parents.append(parent)
+            self.names.append(dialog_symbols.intern(name))
+            self.versions.append(dialog_symbols.intern(version))
+            self.flags.append(0)
+            self.results.append(None)
+        if parent != _NO_PARENT:
+            children = self.children.get(parent)
+            if children is None:
+                children = self.children[parent] = array("i")
+            children.append(node)
+        return node
+
+    def release(self, nodes: Sequence[int]) -> None:
+        """
+        Release nodes that are no longer reachable, and all their descendants.
+        """
+        pending = list(nodes)
+        while pending:
+            node = pending.pop()
+            children = self.children.pop(node, None)
+            if children is not None:
+                pending.extend(children)
+            self.flags[node] = 0
+            self.results[node] = None
+            self.free.append(node)
+
+
+class CompactDialogState(Generic[T]):
+    """
+    A view of a single state in a CompactStateTree.
+
+    It has the same interface as DialogState, so the engines and persistence
+    providers can use either. Views are cheap and created on access; the data
+    lives in the tree.
+    """
+
+    __slots__ = ("tree", "node", "revision")
+
+    def __init__(self, tree: CompactStateTree, node: int):
+        self.tree = tree
+        self.node = node
+        self.revision = 0
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, CompactDialogState):
+            return NotImplemented
+        return self.tree is other.tree and self.node == other.node
+
+    def __repr__(self) -> str:
+        return f"CompactDialogState(name={self.name!r}, version={self.version!r}, node={self.node})"
+
+    @property
+    def name(self) -> str:
+        return dialog_symbols[self.tree.names[self.node]]
+
+    @property
+    def version(self) -> str:
+        return dialog_symbols[self.tree.versions[self.node]]
+
+    @property
+    def subdialogs(self) -> List["CompactDialogState"]:
+        children = self.tree.children.get(self.node, ())
+        return [CompactDialogState(self.tree, child) for child in children]
+
+    @property
+    def result(self) -> Optional[Result]:
+        return Result(self.return_value) if self.is_done else None
+
+    def get_subdialog_state(
+        self, subdialog_index: int, subdialog: BaseDialog
+    ) -> "CompactDialogState":
+        tree = self.tree
+        children = tree.children.get(self.node)
+        length = 0 if children is None else len(children)
+        if length == subdialog_index:
+            return CompactDialogState(
+                tree, tree.add_node(self.node, subdialog.name, subdialog.version)
+            )
+
+        return CompactDialogState(tree, children[subdialog_index])  # type: ignore
+
+    @property
+    def return_value(self) -> T:
+        if not self.tree.flags[self.node] & _DONE:
+            raise DialogStateException("Dialog not done yet")
+
+        return self.tree.results[self.node]
+
+    @return_value.setter
+    def return_value(self, value: T) -> None:
+        if self.tree.flags[self.node] & _DONE:
+            raise DialogStateException("Dialog is done, cannot set return value")
+
+        self.tree.results[self.node] = value
+        self.tree.flags[self.node] |= _DONE
+
+    @property
+    def is_done(self) -> bool:
+        return bool(self.tree.flags[self.node] & _DONE)
+
+    @property
+    def sent_to_client(self) -> bool:
+        return bool(self.tree.flags[self.node] & _SENT_TO_CLIENT)
+
+    @sent_to_client.setter
+    def sent_to_client(self, value: bool) -> None:
+        self._set_flag(_SENT_TO_CLIENT, value)
+
+    @property
+    def handling_fallback(self) -> bool:
+        return bool(self.tree.flags[self.node] & _HANDLING_FALLBACK)
+
+    @handling_fallback.setter
+    def handling_fallback(self, value: bool) -> None:
+        self._set_flag(_HANDLING_FALLBACK, value)
+
+    def skips_to_checkpoint(self, subdialog_index: int, subdialog: BaseDialog) -> bool:
+        if subdialog_index != 0:
+            return False
+
+        children = self.tree.children.get(self.node)
+        if not children:
+            return False
+
+        folded_id = self.tree.names[children[0]]
+        if folded_id == _CHECKPOINT_NAME:
+            folded = checkpoint.name
+        else:
+            folded = dialog_symbols[folded_id]
+            if not is_checkpoint_name(folded):
+                return False
+
+        return not (isinstance(subdialog, checkpoint) and subdialog.name == folded)
+
+    def fold_checkpoint(self) -> None:
+        children = self.tree.children.get(self.node)
+        if not children or not self.tree.flags[children[-1]] & _DONE:
+            raise DialogStateException("Checkpoint not done yet")
+
+        self.tree.children[self.node] = children[-1:]
+        self.tree.release(children[:-1])
+
+    def reset(self, dialog: BaseDialog, fallback_mode: bool) -> None:
+        tree = self.tree
+        children = tree.children.pop(self.node, None)
+        if children is not None:
+            tree.release(children)
+        tree.names[self.node] = dialog_symbols.intern(dialog.name)
+        tree.versions[self.node] = dialog_symbols.intern(dialog.version)
+        tree.results[self.node] = None
+        tree.flags[self.node] = _HANDLING_FALLBACK if fallback_mode else 0
+
+    def compacted(self) -> "CompactDialogState":
+        """
+        Copy this state and its subdialogs to a new tree, without the released nodes
+        of the states that were dropped.
+        """
+        tree = self.tree
+        new_tree = CompactStateTree()
+        pending = [(self.node, _NO_PARENT)]
+        while pending:
+            node, new_parent = pending.pop()
+            new_node = new_tree.add_node(
+                new_parent, dialog_symbols[tree.names[node]], dialog_symbols[tree.versions[node]]
+            )
+            new_tree.flags[new_node] = tree.flags[node]
+            new_tree.results[new_node] = tree.results[node]
+            children = tree.children.get(node, ())
+            pending.extend((child, new_node) for child in reversed(children))
+
+        return CompactDialogState(new_tree, 0)
+
+    def copy(self) -> "CompactDialogState":
+        state_copy = self.compacted()
+        state_copy.revision = self.revision
+        return state_copy
+
+    def to_state(self) -> DialogState:
+        """
+        Expand this state and its subdialogs into regular DialogState objects.
+        """
+        tree = self.tree
+        root = _expand_node(tree, self.node)
+        pending = [(self.node, root)]
+        while pending:
+            node, state = pending.pop()
+            for child in tree.children.get(node, ()):
+                child_state = _expand_node(tree, child)
+                state.subdialogs.append(child_state)
+                pending.append((child, child_state))
+
+        return root
+
+    def _set_flag(self, flag: int, value: bool) -> None:
+        if value:
+            self.tree.flags[self.node] |= flag
+        else:
+            self.tree.flags[self.node] &= ~flag
+
+
+def new_compact_state(dialog: BaseDialog[T]) -> CompactDialogState[T]:
+    tree = CompactStateTree()
+    return CompactDialogState(tree, tree.add_node(_NO_PARENT, dialog.name, dialog.version))
+
+
+def compact_state(state: DialogState) -> CompactDialogState:
+    """
+    Convert a tree of DialogState objects into a compact one.
+    """
+    tree = CompactStateTree()
+    pending = [(state, _NO_PARENT)]
+    while pending:
+        node_state, parent = pending.pop()
+        node = tree.add_node(parent, node_state.name, node_state.version)
+        flags = _SENT_TO_CLIENT if node_state.sent_to_client else 0
+        if node_state.handling_fallback:
+            flags |= _HANDLING_FALLBACK
+        if node_state.result is not None:
+            flags |= _DONE
+            tree.results[node] = node_state.result.return_value
+        tree.flags[node] = flags
+        pending.extend((subdialog, node) for subdialog in reversed(node_state.subdialogs))
+
+    return CompactDialogState(tree, 0)
+
+
+def _expand_node(tree: CompactStateTree, node: int) -> DialogState:
+    flags = tree.flags[node]
+    return DialogState(
+        version=dialog_symbols[tree.versions[node]],
+        name=dialog_symbols[tree.names[node]],
+        result=Result(tree.results[node]) if flags & _DONE else None,
+        sent_to_client=bool(flags & _SENT_TO_CLIENT),
+        handling_fallback=bool(flags & _HANDLING_FALLBACK),
+    )
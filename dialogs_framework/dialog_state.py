@@ -1,7 +1,12 @@
-from typing import List, TypeVar, Generic, Optional
+import json
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, TypeVar, Generic, Optional
 from dataclasses import dataclass, field
 
-from .types import BaseDialog, DialogStateException
+from .blobs import BlobStore
+from .types import BaseDialog, DialogStateException, checkpoint, is_checkpoint_name
+from .symbols import SymbolTable, dialog_symbols
 
 
 T = TypeVar("T")
@@ -12,6 +17,94 @@ class Result(Generic[T]):
     return_value: T
 
 
+class BlobResult(Result[T]):
+    """
+    A result whose return value is kept in a BlobStore, under the hash of its JSON,
+    and loaded on first access.
+
+    It is always encoded as its key, so saving a state again does not load it.
+    """
+
+    blob_store: Optional[BlobStore]
+    key: str
+
+    def __init__(self, blob_store: Optional[BlobStore], key: str):
+        object.__setattr__(self, "blob_store", blob_store)
+        object.__setattr__(self, "key", key)
+
+    @property  # type: ignore
+    def return_value(self) -> T:  # type: ignore
+        try:
+            return self.__dict__["_return_value"]
+        except KeyError:
+            pass
+
+        if self.blob_store is None:
+            raise DialogStateException("The state was loaded without its blob store")
+        return_value = json.loads(self.blob_store.get(self.key))
+        object.__setattr__(self, "_return_value", return_value)
+        return return_value
+
+    @property
+    def is_loaded(self) -> bool:
+        return "_return_value" in self.__dict__
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, Result):
+            return NotImplemented
+        if isinstance(other, BlobResult) and other.key == self.key:
+            return True
+        return self.return_value == other.return_value
+
+    __hash__ = None  # type: ignore
+
+    def __repr__(self) -> str:
+        return f"BlobResult(key={self.key!r})"
+
+
+class StateChanges:
+    """
+    Records the states that were created or updated during a turn, since
+    tracking started with tracking_changes.
+
+    A state is updated when it is done, sent to the client, reset, or when a
+    checkpoint folds its subdialogs. A created state is only listed in created,
+    even if it was updated after. Code that changes states in other ways should
+    call record_update.
+    """
+
+    def __init__(self) -> None:
+        self._created: Dict[int, "DialogState"] = {}
+        self._updated: Dict[int, "DialogState"] = {}
+
+    def __bool__(self) -> bool:
+        return bool(self._created or self._updated)
+
+    @property
+    def created(self) -> List["DialogState"]:
+        return list(self._created.values())
+
+    @property
+    def updated(self) -> List["DialogState"]:
+        return list(self._updated.values())
+
+    def record_created(self, state: "DialogState") -> None:
+        self._created[id(state)] = state
+
+    def record_updated(self, state: "DialogState") -> None:
+        if id(state) not in self._created:
+            self._updated[id(state)] = state
+
+
+_state_changes: ContextVar[Optional[StateChanges]] = ContextVar("state_changes", default=None)
+
+
+def record_update(state: "DialogState") -> None:
+    changes = _state_changes.get()
+    if changes is not None:
+        changes.record_updated(state)
+
+
 @dataclass
 class DialogState(Generic[T]):
     """
@@ -29,13 +122,49 @@ class DialogState(Generic[T]):
     sent_to_client: bool = False
     handling_fallback: bool = False
 
+    # The revision of the conversation that this root state was loaded at, set
+    # by persistence providers that check revisions when saving
+    revision = 0
+
+    def __post_init__(self) -> None:
+        # Share a single copy of each name and version between all the states
+        self.version = dialog_symbols.canonical(self.version)
+        self.name = dialog_symbols.canonical(self.name)
+
     def get_subdialog_state(self, subdialog_index: int, subdialog: BaseDialog[T]) -> "DialogState":
         if len(self.subdialogs) == subdialog_index:
-            self.subdialogs.append(new_empty_state(subdialog))
+            new_state = new_empty_state(subdialog)
+            changes = _state_changes.get()
+            if changes is not None:
+                changes.record_created(new_state)
+            self.subdialogs.append(new_state)
 
         subdialog_state = self.subdialogs[subdialog_index]
         return subdialog_state
 
+    def skips_to_checkpoint(self, subdialog_index: int, subdialog: BaseDialog) -> bool:
+        """
+        Whether subdialog was folded into a checkpoint, and should be skipped on replay.
+        Every step is skipped until the checkpoint that folded them.
+        """
+        if subdialog_index != 0 or not self.subdialogs:
+            return False
+
+        folded = self.subdialogs[0].name
+        return is_checkpoint_name(folded) and not (
+            isinstance(subdialog, checkpoint) and subdialog.name == folded
+        )
+
+    def fold_checkpoint(self) -> None:
+        """
+        Fold the states of all the steps before the last one, which is a done checkpoint.
+        """
+        if not self.subdialogs or not self.subdialogs[-1].is_done:
+            raise DialogStateException("Checkpoint not done yet")
+
+        self.subdialogs = self.subdialogs[-1:]
+        record_update(self)
+
     @property
     def return_value(self) -> T:
         if not self.result:
@@ -49,6 +178,7 @@ class DialogState(Generic[T]):
             raise DialogStateException("Dialog is done, cannot set return value")
 
         self.result = Result(value)
+        record_update(self)
 
     @property
     def is_done(self) -> bool:
@@ -56,24 +186,254 @@ class DialogState(Generic[T]):
 
     def reset(self, dialog: BaseDialog, fallback_mode: bool) -> None:
         self.subdialogs = []
-        self.version = dialog.version
-        self.name = dialog.name
+        self.version = dialog_symbols.canonical(dialog.version)
+        self.name = dialog_symbols.canonical(dialog.name)
         self.result = None
         self.sent_to_client = False
         self.handling_fallback = fallback_mode
+        record_update(self)
+
+    def copy(self) -> "DialogState[T]":
+        """
+        Copy this state and its subdialogs, so a turn can run on the copy and leave
+        this one as it was. The results are shared, since they are never changed in
+        place, and so are the subdialogs of lazy states that were not built.
+        """
+        root = self._copy_node()
+        root.revision = self.revision
+        pending = [(self, root)]
+        while pending:
+            node, node_copy = pending.pop()
+            if isinstance(node_copy, LazyDialogState) and not node_copy.is_loaded:
+                continue
+
+            for subdialog in node.subdialogs:
+                subdialog_copy = subdialog._copy_node()
+                node_copy.subdialogs.append(subdialog_copy)
+                pending.append((subdialog, subdialog_copy))
+
+        return root
+
+    def _copy_node(self) -> "DialogState":
+        return DialogState(
+            version=self.version,
+            name=self.name,
+            result=self.result,
+            sent_to_client=self.sent_to_client,
+            handling_fallback=self.handling_fallback,
+        )
 
 
 def new_empty_state(dialog: BaseDialog[T]) -> DialogState[T]:
     return DialogState(version=dialog.version, name=dialog.name)
 
 
-def state_from_dict(raw_state: dict) -> DialogState:
+@contextmanager
+def tracking_changes(state: DialogState) -> Iterator[Optional[StateChanges]]:
+    """
+    Record the states that are created or updated in the current context, for the
+    turn that runs on state in the with block. Yields None if the state does not
+    support tracking, as for compact states.
+
+    The tracking of the context is restored when the block exits, even if the turn
+    raised before its state was saved.
+    """
+    changes = StateChanges() if isinstance(state, DialogState) else None
+    token = _state_changes.set(changes)
+    try:
+        yield changes
+    finally:
+        _state_changes.reset(token)
+
+
+def stop_tracking_changes() -> None:
+    _state_changes.set(None)
+
+
+def state_from_dict(raw_state: dict, blob_store: Optional[BlobStore] = None) -> DialogState:
+    """
+    Build a state from its dict form, or from the interned form made by intern_state_dict.
+
+    The results that were offloaded to blob_store are loaded from it on first access.
+    """
+    if "symbols" in raw_state:
+        return _state_from_dict(raw_state["state"], raw_state["symbols"], blob_store)
+
+    return _state_from_dict(raw_state, None, blob_store)
+
+
+def _state_from_dict(
+    raw_state: dict, symbols: Optional[List[str]], blob_store: Optional[BlobStore]
+) -> DialogState:
+    version, name = raw_state["version"], raw_state["name"]
+    if symbols is not None:
+        version, name = symbols[version], symbols[name]
+
     return DialogState(
-        version=raw_state["version"],
-        name=raw_state["name"],
-        result=None if raw_state["result"] is None else Result(raw_state["result"]["return_value"]),
+        version=version,
+        name=name,
+        result=_result_from_dict(raw_state["result"], blob_store),
         sent_to_client=raw_state["sent_to_client"],
+        handling_fallback=raw_state.get("handling_fallback", False),
         subdialogs=[
-            state_from_dict(raw_subdialog_state) for raw_subdialog_state in raw_state["subdialogs"]
+            _state_from_dict(raw_subdialog_state, symbols, blob_store)
+            for raw_subdialog_state in raw_state["subdialogs"]
         ],
     )
+
+
+def _result_from_dict(raw_result: Optional[dict], blob_store: Optional[BlobStore]):
+    if raw_result is None:
+        return None
+    if "blob" in raw_result:
+        return BlobResult(blob_store, raw_result["blob"])
+    return Result(raw_result["return_value"])
+
+
+def _result_to_dict(result: Optional[Result]) -> Optional[Dict[str, Any]]:
+    if result is None:
+        return None
+    if isinstance(result, BlobResult):
+        return {"blob": result.key}
+    return {"return_value": result.return_value}
+
+
+def state_to_dict(state: DialogState) -> dict:
+    """
+    Convert a state to the dict form read by state_from_dict, the same as
+    dataclasses.asdict would, without recursing and without building the
+    subdialogs of lazy states that were not loaded. Return values are not copied.
+    """
+    raw_state = _state_to_dict(state)
+    pending = [(state, raw_state)]
+    while pending:
+        node, raw_node = pending.pop()
+        if isinstance(node, LazyDialogState) and not node.is_loaded and node._symbols is None:
+            raw_node["subdialogs"] = node._raw_subdialogs
+            continue
+
+        for subdialog in node.subdialogs:
+            raw_subdialog = _state_to_dict(subdialog)
+            raw_node["subdialogs"].append(raw_subdialog)
+            pending.append((subdialog, raw_subdialog))
+
+    return raw_state
+
+
+def _state_to_dict(state: DialogState) -> dict:
+    return {
+        "version": state.version,
+        "name": state.name,
+        "subdialogs": [],
+        "result": _result_to_dict(state.result),
+        "sent_to_client": state.sent_to_client,
+        "handling_fallback": state.handling_fallback,
+    }
+
+
+class LazyDialogState(DialogState[T]):
+    """
+    A state loaded from its dict form that builds its subdialogs only when they
+    are accessed.
+
+    Replaying a dialog only checks the result of the steps that are done, so
+    their subdialogs are never accessed and stay in their dict form. Loading a
+    state then takes time proportional to the path to the steps that are still
+    running, instead of the whole conversation.
+    """
+
+    def __init__(
+        self,
+        raw_state: dict,
+        symbols: Optional[List[str]] = None,
+        blob_store: Optional[BlobStore] = None,
+    ):
+        version, name = raw_state["version"], raw_state["name"]
+        if symbols is not None:
+            version, name = symbols[version], symbols[name]
+
+        super().__init__(
+            version=version,
+            name=name,
+            result=_result_from_dict(raw_state["result"], blob_store),
+            sent_to_client=raw_state["sent_to_client"],
+            handling_fallback=raw_state.get("handling_fallback", False),
+        )
+        self._raw_subdialogs: Optional[List[dict]] = raw_state["subdialogs"]
+        self._symbols = symbols
+        self._blob_store = blob_store
+
+    @property  # type: ignore
+    def subdialogs(self) -> List[DialogState]:  # type: ignore
+        if self._raw_subdialogs is not None:
+            self._subdialogs: List[DialogState] = [
+                LazyDialogState(raw_subdialog_state, self._symbols, self._blob_store)
+                for raw_subdialog_state in self._raw_subdialogs
+            ]
+            self._raw_subdialogs = None
+
+        return self._subdialogs
+
+    @subdialogs.setter
+    def subdialogs(self, subdialogs: List[DialogState]) -> None:
+        self._subdialogs = subdialogs
+        self._raw_subdialogs = None
+
+    @property
+    def is_loaded(self) -> bool:
+        """
+        Whether the subdialogs of this state were built.
+        """
+        return self._raw_subdialogs is None
+
+    def _copy_node(self) -> DialogState:
+        if self.is_loaded:
+            return super()._copy_node()
+
+        node_copy = LazyDialogState.__new__(LazyDialogState)
+        DialogState.__init__(
+            node_copy,
+            version=self.version,
+            name=self.name,
+            result=self.result,
+            sent_to_client=self.sent_to_client,
+            handling_fallback=self.handling_fallback,
+        )
+        node_copy._raw_subdialogs = self._raw_subdialogs
+        node_copy._symbols = self._symbols
+        node_copy._blob_store = self._blob_store
+        return node_copy
+
+
+def lazy_state_from_dict(
+    raw_state: dict, blob_store: Optional[BlobStore] = None
+) -> LazyDialogState:
+    """
+    Like state_from_dict, but builds the subdialogs of each state on first access.
+    """
+    if "symbols" in raw_state:
+        return LazyDialogState(raw_state["state"], raw_state["symbols"], blob_store)
+
+    return LazyDialogState(raw_state, None, blob_store)
+
+
+def intern_state_dict(raw_state: dict) -> dict:
+    """
+    Convert the dict form of a state, such as the one made by dataclasses.asdict, to a
+    smaller form where the names and versions of the states are ids into a table of
+    symbols that is stored once, alongside the states.
+    """
+    table = SymbolTable()
+    interned_state = _intern_state_dict(raw_state, table)
+    return {"symbols": table.symbols, "state": interned_state}
+
+
+def _intern_state_dict(raw_state: dict, table: SymbolTable) -> dict:
+    interned_state = dict(raw_state)
+    interned_state["version"] = table.intern(raw_state["version"])
+    interned_state["name"] = table.intern(raw_state["name"])
+    interned_state["subdialogs"] = [
+        _intern_state_dict(raw_subdialog_state, table)
+        for raw_subdialog_state in raw_state["subdialogs"]
+    ]
+    return interned_state
@@ -1,3 +1,5 @@
+import copy
+import sys
 from functools import partial
 from typing import cast, Union, Optional, overload
 from contextvars import ContextVar
@@ -7,16 +9,29 @@ from dialogs_framework.fallback_dialog import run_fallback_dialog
 from .types import (
     Dialog,
     SendToClientException,
+    StaleStateException,
     get_client_response,
     send_message,
     DialogStepDone,
     DialogStepNotDone,
     SendMessageFunction,
     VersionMismatchException,
+    checkpoint,
+    checkpoint_renamed,
 )
-from .generic_types import ClientResponse, ServerMessage, T, DialogContext, build_dialog_context
-from .persistence.persistence import PersistenceProvider
+from .generic_types import (
+    ClientResponse,
+    ServerMessage,
+    T,
+    DialogContext,
+    build_dialog_context,
+    check_checkpoint_site,
+)
+from .persistence.persistence import PersistenceProvider, save_turn
 from .message_queue import MessageQueue
+from .dialog_state import DialogState, record_update, tracking_changes
+from .step_registry import StepRegistry
+from . import metrics, tracing
 
 
 """
@@ -27,19 +42,31 @@ It contains the context required by run() to call a subdialog.
 """
 dialog_context: ContextVar[DialogContext] = ContextVar("dialog_context")
 
-_InputDialogType = Union[get_client_response[T], Dialog[T]]
+"""
+The handlers of the steps that run() supports. Custom primitives can be registered here,
+and are then supported by the generator engines as well.
+"""
+step_handlers = StepRegistry()
+
+_InputDialogType = Union[get_client_response[T], Dialog[T], checkpoint[T]]
 InputDialogType = Union[_InputDialogType, send_message[ServerMessage]]
 
 
+@metrics.measure_turns("run_dialog")
 def run_dialog(
     dialog: InputDialogType,
     persistence: PersistenceProvider,
     client_response: ClientResponse,
     fallback_dialog: Optional[InputDialogType] = None,
+    stale_retries: int = 3,
 ) -> Union[DialogStepDone[T, ServerMessage], DialogStepNotDone[ServerMessage]]:
     """
     This is the interface for calling a dialog from an external location.
 
+    If saving the state raises StaleStateException, because another turn of the
+    conversation was saved since it was loaded, the turn is run again on the new
+    state, up to stale_retries times.
+
     The returned DialogStep object indicates:
     1. Whether the dialog is done
     2. If it's done, what the return value is
@@ -50,27 +77,39 @@ def run_dialog(
 
     state = persistence.get_state(dialog)
     if state.handling_fallback and fallback_dialog is not None:
-        return _run_fallback_dialog(client_response, dialog, persistence, fallback_dialog, state)
-
-    dialog_context.set(build_dialog_context(send, client_response, state))
-
-    is_done = False
-    try:
-        return_value = run(dialog)
-        is_done = True
-    except VersionMismatchException:
-        state.reset(dialog, fallback_mode=True)
-        return _run_fallback_dialog(client_response, dialog, persistence, fallback_dialog, state)
-
-    except SendToClientException:
-        pass
-
-    messages = queue.dequeue_all()
-    persistence.save_state(state)
-    if is_done:
-        return DialogStepDone(return_value=cast(T, return_value), messages=messages)
-    else:
-        return DialogStepNotDone(messages=messages)
+        return _run_fallback_dialog(client_response, dialog, persistence, fallback_dialog)
+
+    with tracking_changes(state) as changes:
+        dialog_context.set(build_dialog_context(send, client_response, state))
+
+        is_done = False
+        try:
+            return_value = run(dialog)
+            is_done = True
+        except VersionMismatchException:
+            metrics.version_mismatch(dialog)
+            state.reset(dialog, fallback_mode=True)
+            # providers that load a new copy on every get_state would replay the old state
+            save_turn(persistence, state, None)
+            return _run_fallback_dialog(client_response, dialog, persistence, fallback_dialog)
+
+        except SendToClientException:
+            pass
+
+        try:
+            save_turn(persistence, state, changes)
+        except StaleStateException:
+            if stale_retries == 0:
+                raise
+            return run_dialog(
+                dialog, persistence, client_response, fallback_dialog, stale_retries - 1
+            )
+
+        messages = queue.dequeue_all()
+        if is_done:
+            return DialogStepDone(return_value=cast(T, return_value), messages=messages)
+        else:
+            return DialogStepNotDone(messages=messages)
 
 
 _run_fallback_dialog = partial(run_fallback_dialog, run_dialog)
@@ -109,36 +148,83 @@ def run(subdialog: InputDialogType) -> Optional[T]:
     """
     context: DialogContext = dialog_context.get()
     state = context.state
-    client_response = context.client_response
-    send = context.send
     call_counter = context.call_counter
 
-    subdialog_state = state.get_subdialog_state(next(call_counter), subdialog)
+    if state.skips_to_checkpoint(call_counter.value, subdialog):
+        return None
+
+    call_index = next(call_counter)
+    subdialog_state = state.get_subdialog_state(call_index, subdialog)
 
-    if subdialog.version != subdialog_state.version:
+    if subdialog.version != subdialog_state.version or checkpoint_renamed(
+        subdialog, subdialog_state.name
+    ):
         raise VersionMismatchException
 
+    if isinstance(subdialog, checkpoint):
+        if not subdialog.label:
+            call_counter.checkpoint_site = check_checkpoint_site(
+                call_counter.checkpoint_site, sys._getframe(1)
+            )
+        if subdialog_state.is_done:
+            # a copy, so the dialog cannot change the value the next turn replays
+            return copy.deepcopy(subdialog_state.return_value)
+        subdialog_state.return_value = copy.deepcopy(subdialog.value)
+        state.fold_checkpoint()
+        call_counter.value = len(state.subdialogs)
+        return subdialog.value
+
+    tracer = tracing.active_tracer
     if subdialog_state.is_done:
+        if tracer is not None:
+            tracing.step_replayed(tracer, subdialog, call_index, context.depth)
         return subdialog_state.return_value
 
-    return_value: Optional[T]
-    if isinstance(subdialog, get_client_response):
-        if not subdialog_state.sent_to_client:
-            subdialog_state.sent_to_client = True
-            raise SendToClientException
-        else:
-            return_value = cast(T, client_response)
-    elif isinstance(subdialog, send_message):
-        send(subdialog.message)
-        return_value = None
-    elif isinstance(subdialog, Dialog):
-        # This token is used to return to the parent context after
-        # the subdialog has finished its execution.
-        token = dialog_context.set(build_dialog_context(send, client_response, subdialog_state))
-        return_value = subdialog.dialog()  # type: ignore
-        dialog_context.reset(token)
-    else:
+    handler, is_async = step_handlers.lookup(type(subdialog))
+    if is_async:
         raise Exception("Unsupported dialog type")
 
+    if tracer is None:
+        return_value = handler(subdialog, subdialog_state, context)
+    else:
+        event = tracing.step_entered(tracer, subdialog, call_index, context.depth)
+        try:
+            return_value = handler(subdialog, subdialog_state, context)
+        except BaseException as e:
+            tracing.step_exited(tracer, event, e)
+            raise
+        tracing.step_exited(tracer, event)
+
     subdialog_state.return_value = return_value
     return return_value
+
+
+@step_handlers.register(get_client_response)
+def _run_get_client_response(
+    step: get_client_response[T], step_state: DialogState, context: DialogContext
+) -> T:
+    if not step_state.sent_to_client:
+        step_state.sent_to_client = True
+        record_update(step_state)
+        raise SendToClientException
+
+    return cast(T, context.client_response)
+
+
+@step_handlers.register(send_message)
+def _run_send_message(
+    step: send_message[ServerMessage], step_state: DialogState, context: DialogContext
+) -> None:
+    context.send(step.message)
+
+
+@step_handlers.register(Dialog)
+def _run_dialog_step(step: Dialog[T], step_state: DialogState, context: DialogContext) -> T:
+    # This token is used to return to the parent context after
+    # the subdialog has finished its execution.
+    token = dialog_context.set(
+        build_dialog_context(context.send, context.client_response, step_state, context.depth + 1)
+    )
+    return_value = step.dialog()  # type: ignore
+    dialog_context.reset(token)
+    return return_value
@@ -0,0 +1,251 @@
+import asyncio
+import contextvars
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import partial
+from threading import Lock
+from typing import Callable, Dict, Hashable, Optional, TypeVar
+from weakref import WeakKeyDictionary
+
+from .dialogs import run_dialog, InputDialogType
+from .gen_dialogs import run_gen_dialog, GenInputDialogType
+from .generic_types import ClientResponse, RunDialogReturnType
+from .persistence.persistence import PersistenceProvider
+from .session_cache import SessionCache
+
+R = TypeVar("R")
+
+DEFAULT_MAX_WORKERS = 16
+
+
+@dataclass
+class ExecutorStats:
+    queued: int = 0
+    running: int = 0
+    completed: int = 0
+    max_queued: int = 0
+
+
+class _ConversationLock:
+    def __init__(self) -> None:
+        self.lock = asyncio.Lock()
+        # the calls that hold or wait for the lock, so it is dropped when none do
+        self.users = 0
+
+
+_Conversations = Dict[Hashable, _ConversationLock]
+
+
+class DialogExecutor:
+    """
+    A bounded thread pool for running the sync engines from async code, without
+    blocking the event loop for the whole turn.
+
+    Each call runs in a copy of the caller's context, so context variables set by
+    the caller are visible to the turn, while the dialog_context set by the engine
+    does not leak back into the caller or into other turns run by the same thread.
+
+    At most max_in_flight calls of an event loop are submitted to the pool at the
+    same time, the others wait on the loop. stats() returns the number of calls
+    that are waiting for a thread, the number that are running, and the highest
+    number ever waiting.
+
+    The calls made with run_in_conversation run one at a time for each
+    conversation, in the order they were made, since they change the same state.
+    """
+
+    def __init__(
+        self,
+        max_workers: int = DEFAULT_MAX_WORKERS,
+        max_in_flight: Optional[int] = None,
+        thread_name_prefix: str = "dialogs",
+    ):
+        if max_in_flight is not None and max_in_flight < 1:
+            raise ValueError("max_in_flight must be at least 1")
+
+        self.max_in_flight = max_in_flight
+        self._pool = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix=thread_name_prefix
+        )
+        self._semaphores: "WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]" = (
+            WeakKeyDictionary()
+        )
+        self._conversations: "WeakKeyDictionary[asyncio.AbstractEventLoop, _Conversations]" = (
+            WeakKeyDictionary()
+        )
+        self._lock = Lock()
+        self._stats = ExecutorStats()
+
+    async def run(self, function: Callable[..., R], *args, **kwargs) -> R:
+        """
+        Call a function in the pool, and await its return value.
+        """
+        function = partial(function, *args, **kwargs)
+        semaphore = (
+            None if self.max_in_flight is None else self._semaphore(asyncio.get_running_loop())
+        )
+        self._enqueue()
+        if semaphore is not None:
+            try:
+                await semaphore.acquire()
+            except BaseException:
+                # cancelled before it was submitted to the pool
+                self._dequeue()
+                raise
+
+        try:
+            return await asyncio.wrap_future(self._submit(function))
+        finally:
+            if semaphore is not None:
+                semaphore.release()
+
+    def submit(self, function: Callable[..., R], *args, **kwargs) -> "Future[R]":
+        """
+        Call a function in the pool from sync code, and return the future of its return
+        value. The call runs in a copy of the caller's context, as with run, but does not
+        count towards max_in_flight, which is per event loop.
+        """
+        self._enqueue()
+        return self._submit(partial(function, *args, **kwargs))
+
+    async def run_in_conversation(
+        self, conversation_id: Hashable, function: Callable[..., R], *args, **kwargs
+    ) -> R:
+        """
+        Like run, after the calls of the same conversation that were made before it.
+        """
+        loop = asyncio.get_running_loop()
+        conversations = self._conversations.get(loop)
+        if conversations is None:
+            conversations = self._conversations[loop] = {}
+
+        conversation = conversations.get(conversation_id)
+        if conversation is None:
+            conversation = conversations[conversation_id] = _ConversationLock()
+
+        conversation.users += 1
+        try:
+            async with conversation.lock:
+                return await self.run(function, *args, **kwargs)
+        finally:
+            conversation.users -= 1
+            if conversation.users == 0:
+                del conversations[conversation_id]
+
+    def stats(self) -> ExecutorStats:
+        with self._lock:
+            return ExecutorStats(**vars(self._stats))
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._pool.shutdown(wait=wait)
+
+    def _enqueue(self) -> None:
+        with self._lock:
+            self._stats.queued += 1
+            self._stats.max_queued = max(self._stats.max_queued, self._stats.queued)
+
+    def _dequeue(self) -> None:
+        with self._lock:
+            self._stats.queued -= 1
+
+    def _submit(self, function: Callable[[], R]) -> "Future[R]":
+        """
+        Submit an enqueued call to the pool, in a copy of the caller's context.
+        """
+
+        def call() -> R:
+            # the pool only calls it once the future is running, so it cannot be cancelled
+            with self._lock:
+                self._stats.queued -= 1
+                self._stats.running += 1
+            try:
+                return function()
+            finally:
+                with self._lock:
+                    self._stats.running -= 1
+                    self._stats.completed += 1
+
+        future = self._pool.submit(contextvars.copy_context().run, call)
+        future.add_done_callback(self._dequeue_cancelled)
+        return future
+
+    def _dequeue_cancelled(self, future: Future) -> None:
+        # a future can only be cancelled before a thread calls it, so it is dequeued once
+        if future.cancelled():
+            self._dequeue()
+
+    def _semaphore(self, loop: asyncio.AbstractEventLoop) -> asyncio.Semaphore:
+        semaphore = self._semaphores.get(loop)
+        if semaphore is None:
+            assert self.max_in_flight is not None
+            semaphore = self._semaphores[loop] = asyncio.Semaphore(self.max_in_flight)
+        return semaphore
+
+
+_default_executor: Optional[DialogExecutor] = None
+_default_executor_lock = Lock()
+
+
+def default_dialog_executor() -> DialogExecutor:
+    """
+    The executor of the calls that are not given one, created on first use.
+    """
+    global _default_executor
+    with _default_executor_lock:
+        if _default_executor is None:
+            _default_executor = DialogExecutor()
+        return _default_executor
+
+
+async def run_dialog_in_executor(
+    dialog: InputDialogType,
+    persistence: PersistenceProvider,
+    client_response: ClientResponse,
+    fallback_dialog: Optional[InputDialogType] = None,
+    stale_retries: int = 3,
+    executor: Optional[DialogExecutor] = None,
+    conversation_id: Optional[Hashable] = None,
+) -> RunDialogReturnType:
+    """
+    Run a turn with run_dialog in a DialogExecutor, for servers that use asyncio.
+
+    Turns given the same conversation_id run one at a time, in the order they were
+    called, instead of changing the state of the conversation from two threads.
+    """
+    executor = executor or default_dialog_executor()
+    args = (run_dialog, dialog, persistence, client_response, fallback_dialog, stale_retries)
+    if conversation_id is None:
+        return await executor.run(*args)
+    return await executor.run_in_conversation(conversation_id, *args)
+
+
+async def run_gen_dialog_in_executor(
+    dialog: GenInputDialogType,
+    persistence: PersistenceProvider,
+    client_response: ClientResponse,
+    fallback_dialog: Optional[GenInputDialogType] = None,
+    session_cache: Optional[SessionCache] = None,
+    conversation_id: Optional[Hashable] = None,
+    stale_retries: int = 3,
+    executor: Optional[DialogExecutor] = None,
+) -> RunDialogReturnType:
+    """
+    Run a turn with run_gen_dialog in a DialogExecutor, for servers that use asyncio.
+
+    Turns given the same conversation_id run one at a time, in the order they were
+    called, instead of changing the state of the conversation from two threads.
+    """
+    executor = executor or default_dialog_executor()
+    args = (
+        run_gen_dialog,
+        dialog,
+        persistence,
+        client_response,
+        fallback_dialog,
+        session_cache,
+        conversation_id,
+        stale_retries,
+    )
+    if conversation_id is None:
+        return await executor.run(*args)
+    return await executor.run_in_conversation(conversation_id, *args)
@@ -1,20 +1,22 @@
-from .dialog_state import DialogState
+from . import metrics
+from .persistence.persistence import save_turn
 from .generic_types import RunDialogReturnType, ServerResponse
 
 
-def run_fallback_dialog(
-    run_dialog_func, client_response, dialog, persistence, fallback_dialog, state: DialogState
-):
+def run_fallback_dialog(run_dialog_func, client_response, dialog, persistence, fallback_dialog):
     messages: ServerResponse = []
     if fallback_dialog is not None:
+        metrics.fallback_turn(dialog)
         next_step: RunDialogReturnType = run_dialog_func(
             fallback_dialog, persistence, client_response
         )
         if not next_step.is_done:
             return next_step
         messages = next_step.messages
-        # Fallback dialog completed
+        # Fallback dialog completed, the turn of the fallback saved its own copy of the state
+        state = persistence.get_state(dialog)
         state.reset(dialog, fallback_mode=False)
+        save_turn(persistence, state, None)
 
     next_step = run_dialog_func(dialog, persistence, client_response, fallback_dialog)
     next_step.messages = messages + next_step.messages
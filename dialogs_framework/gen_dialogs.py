@@ -1,7 +1,8 @@
-from typing import Optional, Union, cast, overload
+import copy
+from typing import Generator, Hashable, List, Optional, Union, cast
 from functools import partial
 
-from dialogs_framework.dialog_state import DialogState
+from dialogs_framework.dialog_state import DialogState, tracking_changes
 
 from .types import (
     BaseDialog,
@@ -13,130 +14,245 @@ from .types import (
     DialogStepNotDone,
     SendMessageFunction,
     SendToClientException,
+    StaleStateException,
     Dialog,
     VersionMismatchException,
+    checkpoint,
+    checkpoint_renamed,
 )
 from .message_queue import MessageQueue
-from .persistence.persistence import PersistenceProvider
+from .persistence.persistence import PersistenceProvider, save_turn
 from .fallback_dialog import run_fallback_dialog
+from .session_cache import SessionCache
 
-from .generic_types import T, ClientResponse, DialogContext, build_dialog_context
+from .generic_types import T, ClientResponse, DialogFrame, TurnContext, check_checkpoint_site
+from .dialogs import step_handlers
+from .step_registry import StepRegistry
+from . import metrics, tracing
 
-
-_GenInputDialogType = Union[get_client_response[T], Dialog[T], GenDialog[T]]
+_GenInputDialogType = Union[get_client_response[T], Dialog[T], GenDialog[T], checkpoint[T]]
 GenInputDialogType = Union[_GenInputDialogType, send_message[ServerMessage]]
 
 
+@metrics.measure_turns("run_gen_dialog")
 def run_gen_dialog(
     dialog: GenInputDialogType,
     persistence: PersistenceProvider,
     client_response: ClientResponse,
     fallback_dialog: Optional[GenInputDialogType] = None,
+    session_cache: Optional[SessionCache] = None,
+    conversation_id: Optional[Hashable] = None,
+    stale_retries: int = 3,
 ) -> Union[DialogStepDone[T, ServerMessage], DialogStepNotDone[ServerMessage]]:
     """
     This is the interface for calling a generator based dialog from an external location.
     if the dialog or one of its subdialogs uses asyncio use run_async_gen_dialog instead.
 
+    If a session_cache is given, the suspended generators of the conversation are kept
+    alive between turns, and resumed instead of replayed whenever possible.
+
+    If saving the state raises StaleStateException, because another turn of the
+    conversation was saved since it was loaded, the turn is run again on the new
+    state, up to stale_retries times.
+
     The returned DialogStep object indicates:
     1. Whether the dialog is done
     2. If it's done, what the return value is
     3. If it's not done, what the next server messages are
     """
+    if session_cache is not None and conversation_id is None:
+        raise ValueError("conversation_id is required when using a session_cache")
+
     queue = MessageQueue[ServerMessage]()
     send: SendMessageFunction = queue.enqueue
 
     state = persistence.get_state(dialog)
     if state.handling_fallback and fallback_dialog is not None:
-        return _run_fallback_dialog(client_response, dialog, persistence, fallback_dialog, state)
+        return _run_fallback_dialog(client_response, dialog, persistence, fallback_dialog)
 
-    is_done = False
-    try:
-        return_value = _run_base_dialog(dialog, build_dialog_context(send, client_response, state))
-        is_done = True
-    except VersionMismatchException:
-        state.reset(dialog, fallback_mode=True)
-        return _run_fallback_dialog(client_response, dialog, persistence, fallback_dialog, state)
+    with tracking_changes(state) as changes:
+        stack: List[DialogFrame] = []
+        if session_cache is not None:
+            stack = session_cache.resume(conversation_id, dialog, state) or stack
 
-    except SendToClientException:
-        pass
+        is_done = False
+        try:
+            turn = TurnContext(send, client_response, stack)
+            if stack:
+                return_value = _resume_gen_dialog(turn)
+            else:
+                stack.append(DialogFrame(root_dialog(dialog), state))
+                return_value = drive_gen_dialog(turn, None)
+            is_done = True
+        except VersionMismatchException:
+            metrics.version_mismatch(dialog)
+            state.reset(dialog, fallback_mode=True)
+            # providers that load a new copy on every get_state would replay the old state
+            save_turn(persistence, state, None)
+            return _run_fallback_dialog(client_response, dialog, persistence, fallback_dialog)
 
-    messages = queue.dequeue_all()
-    persistence.save_state(state)
-    if is_done:
-        return DialogStepDone(return_value=cast(T, return_value), messages=messages)
-    else:
-        return DialogStepNotDone(messages=messages)
+        except SendToClientException:
+            if session_cache is not None:
+                session_cache.suspend(conversation_id, dialog, stack)
 
+        try:
+            save_turn(persistence, state, changes)
+        except StaleStateException:
+            if session_cache is not None:
+                session_cache.discard(conversation_id)
+            if stale_retries == 0:
+                raise
+            return run_gen_dialog(
+                dialog,
+                persistence,
+                client_response,
+                fallback_dialog,
+                session_cache,
+                conversation_id,
+                stale_retries - 1,
+            )
 
-_run_fallback_dialog = partial(run_fallback_dialog, run_gen_dialog)
+        messages = queue.dequeue_all()
+        if is_done:
+            return DialogStepDone(return_value=cast(T, return_value), messages=messages)
+        else:
+            return DialogStepNotDone(messages=messages)
 
 
-@overload
-def _run_base_dialog(subdialog: send_message[ServerMessage], context: DialogContext) -> None:
-    ...
+_run_fallback_dialog = partial(run_fallback_dialog, run_gen_dialog)
+
 
+def root_dialog(dialog: BaseDialog[T]) -> Generator[BaseDialog[T], T, T]:
+    """
+    The bottom frame of the stack, which runs the dialog as the single subdialog
+    of the persisted state.
+    """
+    return_value = yield dialog
+    return return_value
 
-@overload
-def _run_base_dialog(subdialog: _GenInputDialogType, context: DialogContext) -> T:
-    ...
 
+def enter_step(frame: DialogFrame, step: BaseDialog[T]) -> Optional[DialogState]:
+    """
+    Get the state of the next step of a frame, advancing its call index.
 
-def _run_base_dialog(
-    subdialog: GenInputDialogType,
-    context: DialogContext,
-) -> Optional[T]:
-    state = context.state
-    client_response = context.client_response
-    send = context.send
-    call_counter = context.call_counter
+    Returns None if the step was folded into a checkpoint and should be skipped.
+    A checkpoint step is done as soon as it is entered, and stores a copy of its value.
+    """
+    state = frame.state
+    if state.skips_to_checkpoint(frame.call_index, step):
+        return None
 
-    subdialog_state = state.get_subdialog_state(next(call_counter), subdialog)
+    step_state = state.get_subdialog_state(frame.call_index, step)
+    frame.call_index += 1
 
-    if subdialog.version != subdialog_state.version:
+    if step.version != step_state.version or checkpoint_renamed(step, step_state.name):
         raise VersionMismatchException
 
-    if subdialog_state.is_done:
-        return subdialog_state.return_value
+    if isinstance(step, checkpoint):
+        if not step.label:
+            instance = frame.instance
+            caller = instance.ag_frame if frame.is_async else instance.gi_frame
+            frame.checkpoint_site = check_checkpoint_site(frame.checkpoint_site, caller)
+        if not step_state.is_done:
+            step_state.return_value = copy.deepcopy(step.value)
+            state.fold_checkpoint()
+            frame.call_index = len(state.subdialogs)
 
-    return_value = run_gen_dialog_step(subdialog, subdialog_state, client_response, send)
-    subdialog_state.return_value = return_value
-    return return_value
+    return step_state
 
 
-def run_gen_dialog_step(
-    step: BaseDialog[T],
-    step_state: DialogState,
-    client_response: ClientResponse,
-    send: SendMessageFunction,
-):
-    return_value: Optional[T]
-    if isinstance(step, get_client_response):
-        if not step_state.sent_to_client:
-            step_state.sent_to_client = True
-            raise SendToClientException
-        else:
-            return_value = cast(T, client_response)
-    elif isinstance(step, send_message):
-        send(step.message)
-        return_value = None
-    elif isinstance(step, Dialog):
-        return_value = step.dialog()  # type: ignore
-    elif isinstance(step, GenDialog):
-        return_value = _run_gen_dialog(
-            step, build_dialog_context(send, client_response, step_state)
-        )
-    else:
-        raise Exception("Unsupported dialog type")
+def checkpoint_value(step_state: DialogState):
+    """
+    The value a checkpoint returns to its dialog: a copy of the stored value, so the
+    dialog can change it without changing the state the next turn replays.
+    """
+    return copy.deepcopy(step_state.return_value)
 
-    return return_value
 
+def drive_gen_dialog(turn: TurnContext, value_for_next_step):
+    """
+    Run the generator frames of the stack until its bottom frame returns.
 
-def _run_gen_dialog(dialog: GenDialog[T], context: DialogContext) -> T:
-    instance = dialog.dialog()  # type: ignore
+    Subdialogs are pushed on the stack rather than run recursively, so the depth of
+    a dialog costs neither python frames nor contexts. If a step raises, the stack
+    is left as it was, with every generator suspended at its current step.
+    """
+    stack = turn.stack
+    lookup = gen_step_handlers.lookup
+    tracer = tracing.active_tracer
+    # When tracing, the event of the step of each frame, aligned with the stack
+    events: List[Optional[tracing.StepEvent]] = [None] * len(stack) if tracer else []
     try:
-        value_for_next_step = None
         while True:
-            next_step = instance.send(value_for_next_step)
-            value_for_next_step = _run_base_dialog(next_step, context)
-    except StopIteration as ex:
-        return ex.value
+            frame = stack[-1]
+            try:
+                step = frame.instance.send(value_for_next_step)
+            except StopIteration as ex:
+                stack.pop()
+                if tracer is not None:
+                    exit_frame_step(tracer, events)
+                if not stack:
+                    return ex.value
+                frame.state.return_value = ex.value
+                value_for_next_step = ex.value
+                continue
+
+            call_index = frame.call_index
+            step_state = enter_step(frame, step)
+            if step_state is None:
+                value_for_next_step = None
+            elif isinstance(step, checkpoint):
+                value_for_next_step = checkpoint_value(step_state)
+            elif step_state.is_done:
+                if tracer is not None:
+                    tracing.step_replayed(tracer, step, call_index, len(stack) - 1)
+                value_for_next_step = step_state.return_value
+            else:
+                handler, is_async = lookup(type(step))
+                if is_async:
+                    raise Exception("Unsupported dialog type")
+
+                if tracer is not None:
+                    events.append(tracing.step_entered(tracer, step, call_index, len(stack) - 1))
+                value_for_next_step = handler(step, step_state, turn)
+                # unless the handler pushed a subdialog frame, the step is done
+                if stack[-1] is frame:
+                    step_state.return_value = value_for_next_step
+                    if tracer is not None:
+                        exit_frame_step(tracer, events)
+    except BaseException as e:
+        if tracer is not None:
+            tracing.steps_interrupted(tracer, events, e)
+        raise
+
+
+def exit_frame_step(tracer: tracing.Tracer, events: List[Optional[tracing.StepEvent]]) -> None:
+    event = events.pop()
+    if event is not None:
+        tracing.step_exited(tracer, event)
+
+
+def _resume_gen_dialog(turn: TurnContext):
+    """
+    Continue a session from a session cache, by sending the client response into the
+    innermost suspended generator.
+    """
+    pending_state = turn.stack[-1].state.subdialogs[-1]
+    pending_state.return_value = turn.client_response
+    return drive_gen_dialog(turn, turn.client_response)
+
+
+"""
+The handlers of the steps that run_gen_dialog supports, on top of the ones of run().
+"""
+gen_step_handlers = StepRegistry(parent=step_handlers)
+
+
+@gen_step_handlers.register(Dialog)
+def _run_dialog_step(step: Dialog[T], step_state: DialogState, turn: TurnContext) -> T:
+    return step.dialog()  # type: ignore
+
+
+@gen_step_handlers.register(GenDialog)
+def _enter_gen_dialog(step: GenDialog[T], step_state: DialogState, turn: TurnContext) -> None:
+    turn.stack.append(DialogFrame(step.dialog(), step_state))  # type: ignore
@@ -1,8 +1,8 @@
 from dataclasses import dataclass
-from itertools import count
 
-from typing import TypeVar, List, Union, Generic, Iterator
-from .types import DialogStepNotDone, DialogStepDone, SendMessageFunction
+from types import FrameType
+from typing import Any, Hashable, Optional, TypeVar, List, Union, Generic, Iterator
+from .types import DialogStateException, DialogStepNotDone, DialogStepDone, SendMessageFunction
 from .dialog_state import DialogState
 
 T = TypeVar("T")
@@ -12,17 +12,116 @@ ServerResponse = List[ServerMessage]
 RunDialogReturnType = Union[DialogStepDone[T, ServerMessage], DialogStepNotDone[ServerMessage]]
 
 
+class CallCounter(Iterator[int]):
+    """
+    Counts the subdialog calls of a dialog.
+
+    Unlike itertools.count, it can be rewound, which is needed once the
+    subdialog states before a checkpoint are folded. It also keeps the call site
+    of the unlabeled checkpoint of the dialog, see check_checkpoint_site.
+    """
+
+    __slots__ = ("value", "checkpoint_site")
+
+    def __init__(self, start: int = 0):
+        self.value = start
+        self.checkpoint_site: Optional[Hashable] = None
+
+    def __next__(self) -> int:
+        value = self.value
+        self.value += 1
+        return value
+
+
+class StepContext(Generic[ClientResponse, ServerMessage]):
+    """
+    The context step handlers are called with, in every engine.
+
+    send adds a message to the messages of the turn, and client_response is the
+    response of the client that started the turn. Each engine passes a subclass
+    with the state it needs to run the turn, so a handler that only uses send and
+    client_response can be registered on step_handlers and run by all of them.
+    """
+
+    __slots__ = ()
+
+    send: SendMessageFunction[ServerMessage]
+    client_response: ClientResponse
+
+
 @dataclass(frozen=True)
-class DialogContext(Generic[ClientResponse, ServerMessage]):
+class DialogContext(StepContext[ClientResponse, ServerMessage]):
     send: SendMessageFunction[ServerMessage]
     client_response: ClientResponse
     state: DialogState
-    call_counter: Iterator[int]
+    call_counter: CallCounter
+    # the number of dialogs above this one
+    depth: int = 0
 
 
 def build_dialog_context(
-    send: SendMessageFunction, client_response: ClientResponse, state: DialogState
+    send: SendMessageFunction, client_response: ClientResponse, state: DialogState, depth: int = 0
 ) -> DialogContext:
     return DialogContext(
-        send=send, client_response=client_response, state=state, call_counter=count()
+        send=send,
+        client_response=client_response,
+        state=state,
+        call_counter=CallCounter(),
+        depth=depth,
     )
+
+
+class DialogFrame:
+    """
+    A generator dialog on the stack of the generator engines.
+
+    The engines drive a stack of frames instead of recursing into subdialogs,
+    so a frame is kept as small as possible: the suspended generator, the state
+    of the dialog, and the index of its next subdialog call.
+    """
+
+    __slots__ = ("instance", "state", "call_index", "is_async", "checkpoint_site")
+
+    def __init__(self, instance: Any, state: DialogState, is_async: bool = False):
+        self.instance = instance
+        self.state = state
+        self.call_index = 0
+        self.is_async = is_async
+        # the call site of the unlabeled checkpoint of the dialog, see check_checkpoint_site
+        self.checkpoint_site: Optional[Hashable] = None
+
+
+def check_checkpoint_site(entered_site: Optional[Hashable], caller: FrameType) -> Hashable:
+    """
+    The call site of an unlabeled checkpoint called by the python frame caller,
+    given the call site of the unlabeled checkpoint the dialog entered before, if any.
+
+    Unlabeled checkpoints all have the same name, so replay cannot tell them apart,
+    and a dialog that called two of them would replay from the wrong one forever.
+    It must give them different labels instead.
+    """
+    site = (caller.f_code, caller.f_lasti)
+    if entered_site is not None and entered_site != site:
+        raise DialogStateException(
+            "A dialog with several checkpoints must give each a different label"
+        )
+    return site
+
+
+class TurnContext(StepContext):
+    """
+    The context of a turn of the generator engines, given to step handlers.
+    The frame of the running dialog is the top of the stack.
+    """
+
+    __slots__ = ("send", "client_response", "stack")
+
+    def __init__(
+        self,
+        send: SendMessageFunction,
+        client_response: ClientResponse,
+        stack: List[DialogFrame],
+    ):
+        self.send = send
+        self.client_response = client_response
+        self.stack = stack
@@ -1,8 +1,17 @@
+from contextvars import ContextVar
 from dataclasses import dataclass, field
-from typing import List, Generic, TypeVar
+from typing import Callable, List, Generic, Optional, TypeVar
 
 ServerMessage = TypeVar("ServerMessage")
 
+"""
+A function that is called with each message as soon as it is enqueued, by the
+queues created in the current context. Used to stream the messages of a turn.
+"""
+message_listener: ContextVar[Optional[Callable[[object], None]]] = ContextVar(
+    "message_listener", default=None
+)
+
 
 @dataclass
 class MessageQueue(Generic[ServerMessage]):
@@ -14,12 +23,17 @@ class MessageQueue(Generic[ServerMessage]):
     """
 
     _queue: List[ServerMessage] = field(default_factory=list)
+    _listener: Optional[Callable[[ServerMessage], None]] = field(
+        default_factory=message_listener.get
+    )
 
     def enqueue(self, message: ServerMessage) -> None:
         """
         Add a message to the queue.
         """
         self._queue.append(message)
+        if self._listener is not None:
+            self._listener(message)
 
     def dequeue_all(self) -> List[ServerMessage]:
         """
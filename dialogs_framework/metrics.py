@@ -0,0 +1,408 @@
+import asyncio
+import functools
+import math
+import threading
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from contextvars import ContextVar
+from random import random
+from time import perf_counter
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, TypeVar, cast
+from weakref import ref
+
+from . import tracing
+from .dialog_state import DialogState, state_to_dict
+from .types import BaseDialog
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+_Key = Tuple[str, Tuple[str, ...]]
+
+DEFAULT_LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+DEFAULT_NODE_BUCKETS = (1, 10, 100, 1000, 10000, 100000)
+DEFAULT_BYTE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+class MetricsRegistry:
+    """
+    A registry of counters and histograms, rendered in the Prometheus text format.
+
+    Each thread records into a shard of its own, without taking a lock, and the
+    shards are merged when the metrics are collected. The shards of threads that
+    ended are folded together on collection, so short lived threads do not add up.
+    """
+
+    def __init__(self) -> None:
+        self._metrics: Dict[str, "_Metric"] = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards: List[Tuple["ref[threading.Thread]", Dict[_Key, Any]]] = []
+        self._retired: Dict[_Key, Any] = {}
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> "Counter":
+        return cast(Counter, self._register(Counter(self, name, help, tuple(labels))))
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS,
+    ) -> "Histogram":
+        return cast(Histogram, self._register(Histogram(self, name, help, tuple(labels), buckets)))
+
+    def collect(self) -> Dict[str, Dict[Tuple[str, ...], Any]]:
+        """
+        The merged values of the metrics by name and label values. The value of a
+        counter is a number, and the value of a histogram is a list of the counts
+        of its buckets, not cumulative, followed by the sum of the observations.
+        """
+        merged: Dict[_Key, Any] = {}
+        with self._lock:
+            alive = []
+            for thread_ref, shard in self._shards:
+                thread = thread_ref()
+                if thread is None or not thread.is_alive():
+                    _merge(self._retired, shard)
+                else:
+                    alive.append((thread_ref, shard))
+                    _merge(merged, shard)
+            self._shards = alive
+            _merge(merged, self._retired)
+
+        collected: Dict[str, Dict[Tuple[str, ...], Any]] = {name: {} for name in self._metrics}
+        for (name, labels), value in merged.items():
+            collected[name][labels] = value
+        return collected
+
+    def render(self) -> str:
+        """
+        The metrics in the Prometheus text exposition format, for a /metrics route.
+        """
+        collected = self.collect()
+        lines: List[str] = []
+        for name, metric in self._metrics.items():
+            lines.append(f"# HELP {name} {_escape_help(metric.help)}")
+            lines.append(f"# TYPE {name} {metric.type}")
+            for labels, value in sorted(collected[name].items()):
+                lines.extend(metric.render(labels, value))
+        return "\n".join(lines) + "\n"
+
+    def _register(self, metric: "_Metric") -> "_Metric":
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def _shard(self) -> Dict[_Key, Any]:
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard: Dict[_Key, Any] = {}
+            with self._lock:
+                self._shards.append((ref(threading.current_thread()), shard))
+            self._local.shard = shard
+            return shard
+
+
+def _merge(target: Dict[_Key, Any], shard: Dict[_Key, Any]) -> None:
+    # copying the items is atomic, while the thread of the shard may be adding to it
+    for key, value in list(shard.items()):
+        if isinstance(value, list):
+            value = list(value)
+            current = target.get(key)
+            if current is not None:
+                value = [a + b for a, b in zip(current, value)]
+        else:
+            value += target.get(key, 0)
+        target[key] = value
+
+
+class _Metric(ABC):
+    type = ""
+
+    def __init__(self, registry: MetricsRegistry, name: str, help: str, labels: Tuple[str, ...]):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labels = labels
+
+    @abstractmethod
+    def render(self, labels: Tuple[str, ...], value: Any) -> List[str]:
+        """
+        The lines of the Prometheus text format of the value of one set of labels.
+        """
+
+    def _check(self, label_values: Tuple[str, ...]) -> None:
+        if len(label_values) != len(self.labels):
+            raise ValueError(f"{self.name} takes the labels {self.labels}")
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, *label_values: str, amount: float = 1) -> None:
+        self._check(label_values)
+        shard = self.registry._shard()
+        key = (self.name, label_values)
+        shard[key] = shard.get(key, 0) + amount
+
+    def render(self, labels: Tuple[str, ...], value: Any) -> List[str]:
+        return [f"{self.name}{_labels(self.labels, labels)} {_number(value)}"]
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        registry: MetricsRegistry,
+        name: str,
+        help: str,
+        labels: Tuple[str, ...],
+        buckets: Sequence[float],
+    ):
+        super().__init__(registry, name, help, labels)
+        self.buckets = sorted(buckets)
+
+    def observe(self, value: float, *label_values: str) -> None:
+        self._check(label_values)
+        shard = self.registry._shard()
+        key = (self.name, label_values)
+        counts = shard.get(key)
+        if counts is None:
+            # one count per bucket, one for +Inf, and the sum
+            counts = shard[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def render(self, labels: Tuple[str, ...], value: Any) -> List[str]:
+        lines = []
+        cumulative = 0
+        bounds = [_number(bound) for bound in self.buckets] + ["+Inf"]
+        for bound, count in zip(bounds, value):
+            cumulative += count
+            bucket_labels = _labels(self.labels + ("le",), labels + (bound,))
+            lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+        lines.append(f"{self.name}_sum{_labels(self.labels, labels)} {_number(value[-1])}")
+        lines.append(f"{self.name}_count{_labels(self.labels, labels)} {cumulative}")
+        return lines
+
+
+def _labels(names: Tuple[str, ...], values: Tuple[str, ...]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape_label(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def _escape_label(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _escape_help(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n")
+
+
+def _number(value: float) -> str:
+    if isinstance(value, int):
+        return str(value)
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+class DialogMetrics(tracing.Tracer):
+    """
+    The metrics of the engines:
+
+    dialogs_turn_seconds: the latency of the turns of run_dialog, run_gen_dialog
+    and run_async_gen_dialog by dialog, engine and outcome, which is done,
+    not_done or error.
+    dialogs_steps_total: the steps by name and mode, which is executed or
+    replayed from the saved state.
+    dialogs_version_mismatches_total and dialogs_fallback_turns_total: the turns
+    whose state did not match the version of the dialog, and the turns that ran
+    the fallback dialog.
+    dialogs_state_nodes and dialogs_state_bytes: the size of the states saved by
+    the turns, measured by encoding them with state_codec. Measuring a state costs
+    about as much as saving it again, so only the fraction state_sizes of the
+    saved states is measured, and none by default.
+
+    The steps are counted by the tracing hooks, so set_metrics installs the
+    metrics as the tracer.
+    """
+
+    def __init__(
+        self,
+        registry: Optional[MetricsRegistry] = None,
+        state_codec=None,
+        state_sizes: float = 0.0,
+    ):
+        if state_codec is None and state_sizes:
+            from .state_codecs import JsonStateCodec
+
+            state_codec = JsonStateCodec()
+
+        self.registry = registry or MetricsRegistry()
+        self.state_codec = state_codec
+        self.state_sizes = state_sizes
+        self.turn_seconds = self.registry.histogram(
+            "dialogs_turn_seconds",
+            "Latency of dialog turns",
+            ("dialog", "engine", "outcome"),
+            DEFAULT_LATENCY_BUCKETS,
+        )
+        self.steps = self.registry.counter(
+            "dialogs_steps_total", "Steps executed or replayed by the engines", ("step", "mode")
+        )
+        self.version_mismatches = self.registry.counter(
+            "dialogs_version_mismatches_total",
+            "Turns whose saved state did not match the version of the dialog",
+            ("dialog",),
+        )
+        self.fallback_turns = self.registry.counter(
+            "dialogs_fallback_turns_total", "Turns that ran the fallback dialog", ("dialog",)
+        )
+        self.state_nodes = self.registry.histogram(
+            "dialogs_state_nodes", "Nodes of the saved states", ("dialog",), DEFAULT_NODE_BUCKETS
+        )
+        self.state_bytes = self.registry.histogram(
+            "dialogs_state_bytes",
+            "Encoded size of the saved states",
+            ("dialog",),
+            DEFAULT_BYTE_BUCKETS,
+        )
+
+    def exit(self, event: tracing.StepEvent) -> None:
+        self.steps.inc(event.name, "replayed" if event.replayed else "executed")
+
+    def state_saved(self, state: DialogState) -> None:
+        if not self.state_sizes or random() >= self.state_sizes:
+            return
+
+        try:
+            encoded_size = len(self.state_codec.encode(state))
+        except Exception:
+            # the state is saved already, and a state the codec cannot encode, such as
+            # one with return values that are not JSON, must not fail the turn
+            return
+
+        raw_state = state_to_dict(state)
+        nodes = 0
+        pending = [raw_state]
+        while pending:
+            raw_node = pending.pop()
+            nodes += 1
+            pending.extend(raw_node["subdialogs"])
+        self.state_nodes.observe(nodes, state.name)
+        self.state_bytes.observe(encoded_size, state.name)
+
+    def render(self) -> str:
+        return self.registry.render()
+
+
+"""
+The metrics of all the engines, installed with set_metrics. When it is None the
+engines skip recording altogether.
+"""
+active_metrics: Optional[DialogMetrics] = None
+
+
+def set_metrics(metrics: Optional[DialogMetrics]) -> None:
+    """
+    Install the metrics of the engines, and as the tracer that counts their steps.
+    To trace the steps with another tracer as well, install a MultiTracer of both
+    after calling this.
+    """
+    global active_metrics
+    if metrics is None and tracing.active_tracer is active_metrics:
+        tracing.set_tracer(None)
+    elif metrics is not None:
+        tracing.set_tracer(metrics)
+    active_metrics = metrics
+
+
+_in_turn: ContextVar[bool] = ContextVar("in_turn", default=False)
+
+
+def measure_turns(engine: str) -> Callable[[F], F]:
+    """
+    Record the latency of the turns run by an engine function. The turns it runs
+    again, on a stale state or for a fallback dialog, are part of the measured turn.
+    """
+
+    def decorator(run_engine: F) -> F:
+        if asyncio.iscoroutinefunction(run_engine):
+
+            @functools.wraps(run_engine)
+            async def run_async_turn(dialog, *args, **kwargs):
+                metrics = active_metrics
+                if metrics is None or _in_turn.get():
+                    return await run_engine(dialog, *args, **kwargs)
+
+                token = _in_turn.set(True)
+                start = perf_counter()
+                outcome = "error"
+                try:
+                    step = await run_engine(dialog, *args, **kwargs)
+                    outcome = "done" if step.is_done else "not_done"
+                    return step
+                finally:
+                    _in_turn.reset(token)
+                    metrics.turn_seconds.observe(
+                        perf_counter() - start, dialog.name, engine, outcome
+                    )
+
+            return cast(F, run_async_turn)
+
+        @functools.wraps(run_engine)
+        def run_turn(dialog, *args, **kwargs):
+            metrics = active_metrics
+            if metrics is None or _in_turn.get():
+                return run_engine(dialog, *args, **kwargs)
+
+            token = _in_turn.set(True)
+            start = perf_counter()
+            outcome = "error"
+            try:
+                step = run_engine(dialog, *args, **kwargs)
+                outcome = "done" if step.is_done else "not_done"
+                return step
+            finally:
+                _in_turn.reset(token)
+                metrics.turn_seconds.observe(perf_counter() - start, dialog.name, engine, outcome)
+
+        return cast(F, run_turn)
+
+    return decorator
+
+
+def version_mismatch(dialog: BaseDialog) -> None:
+    if active_metrics is not None:
+        active_metrics.version_mismatches.inc(dialog.name)
+
+
+def fallback_turn(dialog: BaseDialog) -> None:
+    if active_metrics is not None:
+        active_metrics.fallback_turns.inc(dialog.name)
+
+
+def state_saved(state: DialogState) -> None:
+    if active_metrics is not None:
+        active_metrics.state_saved(state)
@@ -0,0 +1,115 @@
+import asyncio
+from abc import abstractmethod
+from concurrent.futures import Executor, ThreadPoolExecutor
+from functools import partial
+from threading import Lock
+from typing import Optional, Union
+
+from .. import metrics
+from ..types import BaseDialog
+from ..dialog_state import DialogState, StateChanges, stop_tracking_changes
+from .persistence import PersistenceProvider, save_turn
+
+
+class AsyncPersistenceProvider:
+    """
+    This is an interface for persisting the dialog state between consecutive
+    calls to get_client_response, for storage that is accessed with asyncio.
+
+    run_async_gen_dialog awaits it, instead of blocking the event loop the way a
+    PersistenceProvider doing I/O would.
+    """
+
+    @abstractmethod
+    async def save_state(self, state: DialogState) -> None:
+        pass
+
+    @abstractmethod
+    async def get_state(self, dialog: BaseDialog) -> DialogState:
+        pass
+
+    async def save_changes(self, state: DialogState, changes: StateChanges) -> None:
+        """
+        Save the state at the end of a turn in which changes were made to it.
+
+        Providers that can write only the created and updated states should
+        override this, by default the whole state is saved.
+        """
+        await self.save_state(state)
+
+
+_default_executor: Optional[ThreadPoolExecutor] = None
+_default_executor_lock = Lock()
+
+DEFAULT_MAX_WORKERS = 16
+
+
+def default_persistence_executor() -> ThreadPoolExecutor:
+    """
+    The thread pool shared by the ThreadPoolPersistence instances that are not
+    given an executor, created on first use.
+    """
+    global _default_executor
+    with _default_executor_lock:
+        if _default_executor is None:
+            _default_executor = ThreadPoolExecutor(
+                max_workers=DEFAULT_MAX_WORKERS, thread_name_prefix="dialogs-persistence"
+            )
+        return _default_executor
+
+
+class ThreadPoolPersistence(AsyncPersistenceProvider):
+    """
+    Adapts a PersistenceProvider to AsyncPersistenceProvider, by calling it in a
+    thread pool.
+
+    The pool bounds the number of concurrent calls to the provider. By default
+    all the adapters share a pool of DEFAULT_MAX_WORKERS threads, so an adapter
+    can be created per conversation.
+    """
+
+    def __init__(self, persistence: PersistenceProvider, executor: Optional[Executor] = None):
+        self.persistence = persistence
+        self.executor = executor
+
+    async def save_state(self, state: DialogState) -> None:
+        await self._call(partial(self.persistence.save_state, state))
+
+    async def get_state(self, dialog: BaseDialog) -> DialogState:
+        return await self._call(partial(self.persistence.get_state, dialog))
+
+    async def save_changes(self, state: DialogState, changes: StateChanges) -> None:
+        await self._call(partial(self.persistence.save_changes, state, changes))
+
+    def _call(self, function):
+        executor = self.executor or default_persistence_executor()
+        return asyncio.get_running_loop().run_in_executor(executor, function)
+
+
+AnyPersistenceProvider = Union[PersistenceProvider, AsyncPersistenceProvider]
+
+
+async def async_get_state(persistence: AnyPersistenceProvider, dialog: BaseDialog) -> DialogState:
+    if isinstance(persistence, AsyncPersistenceProvider):
+        return await persistence.get_state(dialog)
+
+    return persistence.get_state(dialog)
+
+
+async def async_save_turn(
+    persistence: AnyPersistenceProvider, state: DialogState, changes: Optional[StateChanges]
+) -> None:
+    """
+    Like save_turn, awaiting async providers.
+    """
+    if not isinstance(persistence, AsyncPersistenceProvider):
+        return save_turn(persistence, state, changes)
+
+    stop_tracking_changes()
+    if changes is None:
+        await persistence.save_state(state)
+    elif changes:
+        await persistence.save_changes(state, changes)
+    else:
+        return
+    metrics.state_saved(state)
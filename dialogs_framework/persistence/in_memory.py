@@ -1,8 +1,13 @@
+import sys
+from collections import OrderedDict
 from dataclasses import dataclass
-from typing import Optional, TypeVar, Generic
+from threading import Lock
+from time import monotonic
+from typing import Callable, Hashable, List, Optional, Tuple, TypeVar, Generic
 
 from .persistence import PersistenceProvider
-from ..dialog_state import new_empty_state, DialogState
+from .keyed import KeyedPersistenceProvider
+from ..dialog_state import new_empty_state, BlobResult, DialogState
 from ..types import BaseDialog
 
 T = TypeVar("T")
@@ -17,3 +22,241 @@ class InMemoryPersistence(PersistenceProvider, Generic[T]):
 
     def get_state(self, dialog: BaseDialog[T]) -> DialogState[T]:
         return self.state if self.state else new_empty_state(dialog)
+
+
+@dataclass
+class _Entry:
+    state: DialogState
+    size: int
+    last_used: float
+
+
+@dataclass
+class MemoryStoreStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    entries: int = 0
+    size: int = 0
+
+
+class _Shard:
+    def __init__(self) -> None:
+        self.lock = Lock()
+        self.entries: "OrderedDict[Hashable, _Entry]" = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+def estimated_size(state: DialogState) -> int:
+    """
+    The memory taken by a state and its subdialogs, estimated with sys.getsizeof of
+    each state and return value, without encoding them, so it works for any value.
+    """
+    size = 0
+    pending = [state]
+    while pending:
+        node = pending.pop()
+        size += sys.getsizeof(node)
+        result = node.result
+        # the results kept in a blob store are not loaded to measure them
+        if result is not None and not (isinstance(result, BlobResult) and not result.is_loaded):
+            size += sys.getsizeof(result.return_value)
+        pending.extend(node.subdialogs)
+    return size
+
+
+class KeyedInMemoryPersistence(KeyedPersistenceProvider):
+    """
+    Keeps the dialog states of many conversations in memory.
+
+    Conversations are spread over shards, each with its own lock, so threads
+    working on different conversations rarely wait for each other.
+
+    The least recently used conversations of all the shards are evicted when the
+    store holds more than max_entries, or more than max_bytes as measured by sizer,
+    which defaults to estimated_size, and falls back to it when it raises. While
+    saves run concurrently, the store can go over the limits by the number of
+    saves in progress. Conversations that were not used for ttl seconds are
+    evicted as well.
+
+    get_state returns a copy of the stored state, so a turn that fails leaves the
+    stored state as it was. With copy_states=False it returns the stored state
+    itself, which saves the copy, but the changes of a failed turn stay in memory.
+
+    on_evict is called with the id and the state of each evicted conversation,
+    for example to save it to a colder store, and on_miss is called with the id
+    of each conversation that is not in memory, and can return its state from
+    such a store.
+    """
+
+    def __init__(
+        self,
+        shards: int = 16,
+        max_entries: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+        ttl: Optional[float] = None,
+        on_evict: Optional[Callable[[Hashable, DialogState], None]] = None,
+        on_miss: Optional[Callable[[Hashable], Optional[DialogState]]] = None,
+        sizer: Optional[Callable[[DialogState], int]] = None,
+        clock: Callable[[], float] = monotonic,
+        copy_states: bool = True,
+    ):
+        if shards < 1:
+            raise ValueError("shards must be at least 1")
+
+        self.shards = [_Shard() for _ in range(shards)]
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self.on_miss = on_miss
+        self.clock = clock
+        self.copy_states = copy_states
+        if max_bytes is not None and sizer is None:
+            sizer = estimated_size
+        self.sizer = sizer
+
+    def __len__(self) -> int:
+        return sum(len(shard.entries) for shard in self.shards)
+
+    def get_state(self, conversation_id: Hashable, dialog: BaseDialog[T]) -> DialogState[T]:
+        shard = self._shard(conversation_id)
+        evicted: List[Tuple[Hashable, DialogState]] = []
+        with shard.lock:
+            now = self.clock()
+            entry = shard.entries.get(conversation_id)
+            if entry is not None and self._expired(entry, now):
+                self._remove(shard, conversation_id, evicted)
+                entry = None
+
+            if entry is not None:
+                shard.hits += 1
+                entry.last_used = now
+                shard.entries.move_to_end(conversation_id)
+            else:
+                shard.misses += 1
+
+        self._notify(evicted)
+        if entry is not None:
+            return entry.state.copy() if self.copy_states else entry.state
+
+        state = self.on_miss(conversation_id) if self.on_miss is not None else None
+        return state if state is not None else new_empty_state(dialog)
+
+    def save_state(self, conversation_id: Hashable, state: DialogState[T]) -> None:
+        size = self._size(state)
+        shard = self._shard(conversation_id)
+        evicted: List[Tuple[Hashable, DialogState]] = []
+        with shard.lock:
+            previous = shard.entries.pop(conversation_id, None)
+            if previous is not None:
+                shard.size -= previous.size
+            shard.entries[conversation_id] = _Entry(state, size, self.clock())
+            shard.size += size
+            self._evict_expired(shard, evicted)
+
+        self._evict_least_recent(conversation_id, evicted)
+        self._notify(evicted)
+
+    def delete(self, conversation_id: Hashable) -> None:
+        shard = self._shard(conversation_id)
+        with shard.lock:
+            entry = shard.entries.pop(conversation_id, None)
+            if entry is not None:
+                shard.size -= entry.size
+
+    def clear(self) -> None:
+        for shard in self.shards:
+            with shard.lock:
+                shard.entries.clear()
+                shard.size = 0
+
+    def stats(self) -> MemoryStoreStats:
+        stats = MemoryStoreStats()
+        for shard in self.shards:
+            with shard.lock:
+                stats.hits += shard.hits
+                stats.misses += shard.misses
+                stats.evictions += shard.evictions
+                stats.entries += len(shard.entries)
+                stats.size += shard.size
+        return stats
+
+    def _size(self, state: DialogState) -> int:
+        if self.sizer is None:
+            return 0
+        try:
+            return self.sizer(state)
+        except Exception:
+            # a sizer that cannot measure a state, such as one that encodes it, must not
+            # keep it from being saved
+            return estimated_size(state)
+
+    def _shard(self, conversation_id: Hashable) -> _Shard:
+        return self.shards[hash(conversation_id) % len(self.shards)]
+
+    def _expired(self, entry: _Entry, now: float) -> bool:
+        return self.ttl is not None and now - entry.last_used > self.ttl
+
+    def _evict_expired(self, shard: _Shard, evicted: List[Tuple[Hashable, DialogState]]) -> None:
+        now = self.clock()
+        # The most recently used entry is the one just saved, which is never evicted
+        while len(shard.entries) > 1:
+            conversation_id, entry = next(iter(shard.entries.items()))
+            if not self._expired(entry, now):
+                break
+            self._remove(shard, conversation_id, evicted)
+
+    def _over_limits(self) -> bool:
+        if self.max_entries is not None and len(self) > self.max_entries:
+            return True
+        return self.max_bytes is not None and sum(s.size for s in self.shards) > self.max_bytes
+
+    def _evict_least_recent(
+        self, saved_id: Hashable, evicted: List[Tuple[Hashable, DialogState]]
+    ) -> None:
+        """
+        Evict the least recently used conversations of all the shards until the store
+        is within its limits, except for the conversation that was just saved.
+        """
+        while self._over_limits():
+            oldest_shard: Optional[_Shard] = None
+            oldest_id: Hashable = None
+            oldest_used = 0.0
+            for shard in self.shards:
+                with shard.lock:
+                    for conversation_id, entry in shard.entries.items():
+                        if conversation_id == saved_id:
+                            continue
+                        if oldest_shard is None or entry.last_used < oldest_used:
+                            oldest_shard, oldest_id = shard, conversation_id
+                            oldest_used = entry.last_used
+                        # the entries of a shard are in the order they were used
+                        break
+
+            if oldest_shard is None:
+                return
+
+            with oldest_shard.lock:
+                if oldest_id in oldest_shard.entries:
+                    self._remove(oldest_shard, oldest_id, evicted)
+
+    def _remove(
+        self,
+        shard: _Shard,
+        conversation_id: Hashable,
+        evicted: List[Tuple[Hashable, DialogState]],
+    ) -> None:
+        entry = shard.entries.pop(conversation_id)
+        shard.size -= entry.size
+        shard.evictions += 1
+        evicted.append((conversation_id, entry.state))
+
+    def _notify(self, evicted: List[Tuple[Hashable, DialogState]]) -> None:
+        # Called outside of the shard locks, as the callback may be slow
+        if self.on_evict is not None:
+            for conversation_id, state in evicted:
+                self.on_evict(conversation_id, state)
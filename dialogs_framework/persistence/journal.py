@@ -0,0 +1,389 @@
+import mmap
+import os
+import struct
+import zlib
+from dataclasses import dataclass, field
+from threading import Event, Lock, Thread
+from typing import Dict, Hashable, Iterator, List, Optional, Tuple, cast
+
+from ..types import BaseDialog, StaleStateException
+from ..dialog_state import DialogState, LazyDialogState, StateChanges, new_empty_state
+from ..state_codecs import BinaryStateCodec
+from .keyed import KeyedPersistenceProvider, storage_key
+
+# Each record is its length, the crc32 of its body, and its body
+_HEADER = struct.Struct("<II")
+# The body starts with its kind, whether the conversation is finished, the revision of
+# the conversation and the length of its key
+_BODY = struct.Struct("<BBIH")
+
+_SNAPSHOT = 1
+_DELTA = 2
+_DELETE = 3
+
+_codec = BinaryStateCodec()
+
+
+@dataclass
+class _Conversation:
+    # The offsets of the latest snapshot of the conversation and the deltas after it
+    records: List[int] = field(default_factory=list)
+    size: int = 0
+    finished: bool = False
+    revision: int = 0
+
+
+class _Shard:
+    """
+    A single log file, with the index of the records of its conversations.
+    """
+
+    def __init__(self, path: str, fsync: bool):
+        self.path = path
+        self.fsync = fsync
+        self.lock = Lock()
+        self._open()
+
+    def _open(self) -> None:
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self.map: Optional[mmap.mmap] = None
+        self.index: Dict[str, _Conversation] = {}
+        self.length = self._recover()
+
+    def _remap(self) -> None:
+        self.map = mmap.mmap(self.fd, 0, access=mmap.ACCESS_READ) if self.length else None
+
+    def _recover(self) -> int:
+        """
+        Build the index from the log, and truncate the log after its last whole record,
+        dropping a record that was only partly written before a crash.
+        """
+        self.length = os.fstat(self.fd).st_size
+        self._remap()
+        end = 0
+        for offset, size, kind, key, finished, revision in self._scan():
+            self._index(offset, size, kind, key, finished, revision)
+            end = offset + size
+
+        if end != self.length:
+            os.ftruncate(self.fd, end)
+            self.length = end
+            self._remap()
+        return end
+
+    def _scan(self) -> Iterator[Tuple[int, int, int, str, bool, int]]:
+        if self.map is None:
+            return
+        view = memoryview(self.map)
+        offset = 0
+        while offset + _HEADER.size <= self.length:
+            length, checksum = _HEADER.unpack_from(view, offset)
+            start = offset + _HEADER.size
+            if length == 0 or start + length > self.length:
+                break
+            body = view[start : start + length]
+            if zlib.crc32(body) != checksum:
+                break
+            kind, finished, revision, key, _ = _parse_body(body)
+            yield offset, _HEADER.size + length, kind, key, finished, revision
+            offset = start + length
+
+    def _index(
+        self, offset: int, size: int, kind: int, key: str, finished: bool, revision: int
+    ) -> None:
+        if kind == _DELETE:
+            self.index.pop(key, None)
+        elif kind == _SNAPSHOT:
+            self.index[key] = _Conversation([offset], size, finished, revision)
+        else:
+            conversation = self.index.setdefault(key, _Conversation())
+            conversation.records.append(offset)
+            conversation.size += size
+            conversation.finished = finished
+            conversation.revision = revision
+
+    def revision(self, key: str) -> int:
+        conversation = self.index.get(key)
+        return 0 if conversation is None else conversation.revision
+
+    def append(self, kind: int, key: str, payload: bytes, finished: bool = False) -> int:
+        """
+        Append a record of a conversation, returning its new revision.
+        """
+        revision = self.revision(key) + 1
+        body = _build_body(kind, key, payload, finished, revision)
+        record = _HEADER.pack(len(body), zlib.crc32(body)) + body
+        offset = self.length
+        os.write(self.fd, record)
+        if self.fsync:
+            os.fsync(self.fd)
+        self.length += len(record)
+        self._index(offset, len(record), kind, key, finished, revision)
+        return revision
+
+    def read(self, key: str) -> Optional[DialogState]:
+        conversation = self.index.get(key)
+        if conversation is None:
+            return None
+
+        # The log grew since it was mapped
+        if self.map is None or len(self.map) < self.length:
+            self._remap()
+        view = memoryview(self.map)  # type: ignore
+        state = None
+        for offset in conversation.records:
+            length = _HEADER.unpack_from(view, offset)[0]
+            start = offset + _HEADER.size
+            kind, _, _, _, payload = _parse_body(view[start : start + length])
+            if kind == _SNAPSHOT:
+                state = _codec.decode(payload)
+            else:
+                state = _apply_delta(state, payload)
+        return state
+
+    def live_size(self) -> int:
+        return sum(conversation.size for conversation in self.index.values())
+
+    def compact(self, retain_finished: bool) -> None:
+        """
+        Rewrite the log with a single snapshot of each conversation.
+        """
+        compacted_path = self.path + ".compact"
+        with open(compacted_path, "wb") as compacted:
+            for key, conversation in self.index.items():
+                if conversation.finished and not retain_finished:
+                    continue
+                state = cast(DialogState, self.read(key))
+                body = _build_body(
+                    _SNAPSHOT,
+                    key,
+                    _codec.encode(state),
+                    conversation.finished,
+                    conversation.revision,
+                )
+                compacted.write(_HEADER.pack(len(body), zlib.crc32(body)) + body)
+            compacted.flush()
+            os.fsync(compacted.fileno())
+
+        self.close()
+        os.replace(compacted_path, self.path)
+        self._open()
+
+    def close(self) -> None:
+        self.map = None
+        os.close(self.fd)
+
+
+class JournalPersistence(KeyedPersistenceProvider):
+    """
+    Stores the dialog states of many conversations in append-only log files.
+
+    Each turn appends a record to the log of the shard of the conversation.
+    Usually the record is a delta holding only the subtrees of the state that
+    were created or changed during the turn. Every snapshot_every turns, and
+    whenever the changes are not known, it is a snapshot of the whole state
+    instead.
+
+    With check_revisions, saving a state that was loaded at an older revision
+    than the stored one raises StaleStateException, instead of overwriting the
+    turn that was saved meanwhile.
+
+    get_state rebuilds a state from its latest snapshot and the deltas after it,
+    which are read from a memory map of the log without copying them.
+
+    On opening, a record at the end of a log that was only partly written, as
+    when the process crashed while writing it, is detected by its checksum and
+    dropped, so the conversation continues from its previous turn.
+
+    Compaction rewrites a log with a single snapshot of each conversation,
+    dropping the deleted ones, and the finished ones unless retain_finished.
+    With compaction_interval, a background thread compacts every shard whose
+    log is more than compaction_ratio times the size of its live records.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        shards: int = 4,
+        snapshot_every: int = 32,
+        fsync: bool = False,
+        retain_finished: bool = True,
+        compaction_interval: Optional[float] = None,
+        compaction_ratio: float = 2.0,
+        check_revisions: bool = False,
+    ):
+        if shards < 1:
+            raise ValueError("shards must be at least 1")
+        if snapshot_every < 1:
+            raise ValueError("snapshot_every must be at least 1")
+
+        os.makedirs(directory, exist_ok=True)
+        self.shards = [
+            _Shard(os.path.join(directory, f"shard-{shard}.log"), fsync) for shard in range(shards)
+        ]
+        self.snapshot_every = snapshot_every
+        self.retain_finished = retain_finished
+        self.compaction_ratio = compaction_ratio
+        self.check_revisions = check_revisions
+
+        self._stopped = Event()
+        self._compactor: Optional[Thread] = None
+        if compaction_interval is not None:
+            self._compactor = Thread(
+                target=self._compact_periodically,
+                args=(compaction_interval,),
+                name="dialogs-journal-compaction",
+                daemon=True,
+            )
+            self._compactor.start()
+
+    def get_state(self, conversation_id: Hashable, dialog: BaseDialog) -> DialogState:
+        key, shard = self._locate(conversation_id)
+        with shard.lock:
+            state = shard.read(key)
+            revision = shard.revision(key)
+        if state is None:
+            return new_empty_state(dialog)
+        state.revision = revision
+        return state
+
+    def save_state(self, conversation_id: Hashable, state: DialogState) -> None:
+        key, shard = self._locate(conversation_id)
+        payload = _codec.encode(state)
+        with shard.lock:
+            self._check_revision(conversation_id, key, shard, state)
+            state.revision = shard.append(_SNAPSHOT, key, payload, _is_finished(state))
+
+    def save_changes(
+        self, conversation_id: Hashable, state: DialogState, changes: StateChanges
+    ) -> None:
+        key, shard = self._locate(conversation_id)
+        with shard.lock:
+            self._check_revision(conversation_id, key, shard, state)
+            conversation = shard.index.get(key)
+            if conversation is None or len(conversation.records) >= self.snapshot_every:
+                kind, payload = _SNAPSHOT, _codec.encode(state)
+            else:
+                kind, payload = _DELTA, _encode_delta(state, changes)
+            state.revision = shard.append(kind, key, payload, _is_finished(state))
+
+    def delete(self, conversation_id: Hashable) -> None:
+        key, shard = self._locate(conversation_id)
+        with shard.lock:
+            if key in shard.index:
+                shard.append(_DELETE, key, b"")
+
+    def compact(self, force: bool = True) -> None:
+        """
+        Compact the logs of the shards, or only of the ones that reached the
+        compaction ratio unless force.
+        """
+        for shard in self.shards:
+            with shard.lock:
+                if force or shard.length > self.compaction_ratio * shard.live_size():
+                    shard.compact(self.retain_finished)
+
+    def close(self) -> None:
+        self._stopped.set()
+        if self._compactor is not None:
+            self._compactor.join()
+        for shard in self.shards:
+            with shard.lock:
+                shard.close()
+
+    def _check_revision(
+        self, conversation_id: Hashable, key: str, shard: _Shard, state: DialogState
+    ) -> None:
+        if self.check_revisions and state.revision != shard.revision(key):
+            raise StaleStateException(f"Conversation {conversation_id} was saved meanwhile")
+
+    def _compact_periodically(self, interval: float) -> None:
+        while not self._stopped.wait(interval):
+            self.compact(force=False)
+
+    def _locate(self, conversation_id: Hashable) -> Tuple[str, _Shard]:
+        key = storage_key(conversation_id)
+        return key, self.shards[zlib.crc32(key.encode()) % len(self.shards)]
+
+
+def _is_finished(state: DialogState) -> bool:
+    return bool(state.subdialogs) and state.subdialogs[0].is_done
+
+
+def _build_body(kind: int, key: str, payload: bytes, finished: bool, revision: int) -> bytes:
+    encoded_key = key.encode()
+    return _BODY.pack(kind, finished, revision, len(encoded_key)) + encoded_key + payload
+
+
+def _parse_body(body: memoryview) -> Tuple[int, bool, int, str, memoryview]:
+    kind, finished, revision, key_length = _BODY.unpack_from(body)
+    key_end = _BODY.size + key_length
+    return kind, bool(finished), revision, str(body[_BODY.size : key_end], "utf-8"), body[key_end:]
+
+
+def _changed_subtrees(
+    state: DialogState, changes: StateChanges
+) -> List[Tuple[List[int], DialogState]]:
+    """
+    Find the changed states that have no changed ancestors, with their paths.
+
+    Only the states that are not done, or that changed, can have changed
+    subdialogs, so the walk does not go into the subdialogs of other states.
+    """
+    changed = {id(node) for node in changes.created}
+    changed.update(id(node) for node in changes.updated)
+
+    subtrees = []
+    pending: List[Tuple[List[int], DialogState]] = [([], state)]
+    while pending:
+        path, node = pending.pop()
+        if id(node) in changed:
+            subtrees.append((path, node))
+            continue
+        if node.is_done or (isinstance(node, LazyDialogState) and not node.is_loaded):
+            continue
+        for index in range(len(node.subdialogs) - 1, -1, -1):
+            pending.append((path + [index], node.subdialogs[index]))
+
+    return subtrees
+
+
+def _encode_delta(state: DialogState, changes: StateChanges) -> bytes:
+    """
+    Encode the changed subtrees as the subdialogs of a single state, so they share
+    one symbol table, after their paths.
+    """
+    subtrees = _changed_subtrees(state, changes)
+    forest: DialogState = DialogState(
+        version="", name="", subdialogs=[node for _, node in subtrees]
+    )
+    data = bytearray(struct.pack("<I", len(subtrees)))
+    for path, _ in subtrees:
+        data += struct.pack(f"<I{len(path)}I", len(path), *path)
+    data += _codec.encode(forest)
+    return bytes(data)
+
+
+def _apply_delta(state: Optional[DialogState], payload: memoryview) -> Optional[DialogState]:
+    (count,) = struct.unpack_from("<I", payload, 0)
+    position = 4
+    paths = []
+    for _ in range(count):
+        (path_length,) = struct.unpack_from("<I", payload, position)
+        paths.append(struct.unpack_from(f"<{path_length}I", payload, position + 4))
+        position += 4 + 4 * path_length
+    forest = _codec.decode(payload[position:])
+
+    for path, subtree in zip(paths, forest.subdialogs):
+        if not path:
+            state = subtree
+            continue
+        parent = cast(DialogState, state)
+        for index in path[:-1]:
+            parent = parent.subdialogs[index]
+        subdialogs = parent.subdialogs
+        if path[-1] == len(subdialogs):
+            subdialogs.append(subtree)
+        else:
+            subdialogs[path[-1]] = subtree
+    return state
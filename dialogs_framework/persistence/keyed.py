@@ -0,0 +1,70 @@
+from abc import abstractmethod
+from typing import Hashable
+
+from ..types import BaseDialog
+from ..dialog_state import DialogState, StateChanges
+from .persistence import PersistenceProvider
+
+
+class KeyedPersistenceProvider:
+    """
+    This is an interface for storing the dialog states of many conversations,
+    each identified by a conversation id.
+
+    The engines take a PersistenceProvider for a single conversation, which
+    for_conversation returns.
+    """
+
+    @abstractmethod
+    def save_state(self, conversation_id: Hashable, state: DialogState) -> None:
+        pass
+
+    @abstractmethod
+    def get_state(self, conversation_id: Hashable, dialog: BaseDialog) -> DialogState:
+        pass
+
+    def save_changes(
+        self, conversation_id: Hashable, state: DialogState, changes: StateChanges
+    ) -> None:
+        """
+        Save the state at the end of a turn in which changes were made to it.
+
+        Providers that can write only the created and updated states should
+        override this, by default the whole state is saved.
+        """
+        self.save_state(conversation_id, state)
+
+    def for_conversation(self, conversation_id: Hashable) -> PersistenceProvider:
+        return ConversationPersistence(self, conversation_id)
+
+
+class ConversationPersistence(PersistenceProvider):
+    """
+    The PersistenceProvider of a single conversation of a KeyedPersistenceProvider.
+    """
+
+    def __init__(self, store: KeyedPersistenceProvider, conversation_id: Hashable):
+        self.store = store
+        self.conversation_id = conversation_id
+
+    def save_state(self, state: DialogState) -> None:
+        self.store.save_state(self.conversation_id, state)
+
+    def get_state(self, dialog: BaseDialog) -> DialogState:
+        return self.store.get_state(self.conversation_id, dialog)
+
+    def save_changes(self, state: DialogState, changes: StateChanges) -> None:
+        self.store.save_changes(self.conversation_id, state, changes)
+
+
+def storage_key(conversation_id: Hashable) -> str:
+    """
+    The text a conversation id is stored under, by the providers that store text keys.
+
+    A str id is its own key and other ids are tagged with their type, as in "#int:1",
+    so 1 and "1" do not share a key. A str id that starts with "#" is escaped as "##...",
+    which no tagged key starts with.
+    """
+    if isinstance(conversation_id, str):
+        return "#" + conversation_id if conversation_id.startswith("#") else conversation_id
+    return f"#{type(conversation_id).__qualname__}:{conversation_id!r}"
@@ -1,7 +1,9 @@
 from abc import abstractmethod
+from typing import Optional
 
+from .. import metrics
 from ..types import BaseDialog
-from ..dialog_state import DialogState
+from ..dialog_state import DialogState, StateChanges, stop_tracking_changes
 
 
 class PersistenceProvider:
@@ -19,3 +21,28 @@ class PersistenceProvider:
     @abstractmethod
     def get_state(self, dialog: BaseDialog) -> DialogState:
         pass
+
+    def save_changes(self, state: DialogState, changes: StateChanges) -> None:
+        """
+        Save the state at the end of a turn in which changes were made to it.
+
+        Providers that can write only the created and updated states should
+        override this, by default the whole state is saved.
+        """
+        self.save_state(state)
+
+
+def save_turn(
+    persistence: PersistenceProvider, state: DialogState, changes: Optional[StateChanges]
+) -> None:
+    """
+    Save the state at the end of a turn, skipping the write if nothing changed.
+    """
+    stop_tracking_changes()
+    if changes is None:
+        persistence.save_state(state)
+    elif changes:
+        persistence.save_changes(state, changes)
+    else:
+        return
+    metrics.state_saved(state)
@@ -0,0 +1,253 @@
+import os
+import sqlite3
+import zlib
+from contextlib import contextmanager
+from queue import Queue
+from threading import Event, Lock
+from typing import Hashable, Iterator, List, Optional, Tuple
+
+from ..types import BaseDialog, StaleStateException
+from ..dialog_state import DialogState, new_empty_state
+from ..state_codecs import StateCodec, BinaryStateCodec
+from .keyed import KeyedPersistenceProvider, storage_key
+
+_CREATE_TABLE = """
+CREATE TABLE IF NOT EXISTS dialog_states (
+    conversation_id TEXT PRIMARY KEY,
+    state BLOB NOT NULL,
+    revision INTEGER NOT NULL
+) WITHOUT ROWID
+"""
+_SELECT_STATE = "SELECT state, revision FROM dialog_states WHERE conversation_id = ?"
+_SELECT_REVISION = "SELECT revision FROM dialog_states WHERE conversation_id = ?"
+_UPSERT_STATE = (
+    "INSERT OR REPLACE INTO dialog_states (conversation_id, state, revision) VALUES (?, ?, ?)"
+)
+_DELETE_STATE = "DELETE FROM dialog_states WHERE conversation_id = ?"
+
+
+# The key and the encoded state of a save, and the revision it expects to replace, if checked
+_Row = Tuple[str, bytes, Optional[int]]
+
+
+class _SaveRequest:
+    __slots__ = ("row", "done", "error", "revision")
+
+    def __init__(self, row: _Row):
+        self.row = row
+        self.done = Event()
+        self.error: Optional[BaseException] = None
+        self.revision: Optional[int] = None
+
+
+class _Shard:
+    """
+    A single database file, with its pool of connections and its queue of saves
+    waiting to be committed.
+    """
+
+    def __init__(self, path: str, pool_size: int, timeout: float, synchronous: str):
+        self.path = path
+        self.pool: "Queue[sqlite3.Connection]" = Queue()
+        for _ in range(pool_size):
+            self.pool.put(self._connect(timeout, synchronous))
+
+        with self.connection() as connection:
+            connection.execute(_CREATE_TABLE)
+
+        self.pending: List[_SaveRequest] = []
+        self.pending_lock = Lock()
+        self.committing = False
+
+    def _connect(self, timeout: float, synchronous: str) -> sqlite3.Connection:
+        connection = sqlite3.connect(
+            self.path, timeout=timeout, check_same_thread=False, isolation_level=None
+        )
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute(f"PRAGMA synchronous={synchronous}")
+        return connection
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        connection = self.pool.get()
+        try:
+            yield connection
+        finally:
+            self.pool.put(connection)
+
+    def write(self, rows: List[_Row]) -> List[Optional[int]]:
+        """
+        Write rows in a single transaction, returning the new revision of each
+        row, or None for the rows that expected another revision and were not
+        written.
+        """
+        revisions: List[Optional[int]] = []
+        with self.connection() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                for key, data, expected_revision in rows:
+                    current = connection.execute(_SELECT_REVISION, (key,)).fetchone()
+                    revision = 0 if current is None else current[0]
+                    if expected_revision is not None and expected_revision != revision:
+                        revisions.append(None)
+                        continue
+                    connection.execute(_UPSERT_STATE, (key, data, revision + 1))
+                    revisions.append(revision + 1)
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+        return revisions
+
+    def save(self, row: _Row) -> Optional[int]:
+        """
+        Save a row, together with the rows of the saves that are waiting on other
+        threads, in a single transaction.
+
+        The first thread to save becomes the committer, and keeps committing
+        batches of the saves that queue up meanwhile until none are left. The
+        other threads wait for the batch of their save to be committed.
+
+        Returns the new revision, as write does.
+        """
+        request = _SaveRequest(row)
+        with self.pending_lock:
+            self.pending.append(request)
+            is_committer = not self.committing
+            self.committing = True
+
+        if not is_committer:
+            request.done.wait()
+            if request.error is not None:
+                raise request.error
+            return request.revision
+
+        while True:
+            with self.pending_lock:
+                batch, self.pending = self.pending, []
+                if not batch:
+                    self.committing = False
+                    break
+
+            error = None
+            revisions: List[Optional[int]] = [None] * len(batch)
+            try:
+                revisions = self.write([queued.row for queued in batch])
+            except BaseException as e:
+                error = e
+            for queued, revision in zip(batch, revisions):
+                queued.error = error
+                queued.revision = revision
+                queued.done.set()
+
+        if request.error is not None:
+            raise request.error
+        return request.revision
+
+    def close(self) -> None:
+        while not self.pool.empty():
+            self.pool.get().close()
+
+
+class SqlitePersistence(KeyedPersistenceProvider):
+    """
+    Stores the dialog states of many conversations in SQLite databases.
+
+    The databases use write-ahead logging, so reads do not wait for writes.
+    Each database file has a pool of pool_size connections, which can be used
+    from any thread. To use it with run_async_gen_dialog, wrap the provider of
+    each conversation in a ThreadPoolPersistence.
+
+    With shards > 1, conversations are spread over several database files by a
+    hash of their id, path being suffixed with the shard number, so writes to
+    different shards do not wait for each other.
+
+    With group_commit, saves that happen at the same time on different threads
+    are batched into a single transaction, sharing the cost of syncing it. By
+    default commits are only synced to disk at WAL checkpoints, which survives
+    a crash of the process but not of the machine; synchronous="FULL" syncs
+    every commit.
+
+    With check_revisions, saving a state that was loaded at an older revision
+    than the stored one raises StaleStateException, instead of overwriting the
+    turn that was saved meanwhile.
+
+    States are stored encoded by codec, a BinaryStateCodec by default. The SQL
+    statements are constants, so each connection compiles them once and reuses
+    them from its statement cache.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        shards: int = 1,
+        pool_size: int = 4,
+        group_commit: bool = True,
+        codec: Optional[StateCodec] = None,
+        timeout: float = 30.0,
+        synchronous: str = "NORMAL",
+        check_revisions: bool = False,
+    ):
+        if shards < 1:
+            raise ValueError("shards must be at least 1")
+        if pool_size < 1:
+            raise ValueError("pool_size must be at least 1")
+        if path == ":memory:":
+            raise ValueError("Each connection would have its own in-memory database")
+        if synchronous not in ("OFF", "NORMAL", "FULL", "EXTRA"):
+            raise ValueError(f"Unknown synchronous mode {synchronous}")
+
+        self.codec = codec or BinaryStateCodec()
+        self.group_commit = group_commit
+        self.check_revisions = check_revisions
+        self.shards = [
+            _Shard(shard_path, pool_size, timeout, synchronous)
+            for shard_path in _shard_paths(path, shards)
+        ]
+
+    def get_state(self, conversation_id: Hashable, dialog: BaseDialog) -> DialogState:
+        key, shard = self._locate(conversation_id)
+        with shard.connection() as connection:
+            row = connection.execute(_SELECT_STATE, (key,)).fetchone()
+
+        if row is None:
+            return new_empty_state(dialog)
+        state = self.codec.decode(row[0])
+        state.revision = row[1]
+        return state
+
+    def save_state(self, conversation_id: Hashable, state: DialogState) -> None:
+        key, shard = self._locate(conversation_id)
+        expected_revision = state.revision if self.check_revisions else None
+        row = (key, self.codec.encode(state), expected_revision)
+        if self.group_commit:
+            revision = shard.save(row)
+        else:
+            [revision] = shard.write([row])
+
+        if revision is None:
+            raise StaleStateException(f"Conversation {conversation_id} was saved meanwhile")
+        state.revision = revision
+
+    def delete(self, conversation_id: Hashable) -> None:
+        key, shard = self._locate(conversation_id)
+        with shard.connection() as connection:
+            connection.execute(_DELETE_STATE, (key,))
+
+    def close(self) -> None:
+        for shard in self.shards:
+            shard.close()
+
+    def _locate(self, conversation_id: Hashable) -> Tuple[str, _Shard]:
+        key = storage_key(conversation_id)
+        if len(self.shards) == 1:
+            return key, self.shards[0]
+        return key, self.shards[zlib.crc32(key.encode()) % len(self.shards)]
+
+
+def _shard_paths(path: str, shards: int) -> List[str]:
+    if shards == 1:
+        return [path]
+
+    root, extension = os.path.splitext(path)
+    return [f"{root}-{shard}{extension}" for shard in range(shards)]
@@ -0,0 +1,257 @@
+import asyncio
+import os
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from threading import Lock
+from typing import Callable, Hashable, List, Optional, Tuple
+
+from .dialog_state import DialogState, StateChanges
+from .gen_dialogs import run_gen_dialog, GenInputDialogType
+from .generic_types import ClientResponse, RunDialogReturnType
+from .persistence.persistence import PersistenceProvider, save_turn
+from .persistence.async_persistence import AnyPersistenceProvider, async_get_state, async_save_turn
+from .session_cache import SessionCache
+from .types import BaseDialog, StaleStateException
+
+_TurnResult = Tuple[RunDialogReturnType, bool, DialogState, Optional[StateChanges]]
+
+
+class ProcessPoolEngine:
+    """
+    Runs the turns of run_gen_dialog in a pool of worker processes, so that sync
+    dialogs doing heavy computation use all the cores instead of sharing the GIL
+    of the server.
+
+    Each conversation id is always sent to the same worker, whose session cache
+    keeps its suspended generators, and any other in-process cache, warm between
+    turns. The state is loaded and saved by the calling process, and handed to the
+    worker with the client response, so the persistence provider does not need to
+    be shared with the workers.
+
+    The dialog factories are sent to the workers, so they must be picklable, such
+    as functions decorated with dialog at the top level of a module. A worker that
+    crashes is replaced, and its turn is run again, up to crash_retries times.
+    """
+
+    def __init__(
+        self,
+        workers: Optional[int] = None,
+        max_sessions: int = 1024,
+        crash_retries: int = 1,
+        mp_context=None,
+    ):
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if workers < 1:
+            raise ValueError("workers must be at least 1")
+
+        self.max_sessions = max_sessions
+        self.crash_retries = crash_retries
+        self._mp_context = mp_context
+        self._lock = Lock()
+        self._executors: List[ProcessPoolExecutor] = [self._new_executor() for _ in range(workers)]
+
+    def __enter__(self) -> "ProcessPoolEngine":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.shutdown()
+
+    @property
+    def workers(self) -> int:
+        return len(self._executors)
+
+    def worker_of(self, conversation_id: Hashable) -> int:
+        return hash(conversation_id) % len(self._executors)
+
+    def run(
+        self,
+        dialog_factory: Callable[[], GenInputDialogType],
+        persistence: PersistenceProvider,
+        client_response: ClientResponse,
+        conversation_id: Hashable,
+        fallback_dialog_factory: Optional[Callable[[], GenInputDialogType]] = None,
+        stale_retries: int = 3,
+    ) -> RunDialogReturnType:
+        """
+        Run a turn of a conversation in its worker, blocking until it is done.
+        """
+        resume = True
+        while True:
+            state = persistence.get_state(dialog_factory())
+            step, saved, state, changes = self._submit_with_retries(
+                dialog_factory,
+                state,
+                client_response,
+                conversation_id,
+                fallback_dialog_factory,
+                resume,
+            ).result()
+            if not saved:
+                return step
+
+            try:
+                save_turn(persistence, state, changes)
+                return step
+            except StaleStateException:
+                if stale_retries == 0:
+                    raise
+                stale_retries -= 1
+                resume = False
+
+    async def run_async(
+        self,
+        dialog_factory: Callable[[], GenInputDialogType],
+        persistence: AnyPersistenceProvider,
+        client_response: ClientResponse,
+        conversation_id: Hashable,
+        fallback_dialog_factory: Optional[Callable[[], GenInputDialogType]] = None,
+        stale_retries: int = 3,
+    ) -> RunDialogReturnType:
+        """
+        Like run, awaiting the worker instead of blocking the event loop.
+        """
+        resume = True
+        while True:
+            state = await async_get_state(persistence, dialog_factory())
+            step, saved, state, changes = await asyncio.wrap_future(
+                self._submit_with_retries(
+                    dialog_factory,
+                    state,
+                    client_response,
+                    conversation_id,
+                    fallback_dialog_factory,
+                    resume,
+                )
+            )
+            if not saved:
+                return step
+
+            try:
+                await async_save_turn(persistence, state, changes)
+                return step
+            except StaleStateException:
+                if stale_retries == 0:
+                    raise
+                stale_retries -= 1
+                resume = False
+
+    def shutdown(self, wait: bool = True) -> None:
+        for executor in self._executors:
+            executor.shutdown(wait=wait)
+
+    def _new_executor(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(
+            max_workers=1,
+            mp_context=self._mp_context,
+            initializer=_init_worker,
+            initargs=(self.max_sessions,),
+        )
+
+    def _submit_with_retries(
+        self,
+        dialog_factory,
+        state: DialogState,
+        client_response,
+        conversation_id: Hashable,
+        fallback_dialog_factory,
+        resume: bool,
+    ) -> "Future[_TurnResult]":
+        """
+        Submit a turn to the worker of its conversation. The returned future is
+        resubmitted to a new worker if the current one crashes.
+        """
+        worker = self.worker_of(conversation_id)
+        outcome: "Future[_TurnResult]" = Future()
+        retries = self.crash_retries
+
+        def submit() -> None:
+            executor = self._executors[worker]
+            try:
+                future = executor.submit(
+                    _run_turn,
+                    dialog_factory,
+                    state,
+                    client_response,
+                    conversation_id,
+                    fallback_dialog_factory,
+                    resume,
+                )
+            except BrokenProcessPool:
+                future = Future()
+                future.set_exception(BrokenProcessPool("Worker crashed"))
+            future.add_done_callback(lambda future: done(executor, future))
+
+        def done(executor: ProcessPoolExecutor, future: "Future[_TurnResult]") -> None:
+            nonlocal retries
+            error = future.exception()
+            if isinstance(error, BrokenProcessPool) and retries > 0:
+                retries -= 1
+                self._replace_executor(worker, executor)
+                submit()
+            elif error is not None:
+                outcome.set_exception(error)
+            else:
+                outcome.set_result(future.result())
+
+        submit()
+        return outcome
+
+    def _replace_executor(self, worker: int, broken: ProcessPoolExecutor) -> None:
+        with self._lock:
+            if self._executors[worker] is broken:
+                self._executors[worker] = self._new_executor()
+        broken.shutdown(wait=False)
+
+
+class _HandoffPersistence(PersistenceProvider):
+    """
+    The persistence of a turn run by a worker, which holds the state handed over
+    by the calling process, and keeps what the turn saved to hand it back.
+    """
+
+    def __init__(self, state: DialogState):
+        self.state = state
+        self.saves = 0
+        self.changes: Optional[StateChanges] = None
+
+    def get_state(self, dialog: BaseDialog) -> DialogState:
+        return self.state
+
+    def save_state(self, state: DialogState) -> None:
+        self.state = state
+        self.saves += 1
+        self.changes = None
+
+    def save_changes(self, state: DialogState, changes: StateChanges) -> None:
+        self.state = state
+        self.saves += 1
+        # the changes of several saves in a turn are not merged, the state is saved whole
+        self.changes = changes if self.saves == 1 else None
+
+
+_session_cache: Optional[SessionCache] = None
+
+
+def _init_worker(max_sessions: int) -> None:
+    global _session_cache
+    _session_cache = SessionCache(max_sessions=max_sessions)
+
+
+def _run_turn(
+    dialog_factory, state, client_response, conversation_id, fallback_dialog_factory, resume
+) -> _TurnResult:
+    assert _session_cache is not None
+    if not resume:
+        _session_cache.discard(conversation_id)
+
+    persistence = _HandoffPersistence(state)
+    step: RunDialogReturnType = run_gen_dialog(
+        dialog_factory(),
+        persistence,
+        client_response,
+        fallback_dialog_factory() if fallback_dialog_factory else None,
+        _session_cache,
+        conversation_id,
+    )
+    return step, persistence.saves > 0, persistence.state, persistence.changes
@@ -0,0 +1,135 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+from threading import Lock
+from time import monotonic
+from typing import Callable, Hashable, List, Optional, Tuple
+
+from .dialog_state import DialogState
+from .generic_types import DialogFrame
+from .types import BaseDialog
+
+
+@dataclass
+class _Session:
+    root: Tuple[str, str]
+    signature: List[Tuple[str, str, int]]
+    frames: List[DialogFrame]
+    last_used: float
+
+
+class SessionCache:
+    """
+    This is an opt-in, in-process cache of live dialog sessions.
+
+    When a turn ends on get_client_response, the engine hands the stack of
+    suspended generators to the cache. On the next turn of the same conversation
+    the engine sends the client response straight into the innermost generator,
+    instead of replaying the whole dialog from its first step.
+
+    A session is only resumed if the persisted state still matches the state it
+    was suspended with, so a miss, an eviction, a changed root dialog version or
+    a process restart all fall back to a regular replay.
+    """
+
+    def __init__(
+        self,
+        max_sessions: int = 1024,
+        ttl: Optional[float] = None,
+        clock: Callable[[], float] = monotonic,
+    ):
+        if max_sessions < 1:
+            raise ValueError("max_sessions must be positive")
+
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._clock = clock
+        self._sessions: "OrderedDict[Hashable, _Session]" = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def suspend(
+        self, conversation_id: Hashable, dialog: BaseDialog, frames: List[DialogFrame]
+    ) -> None:
+        """
+        Store the stack of suspended frames of a conversation.
+        """
+        if not frames:
+            self.discard(conversation_id)
+            return
+
+        session = _Session(
+            root=(dialog.name, dialog.version),
+            signature=[_node_signature(frame.state) for frame in frames],
+            frames=frames,
+            last_used=self._clock(),
+        )
+        with self._lock:
+            self._sessions[conversation_id] = session
+            self._sessions.move_to_end(conversation_id)
+            self._evict()
+
+    def resume(
+        self,
+        conversation_id: Hashable,
+        dialog: BaseDialog,
+        state: DialogState,
+        allow_async: bool = False,
+    ) -> Optional[List[DialogFrame]]:
+        """
+        Take the session of a conversation out of the cache, and rebind its frames
+        to the freshly loaded state. Returns None if the session cannot be resumed.
+        """
+        with self._lock:
+            session = self._sessions.pop(conversation_id, None)
+
+        if session is None or self._is_expired(session):
+            return None
+
+        if session.root != (dialog.name, dialog.version) or state.handling_fallback:
+            return None
+
+        if not allow_async and any(frame.is_async for frame in session.frames):
+            return None
+
+        states = []
+        node = state
+        for signature in session.signature:
+            if _node_signature(node) != signature or node.is_done:
+                return None
+            states.append(node)
+            node = node.subdialogs[-1]
+
+        if node.is_done or not node.sent_to_client:
+            return None
+
+        for frame, frame_state in zip(session.frames, states):
+            frame.state = frame_state
+
+        return session.frames
+
+    def discard(self, conversation_id: Hashable) -> None:
+        with self._lock:
+            self._sessions.pop(conversation_id, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._sessions.clear()
+
+    def _is_expired(self, session: _Session) -> bool:
+        return self.ttl is not None and self._clock() - session.last_used > self.ttl
+
+    def _evict(self) -> None:
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+
+        while self._sessions:
+            oldest = next(iter(self._sessions.values()))
+            if not self._is_expired(oldest):
+                break
+            self._sessions.popitem(last=False)
+
+
+def _node_signature(state: DialogState) -> Tuple[str, str, int]:
+    return state.name, state.version, len(state.subdialogs)
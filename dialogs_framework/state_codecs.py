@@ -0,0 +1,316 @@
+import json
+from abc import abstractmethod
+from typing import Any, List, Optional, Tuple, Union
+
+from .blobs import BlobStore, blob_key
+from .dialog_state import (
+    BlobResult,
+    DialogState,
+    Result,
+    state_from_dict,
+    state_to_dict,
+    lazy_state_from_dict,
+    intern_state_dict,
+)
+from .symbols import SymbolTable, dialog_symbols
+from .types import send_message
+
+"""
+The size in bytes of the JSON of a return value above which it is offloaded to
+the blob store of a codec.
+"""
+DEFAULT_BLOB_THRESHOLD = 1024
+
+
+class StateCodec:
+    """
+    This is an interface for converting dialog states to bytes and back, for
+    persistence providers that store bytes.
+    """
+
+    @abstractmethod
+    def encode(self, state: DialogState) -> bytes:
+        pass
+
+    @abstractmethod
+    def decode(self, data: Union[bytes, bytearray, memoryview]) -> DialogState:
+        pass
+
+
+class JsonStateCodec(StateCodec):
+    """
+    Encodes states as the JSON of their dict form.
+
+    With interned, the names and versions are stored once, as made by
+    intern_state_dict. With lazy, decoded states build their subdialogs on
+    first access, as made by lazy_state_from_dict.
+
+    With a blob_store, the return values whose JSON is larger than
+    blob_threshold bytes are stored in it, and only their keys in the state.
+    They are loaded when they are first accessed.
+    """
+
+    def __init__(
+        self,
+        interned: bool = True,
+        lazy: bool = False,
+        blob_store: Optional[BlobStore] = None,
+        blob_threshold: int = DEFAULT_BLOB_THRESHOLD,
+    ):
+        self.interned = interned
+        self.lazy = lazy
+        self.blob_store = blob_store
+        self.blob_threshold = blob_threshold
+
+    def encode(self, state: DialogState) -> bytes:
+        raw_state = state_to_dict(state)
+        if self.blob_store is not None:
+            raw_state = self._offload_results(raw_state)
+        if self.interned:
+            raw_state = intern_state_dict(raw_state)
+        return json.dumps(raw_state, separators=(",", ":")).encode()
+
+    def decode(self, data: Union[bytes, bytearray, memoryview]) -> DialogState:
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        raw_state = json.loads(data)
+        if self.lazy:
+            return lazy_state_from_dict(raw_state, self.blob_store)
+        return state_from_dict(raw_state, self.blob_store)
+
+    def _offload_results(self, raw_state: dict) -> dict:
+        """
+        Copy the dict form of a state, replacing the large results by blob keys.
+        The dicts of the state are copied rather than changed, as lazy states share
+        theirs with the dict forms made from them.
+        """
+        assert self.blob_store is not None
+        root = dict(raw_state)
+        pending = [root]
+        while pending:
+            node = pending.pop()
+            result = node["result"]
+            if result is not None and "return_value" in result:
+                data = json.dumps(result["return_value"], separators=(",", ":")).encode()
+                if len(data) > self.blob_threshold:
+                    node["result"] = {"blob": _offload(self.blob_store, data)}
+            node["subdialogs"] = [dict(subdialog) for subdialog in node["subdialogs"]]
+            pending.extend(node["subdialogs"])
+
+        return root
+
+
+_MAGIC = b"DS\x01"
+
+_DONE = 1
+_SENT_TO_CLIENT = 2
+_HANDLING_FALLBACK = 4
+_RETURNS_NONE = 8
+_RUN = 16
+_BLOB = 32
+
+_SEND_MESSAGE_NAME = dialog_symbols.canonical(send_message.name)
+
+
+class BinaryStateCodec(StateCodec):
+    """
+    Encodes states in a compact binary format, using only the standard library.
+
+    The format is a symbol table of the names and versions, followed by the
+    states in depth first order. Each state is its name and version ids, a byte
+    of flags, its return value as JSON unless it is None, and the number of
+    records of its subdialogs, all integers being varints. Consecutive done
+    send_message states, which make up most of a conversation, are stored as a
+    single record with a count.
+
+    With a blob_store, the return values whose JSON is larger than
+    blob_threshold bytes are stored in it, and only their keys in the state.
+    They are loaded when they are first accessed.
+
+    Decoding reads the data through a memoryview, without copying it.
+    """
+
+    def __init__(
+        self,
+        blob_store: Optional[BlobStore] = None,
+        blob_threshold: int = DEFAULT_BLOB_THRESHOLD,
+    ):
+        self.blob_store = blob_store
+        self.blob_threshold = blob_threshold
+
+    def encode(self, state: DialogState) -> bytes:
+        table = SymbolTable()
+        body = bytearray()
+        pending: List[Tuple[DialogState, int]] = [(state, 1)]
+        while pending:
+            node, count = pending.pop()
+            flags = _flags_of(node)
+            if count > 1:
+                flags |= _RUN
+            value = b""
+            if count == 1 and flags & _DONE and not flags & _RETURNS_NONE:
+                if flags & _BLOB:
+                    value = bytes.fromhex(node.result.key)  # type: ignore
+                else:
+                    value = json.dumps(node.return_value, separators=(",", ":")).encode()
+                    if self.blob_store is not None and len(value) > self.blob_threshold:
+                        value = bytes.fromhex(_offload(self.blob_store, value))
+                        flags |= _BLOB
+
+            _write_varint(body, table.intern(node.name))
+            _write_varint(body, table.intern(node.version))
+            body.append(flags)
+            if count > 1:
+                _write_varint(body, count)
+                continue
+            if value:
+                _write_bytes(body, value)
+
+            records = _records_of(node.subdialogs)
+            _write_varint(body, len(records))
+            pending.extend(reversed(records))
+
+        data = bytearray(_MAGIC)
+        _write_varint(data, len(table))
+        for symbol in table.symbols:
+            _write_bytes(data, symbol.encode())
+        data += body
+        return bytes(data)
+
+    def decode(self, data: Union[bytes, bytearray, memoryview]) -> DialogState:
+        view = memoryview(data)
+        if view[: len(_MAGIC)] != _MAGIC:
+            raise ValueError("Not a binary dialog state")
+
+        position = len(_MAGIC)
+        symbol_count, position = _read_varint(view, position)
+        symbols = []
+        for _ in range(symbol_count):
+            length, position = _read_varint(view, position)
+            symbols.append(
+                dialog_symbols.canonical(str(view[position : position + length], "utf-8"))
+            )
+            position += length
+
+        root: List[DialogState] = []
+        # Each entry is the list the next records go to, and how many records are left
+        pending: List[List[Any]] = [[root, 1]]
+        while pending:
+            entry = pending[-1]
+            if entry[1] == 0:
+                pending.pop()
+                continue
+            entry[1] -= 1
+
+            name_id, position = _read_varint(view, position)
+            version_id, position = _read_varint(view, position)
+            flags = view[position]
+            position += 1
+
+            if flags & _RUN:
+                count, position = _read_varint(view, position)
+                entry[0].extend(
+                    _new_state(symbols[name_id], symbols[version_id], flags, None)
+                    for _ in range(count)
+                )
+                continue
+
+            return_value = None
+            key = None
+            if flags & _DONE and not flags & _RETURNS_NONE:
+                length, position = _read_varint(view, position)
+                if flags & _BLOB:
+                    key = view[position : position + length].hex()
+                else:
+                    return_value = json.loads(str(view[position : position + length], "utf-8"))
+                position += length
+
+            state = _new_state(symbols[name_id], symbols[version_id], flags, return_value)
+            if key is not None:
+                state.result = BlobResult(self.blob_store, key)
+            entry[0].append(state)
+            record_count, position = _read_varint(view, position)
+            if record_count:
+                pending.append([state.subdialogs, record_count])
+
+        return root[0]
+
+
+def _flags_of(state: DialogState) -> int:
+    flags = 0
+    if state.is_done:
+        flags |= _DONE
+        # the value of a blob result is not loaded, it is never None
+        if isinstance(state.result, BlobResult):
+            flags |= _BLOB
+        elif state.return_value is None:
+            flags |= _RETURNS_NONE
+    if state.sent_to_client:
+        flags |= _SENT_TO_CLIENT
+    if state.handling_fallback:
+        flags |= _HANDLING_FALLBACK
+    return flags
+
+
+def _is_trivial(state: DialogState) -> bool:
+    return (
+        state.name == _SEND_MESSAGE_NAME
+        and state.is_done
+        and state.return_value is None
+        and not state.sent_to_client
+        and not state.handling_fallback
+        and not state.subdialogs
+    )
+
+
+def _records_of(subdialogs: List[DialogState]) -> List[Tuple[DialogState, int]]:
+    records: List[Tuple[DialogState, int]] = []
+    for subdialog in subdialogs:
+        if records and _is_trivial(subdialog):
+            previous, count = records[-1]
+            if _is_trivial(previous) and previous.version == subdialog.version:
+                records[-1] = (previous, count + 1)
+                continue
+        records.append((subdialog, 1))
+    return records
+
+
+def _new_state(name: str, version: str, flags: int, return_value: Any) -> DialogState:
+    return DialogState(
+        version=version,
+        name=name,
+        result=Result(return_value) if flags & _DONE else None,
+        sent_to_client=bool(flags & _SENT_TO_CLIENT),
+        handling_fallback=bool(flags & _HANDLING_FALLBACK),
+    )
+
+
+def _offload(blob_store: BlobStore, data: bytes) -> str:
+    key = blob_key(data)
+    if key not in blob_store:
+        blob_store.put(key, data)
+    return key
+
+
+def _write_varint(data: bytearray, value: int) -> None:
+    while value >= 0x80:
+        data.append((value & 0x7F) | 0x80)
+        value >>= 7
+    data.append(value)
+
+
+def _write_bytes(data: bytearray, value: bytes) -> None:
+    _write_varint(data, len(value))
+    data += value
+
+
+def _read_varint(view: memoryview, position: int) -> Tuple[int, int]:
+    value = 0
+    shift = 0
+    while True:
+        byte = view[position]
+        position += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, position
+        shift += 7
@@ -0,0 +1,69 @@
+import asyncio
+from typing import Any, Callable, Dict, List, Optional, Tuple, Type
+
+from .dialog_state import DialogState
+from .generic_types import StepContext
+
+StepHandler = Callable[[Any, DialogState, StepContext], Any]
+
+
+class StepRegistry:
+    """
+    Maps step types to the handlers that run them.
+
+    A handler is called with the step, the step's state, and the StepContext of
+    the engine running it, and returns the step's return value. Handlers registered
+    as coroutine functions are awaited by the async engine.
+
+    Each engine has its own registry, which falls back to its parent registry
+    for the step types it does not handle itself. A step type that is not
+    registered falls back to the handler of its nearest registered base class.
+    Lookups are cached per step type, so dispatching a step is a dict lookup.
+    """
+
+    def __init__(self, parent: Optional["StepRegistry"] = None):
+        self.parent = parent
+        self._handlers: Dict[type, Tuple[StepHandler, bool]] = {}
+        self._cache: Dict[type, Tuple[StepHandler, bool]] = {}
+        self._children: List["StepRegistry"] = []
+        if parent is not None:
+            parent._children.append(self)
+
+    def register(self, step_type: Type, handler: Optional[StepHandler] = None):
+        """
+        Register the handler of a step type. Can be used as a decorator.
+        """
+        if handler is None:
+            return lambda handler: self.register(step_type, handler)
+
+        self._handlers[step_type] = (handler, asyncio.iscoroutinefunction(handler))
+        self._invalidate()
+        return handler
+
+    def unregister(self, step_type: Type) -> None:
+        del self._handlers[step_type]
+        self._invalidate()
+
+    def lookup(self, step_type: Type) -> Tuple[StepHandler, bool]:
+        """
+        Returns the handler of a step type, and whether it is a coroutine function.
+        """
+        try:
+            return self._cache[step_type]
+        except KeyError:
+            pass
+
+        for base in step_type.__mro__:
+            registry: Optional[StepRegistry] = self
+            while registry is not None:
+                if base in registry._handlers:
+                    entry = self._cache[step_type] = registry._handlers[base]
+                    return entry
+                registry = registry.parent
+
+        raise Exception("Unsupported dialog type")
+
+    def _invalidate(self) -> None:
+        self._cache.clear()
+        for child in self._children:
+            child._invalidate()
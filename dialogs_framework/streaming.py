@@ -0,0 +1,122 @@
+import asyncio
+import queue
+from typing import Any, AsyncIterator, Hashable, Iterator, Optional
+
+from .async_gen_dialogs import run_async_gen_dialog, AsyncGenInputDialogType
+from .executor import DialogExecutor, default_dialog_executor
+from .gen_dialogs import run_gen_dialog, GenInputDialogType
+from .generic_types import ClientResponse, RunDialogReturnType
+from .message_queue import message_listener
+from .persistence.async_persistence import AnyPersistenceProvider
+from .persistence.persistence import PersistenceProvider
+from .session_cache import SessionCache
+
+
+async def stream_async_gen_dialog(
+    dialog: AsyncGenInputDialogType,
+    persistence: AnyPersistenceProvider,
+    client_response: ClientResponse,
+    fallback_dialog: Optional[AsyncGenInputDialogType] = None,
+    session_cache: Optional[SessionCache] = None,
+    conversation_id: Optional[Hashable] = None,
+    deadline: Optional[float] = None,
+) -> AsyncIterator[Any]:
+    """
+    Run a turn like run_async_gen_dialog, yielding each server message as soon as
+    it is sent, and then the DialogStep of the turn, whose messages are all the
+    messages that were yielded.
+
+    The state is saved once, at the end of the turn. Since the messages were
+    already yielded, a stale save raises StaleStateException instead of running
+    the turn again. If the iteration is stopped before the end, the turn is
+    cancelled and nothing is saved.
+    """
+    messages: "asyncio.Queue[Any]" = asyncio.Queue()
+
+    async def run_turn():
+        # The task runs in a copy of the context, so the listener is only set for this turn
+        message_listener.set(messages.put_nowait)
+        return await run_async_gen_dialog(
+            dialog,
+            persistence,
+            client_response,
+            fallback_dialog,
+            session_cache,
+            conversation_id,
+            stale_retries=0,
+            deadline=deadline,
+        )
+
+    turn = asyncio.ensure_future(run_turn())
+    next_message: Optional[asyncio.Future] = None
+    try:
+        while not turn.done():
+            next_message = asyncio.ensure_future(messages.get())
+            await asyncio.wait({next_message, turn}, return_when=asyncio.FIRST_COMPLETED)
+            if next_message.done():
+                yield next_message.result()
+            else:
+                next_message.cancel()
+
+        while not messages.empty():
+            yield messages.get_nowait()
+        yield turn.result()
+    finally:
+        if next_message is not None:
+            next_message.cancel()
+        turn.cancel()
+
+
+_MESSAGE = 0
+_STEP = 1
+_ERROR = 2
+
+
+def stream_gen_dialog(
+    dialog: GenInputDialogType,
+    persistence: PersistenceProvider,
+    client_response: ClientResponse,
+    fallback_dialog: Optional[GenInputDialogType] = None,
+    session_cache: Optional[SessionCache] = None,
+    conversation_id: Optional[Hashable] = None,
+    executor: Optional[DialogExecutor] = None,
+) -> Iterator[Any]:
+    """
+    Run a turn like run_gen_dialog, yielding each server message as soon as it is
+    sent, and then the DialogStep of the turn.
+
+    The turn runs in a thread of executor, or of the default DialogExecutor, in a
+    copy of the caller's context, while the messages are yielded by the calling
+    thread. As with stream_async_gen_dialog, the state is saved once, at the end of
+    the turn, and a stale save raises StaleStateException.
+
+    Unlike stream_async_gen_dialog, a thread cannot be interrupted: if the iteration
+    is stopped before the end, the turn still runs to its end and is saved, and its
+    remaining messages are dropped.
+    """
+    events: "queue.Queue[Any]" = queue.Queue()
+
+    def run_turn() -> None:
+        message_listener.set(lambda message: events.put((_MESSAGE, message)))
+        try:
+            step: RunDialogReturnType = run_gen_dialog(
+                dialog,
+                persistence,
+                client_response,
+                fallback_dialog,
+                session_cache,
+                conversation_id,
+                stale_retries=0,
+            )
+            events.put((_STEP, step))
+        except BaseException as e:
+            events.put((_ERROR, e))
+
+    (executor or default_dialog_executor()).submit(run_turn)
+    while True:
+        kind, value = events.get()
+        if kind == _ERROR:
+            raise value
+        yield value
+        if kind == _STEP:
+            return
@@ -0,0 +1,55 @@
+from threading import Lock
+from typing import Dict, List
+
+
+class SymbolTable:
+    """
+    Interns the names and versions of dialogs as small integer ids.
+
+    Interned strings are shared by every state that uses them, instead of each
+    state holding its own copy, and compare by identity.
+    """
+
+    def __init__(self) -> None:
+        self._symbols: List[str] = []
+        self._ids: Dict[str, int] = {}
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._symbols)
+
+    def __getitem__(self, symbol_id: int) -> str:
+        return self._symbols[symbol_id]
+
+    def intern(self, symbol: str) -> int:
+        """
+        Returns the id of a symbol, adding it to the table if needed.
+        """
+        try:
+            return self._ids[symbol]
+        except KeyError:
+            pass
+
+        with self._lock:
+            symbol_id = self._ids.get(symbol)
+            if symbol_id is None:
+                symbol_id = len(self._symbols)
+                self._symbols.append(symbol)
+                self._ids[symbol] = symbol_id
+            return symbol_id
+
+    def canonical(self, symbol: str) -> str:
+        """
+        Returns the shared copy of a symbol.
+        """
+        return self._symbols[self.intern(symbol)]
+
+    @property
+    def symbols(self) -> List[str]:
+        return list(self._symbols)
+
+
+"""
+The table shared by all the states of the process.
+"""
+dialog_symbols = SymbolTable()
@@ -0,0 +1,199 @@
+from contextlib import contextmanager
+from dataclasses import dataclass
+from threading import Lock
+from time import perf_counter
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from .types import BaseDialog, SendToClientException
+
+
+class StepEvent:
+    """
+    A step run by one of the engines, given to the tracer when the step is entered
+    and again when it exits.
+
+    call_index is the index of the step among the steps of its parent dialog, and
+    depth is the number of dialogs above it on the stack of the engine. A step is
+    replayed when it was already done, and returns its saved value without running.
+    start and end are perf_counter timestamps. error is the exception that ended
+    the step, which is a SendToClientException for a step waiting for the client.
+    """
+
+    __slots__ = ("name", "version", "call_index", "depth", "replayed", "start", "end", "error")
+
+    def __init__(self, step: BaseDialog, call_index: int, depth: int, replayed: bool):
+        self.name = step.name
+        self.version = step.version
+        self.call_index = call_index
+        self.depth = depth
+        self.replayed = replayed
+        self.start = perf_counter()
+        self.end: Optional[float] = None
+        self.error: Optional[BaseException] = None
+
+    def __repr__(self) -> str:
+        return (
+            f"StepEvent(name={self.name!r}, version={self.version!r}, "
+            f"call_index={self.call_index}, depth={self.depth}, replayed={self.replayed})"
+        )
+
+    @property
+    def duration(self) -> float:
+        return (self.end if self.end is not None else perf_counter()) - self.start
+
+
+class Tracer:
+    """
+    This is an interface for observing the steps the engines run.
+
+    The engines check for a tracer once per step, so they cost next to nothing
+    when none is installed. Tracers are called on the thread running the turn,
+    so they should be quick, and thread safe if turns run in several threads.
+    """
+
+    def enter(self, event: StepEvent) -> None:
+        pass
+
+    def exit(self, event: StepEvent) -> None:
+        pass
+
+
+class MultiTracer(Tracer):
+    """
+    Calls several tracers, in order.
+    """
+
+    def __init__(self, *tracers: Tracer):
+        self.tracers = tracers
+
+    def enter(self, event: StepEvent) -> None:
+        for tracer in self.tracers:
+            tracer.enter(event)
+
+    def exit(self, event: StepEvent) -> None:
+        for tracer in self.tracers:
+            tracer.exit(event)
+
+
+"""
+The tracer of all the engines, installed with set_tracer. Read by the engines on
+every turn, and by run on every step.
+"""
+active_tracer: Optional[Tracer] = None
+
+
+def set_tracer(tracer: Optional[Tracer]) -> None:
+    global active_tracer
+    active_tracer = tracer
+
+
+@contextmanager
+def tracing(tracer: Tracer) -> Iterator[Tracer]:
+    """
+    Install a tracer for the duration of a with block.
+    """
+    previous = active_tracer
+    set_tracer(tracer)
+    try:
+        yield tracer
+    finally:
+        set_tracer(previous)
+
+
+def step_entered(tracer: Tracer, step: BaseDialog, call_index: int, depth: int) -> StepEvent:
+    event = StepEvent(step, call_index, depth, False)
+    tracer.enter(event)
+    return event
+
+
+def step_exited(tracer: Tracer, event: StepEvent, error: Optional[BaseException] = None) -> None:
+    event.end = perf_counter()
+    event.error = error
+    tracer.exit(event)
+
+
+def step_replayed(tracer: Tracer, step: BaseDialog, call_index: int, depth: int) -> None:
+    event = StepEvent(step, call_index, depth, True)
+    event.end = event.start
+    tracer.enter(event)
+    tracer.exit(event)
+
+
+def steps_interrupted(
+    tracer: Tracer, events: List[Optional[StepEvent]], error: BaseException
+) -> None:
+    """
+    Report the steps that were still running when a turn was ended by error,
+    innermost first.
+    """
+    for event in reversed(events):
+        if event is not None:
+            step_exited(tracer, event, error)
+
+
+@dataclass
+class StepStats:
+    executed: int = 0
+    replayed: int = 0
+    errors: int = 0
+    total_time: float = 0.0
+    max_time: float = 0.0
+    max_depth: int = 0
+
+    @property
+    def mean_time(self) -> float:
+        return self.total_time / self.executed if self.executed else 0.0
+
+
+class AggregatingTracer(Tracer):
+    """
+    Aggregates the steps by name and version: how many times they were executed
+    and replayed, how many ended by an error other than waiting for the client,
+    the time they took, and the deepest they ran.
+    """
+
+    def __init__(self) -> None:
+        self._stats: Dict[Tuple[str, str], StepStats] = {}
+        self._lock = Lock()
+
+    def exit(self, event: StepEvent) -> None:
+        with self._lock:
+            stats = self._stats.get((event.name, event.version))
+            if stats is None:
+                stats = self._stats[(event.name, event.version)] = StepStats()
+            stats.max_depth = max(stats.max_depth, event.depth)
+            if event.replayed:
+                stats.replayed += 1
+                return
+
+            duration = event.duration
+            stats.executed += 1
+            stats.total_time += duration
+            stats.max_time = max(stats.max_time, duration)
+            if event.error is not None and not isinstance(event.error, SendToClientException):
+                stats.errors += 1
+
+    def stats(self) -> Dict[Tuple[str, str], StepStats]:
+        with self._lock:
+            return {key: StepStats(**vars(stats)) for key, stats in self._stats.items()}
+
+    def reset(self) -> None:
+        with self._lock:
+            self._stats.clear()
+
+    def report(self) -> str:
+        """
+        A table of the steps, slowest in total first.
+        """
+        lines = [
+            f"{'step':<40} {'executed':>9} {'replayed':>9} {'errors':>7} "
+            f"{'total ms':>10} {'mean ms':>9} {'max ms':>9}"
+        ]
+        stats = sorted(self.stats().items(), key=lambda item: -item[1].total_time)
+        for (name, version), step_stats in stats:
+            lines.append(
+                f"{name + ' ' + version:<40} {step_stats.executed:>9} {step_stats.replayed:>9} "
+                f"{step_stats.errors:>7} {step_stats.total_time * 1000:>10.3f} "
+                f"{step_stats.mean_time * 1000:>9.3f} {step_stats.max_time * 1000:>9.3f}"
+            )
+        return "\n".join(lines)
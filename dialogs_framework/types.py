@@ -1,10 +1,24 @@
 import inspect
 import asyncio
-
-from typing import Generic, TypeVar, Callable, List, Generator, Union, Awaitable, AsyncGenerator
+import functools
+
+from typing import (
+    Any,
+    Generic,
+    TypeVar,
+    Callable,
+    List,
+    Generator,
+    Optional,
+    Union,
+    Awaitable,
+    AsyncGenerator,
+)
 from typing_extensions import Protocol, Literal
 from dataclasses import dataclass
 
+from .symbols import dialog_symbols
+
 T = TypeVar("T", covariant=True)
 ServerMessage = TypeVar("ServerMessage", contravariant=True)
 
@@ -26,6 +40,50 @@ class send_message(BaseDialog[None], Generic[ServerMessage]):
     version: str = "1.0"
 
 
+@dataclass
+class checkpoint(BaseDialog[T]):
+    """
+    Marks a point from which a dialog can be resumed, carrying value.
+
+    When a checkpoint runs, the states of all the preceding steps of the dialog
+    are folded into a single state holding only value, so the state of a dialog
+    that loops through a checkpoint does not grow from one iteration to the next.
+
+    On replay, the steps before the checkpoint that ran last are skipped, and it
+    returns its value. Everything the rest of the dialog needs must therefore
+    pass through value. A dialog with several checkpoints must give each a
+    different label, which is how replay tells which of them ran last, or it
+    raises a DialogStateException.
+
+    The state keeps a copy of value, and replay returns a copy of it, so the
+    dialog may change the value it gets back.
+    """
+
+    value: T = None  # type: ignore
+    name: str = "checkpoint"
+    version: str = "1.0"
+    label: str = ""
+
+    def __post_init__(self) -> None:
+        if self.label:
+            self.name = f"{checkpoint.name}:{self.label}"
+
+
+def is_checkpoint_name(name: str) -> bool:
+    return name == checkpoint.name or name.startswith(f"{checkpoint.name}:")
+
+
+def checkpoint_renamed(step: BaseDialog, state_name: str) -> bool:
+    """
+    Whether step replaces a checkpoint, or a checkpoint replaces the step, in a state
+    named state_name. Other steps are matched by version only, but a checkpoint with
+    another label holds another value.
+    """
+    return step.name != state_name and (
+        isinstance(step, checkpoint) or is_checkpoint_name(state_name)
+    )
+
+
 @dataclass(frozen=True)
 class Dialog(BaseDialog[T]):
     dialog: Callable[[], T]
@@ -45,6 +103,8 @@ class AsyncDialog(BaseDialog[T]):
     dialog: Callable[[], Awaitable[T]]
     version: str
     name: str
+    timeout: Optional[float] = None
+    timeout_result: Any = None
 
 
 @dataclass(frozen=True)
@@ -52,6 +112,8 @@ class AsyncGenDialog(BaseDialog[T]):
     dialog: Callable[[], AsyncGenerator[BaseDialog[T], T]]
     version: str
     name: str
+    timeout: Optional[float] = None
+    timeout_result: Any = None
 
 
 class SendToClientException(Exception):
@@ -68,7 +130,7 @@ class VersionMismatchException(Exception):
     pass
 
 
-def dialog(version: str = "1.0"):
+def dialog(version: str = "1.0", timeout: Optional[float] = None, timeout_result: Any = None):
     """
     This decorator wraps any function and turns it into a dialog, i.e.
     an object you can call with run(), for dialogs or yield for generator dialogs.
@@ -77,25 +139,49 @@ def dialog(version: str = "1.0"):
     packaged as a closure inside a Dialog class. This is necessary
     because we do not want the function to run immediately, but only
     when called by run().
+
+    Async dialogs can be given a timeout in seconds. A step that runs longer is
+    cancelled, and returns timeout_result instead, which is saved as its result.
     """
 
     def decorator(
         f: Callable[..., T]
     ) -> Callable[..., Union[Dialog[T], GenDialog[T], AsyncGenDialog[T], AsyncDialog[T]]]:
+        # Use the same copies as the states, so comparing them is an identity check
+        name = dialog_symbols.canonical(f.__name__)
+        canonical_version = dialog_symbols.canonical(version)
+        is_async = inspect.isasyncgenfunction(f) or asyncio.iscoroutinefunction(f)
+        if timeout is not None and not is_async:
+            raise ValueError("Only async dialogs can have a timeout")
+
+        # wraps also lets the decorated function be pickled by reference
+        @functools.wraps(f)
         def wrapper(*args, **kwargs):
             def f_closure() -> T:
                 return f(*args, **kwargs)
 
             if inspect.isasyncgenfunction(f):
-                return AsyncGenDialog(version=version, name=f.__name__, dialog=f_closure)
+                return AsyncGenDialog(
+                    version=canonical_version,
+                    name=name,
+                    dialog=f_closure,
+                    timeout=timeout,
+                    timeout_result=timeout_result,
+                )
 
             if asyncio.iscoroutinefunction(f):
-                return AsyncDialog(version=version, name=f.__name__, dialog=f_closure)
+                return AsyncDialog(
+                    version=canonical_version,
+                    name=name,
+                    dialog=f_closure,
+                    timeout=timeout,
+                    timeout_result=timeout_result,
+                )
 
             if inspect.isgeneratorfunction(f):
-                return GenDialog(version=version, name=f.__name__, dialog=f_closure)
+                return GenDialog(version=canonical_version, name=name, dialog=f_closure)
 
-            return Dialog(version=version, name=f.__name__, dialog=f_closure)
+            return Dialog(version=canonical_version, name=name, dialog=f_closure)
 
         return wrapper
 
@@ -122,3 +208,23 @@ class DialogStepNotDone(Generic[ServerMessage]):
 
 class DialogStateException(Exception):
     pass
+
+
+class StaleStateException(Exception):
+    """
+    Raised when saving a state that was loaded at an older revision than the
+    stored one, because another turn of the conversation was saved meanwhile.
+    """
+
+
+class DialogTimeoutException(Exception):
+    """
+    Raised by run_async_gen_dialog when a turn runs past its deadline.
+
+    messages holds the messages the turn sent before it was cancelled, if they
+    were flushed, and is empty otherwise.
+    """
+
+    def __init__(self, messages: Optional[List[Any]] = None):
+        super().__init__("The turn ran past its deadline")
+        self.messages = messages or []
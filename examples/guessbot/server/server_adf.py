@@ -1,13 +1,17 @@
 import asyncio
 from random import randrange
 from fastapi import FastAPI
-from collections import defaultdict
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from dialogs_framework import (
+    DialogMetrics,
+    set_metrics,
     dialog,
-    InMemoryPersistence,
+    KeyedInMemoryPersistence,
     run_async_gen_dialog,
+    stream_async_gen_dialog,
     send_message,
     get_client_response,
+    checkpoint,
 )
 
 
@@ -16,12 +20,14 @@ async def sleep_a_bit(how_much):
     await asyncio.sleep(how_much)
 
 
-@dialog(version="1.1")
+@dialog(version="1.2")
 def game():
     yield send_message("Guess a number between 1 and 10.")
     correct_number = yield rand()
 
     while True:
+        # keeps the state from growing with every wrong guess
+        correct_number = yield checkpoint(correct_number)
         guess = yield get_client_response()
         if int(guess) == correct_number:
             yield sleep_a_bit(1)
@@ -39,15 +45,38 @@ def rand():
 
 
 app = FastAPI()
-state = defaultdict(InMemoryPersistence)
+# Chats that are idle for an hour are forgotten
+store = KeyedInMemoryPersistence(ttl=3600)
+metrics = DialogMetrics()
+set_metrics(metrics)
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    return metrics.render()
 
 
 @app.post("/async")
 async def next_message(message, chat_id):
-    persistence = state[chat_id]
+    # The in-memory store does no I/O, so it is called from the event loop directly.
+    # Stores that do, such as SqlitePersistence, are wrapped in a ThreadPoolPersistence.
+    persistence = store.for_conversation(chat_id)
 
     next_step = await run_async_gen_dialog(game(), persistence, message)
     return next_step.messages
 
 
+@app.post("/async/stream")
+async def stream_messages(message, chat_id):
+    # Each message is sent as a line as soon as it is sent, instead of at the end of the turn
+    persistence = store.for_conversation(chat_id)
+
+    async def lines():
+        async for item in stream_async_gen_dialog(game(), persistence, message):
+            if isinstance(item, str):
+                yield item + "\n"
+
+    return StreamingResponse(lines(), media_type="text/plain")
+
+
 subdialog_states = []
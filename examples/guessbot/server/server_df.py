@@ -1,11 +1,13 @@
 from random import randrange
 from fastapi import FastAPI
-from collections import defaultdict
+from fastapi.responses import PlainTextResponse
 from dialogs_framework import (
+    DialogMetrics,
+    set_metrics,
     dialog,
-    InMemoryPersistence,
+    KeyedInMemoryPersistence,
     run,
-    run_dialog,
+    run_dialog_in_executor,
     send_message,
     get_client_response,
 )
@@ -32,14 +34,24 @@ def rand():
 
 
 app = FastAPI()
-state = defaultdict(InMemoryPersistence)
+# Chats that are idle for an hour are forgotten
+store = KeyedInMemoryPersistence(ttl=3600)
+metrics = DialogMetrics()
+set_metrics(metrics)
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    return metrics.render()
 
 
 @app.post("/")
 async def next_message(message, chat_id):
-    persistence = state[chat_id]
+    persistence = store.for_conversation(chat_id)
 
-    next_step = run_dialog(game(), persistence, message)
+    # The sync engine runs in a thread pool, so it does not block the event loop, and
+    # the turns of a chat run one at a time, since they change the same state
+    next_step = await run_dialog_in_executor(game(), persistence, message, conversation_id=chat_id)
     return next_step.messages
 
 
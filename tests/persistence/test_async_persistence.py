@@ -0,0 +1,98 @@
+import asyncio
+import threading
+import time
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from dialogs_framework.types import dialog, send_message, get_client_response, BaseDialog
+from dialogs_framework.persistence.in_memory import InMemoryPersistence
+from dialogs_framework.persistence.async_persistence import (
+    AsyncPersistenceProvider,
+    ThreadPoolPersistence,
+)
+from dialogs_framework.dialog_state import DialogState, new_empty_state
+from dialogs_framework.async_gen_dialogs import run_async_gen_dialog
+
+
+class AsyncInMemoryPersistence(AsyncPersistenceProvider):
+    def __init__(self):
+        self.state: Optional[DialogState] = None
+        self.saves = 0
+
+    async def save_state(self, state: DialogState) -> None:
+        await asyncio.sleep(0)
+        self.saves += 1
+        self.state = state
+
+    async def get_state(self, dialog: BaseDialog) -> DialogState:
+        await asyncio.sleep(0)
+        return self.state if self.state else new_empty_state(dialog)
+
+
+class SlowPersistence(InMemoryPersistence):
+    def get_state(self, dialog):
+        self.thread = threading.get_ident()
+        time.sleep(0.1)
+        return super().get_state(dialog)
+
+
+@dialog(version="1.0")
+def short_dialog():
+    yield send_message("What's your name?")
+    name = yield get_client_response()
+    return name
+
+
+@pytest.mark.asyncio
+async def test_async_persistence_provider():
+    persistence = AsyncInMemoryPersistence()
+    step1 = await run_async_gen_dialog(short_dialog(), persistence, "")
+    assert step1.messages == ["What's your name?"]
+
+    step2 = await run_async_gen_dialog(short_dialog(), persistence, "Johnny")
+    assert step2.return_value == "Johnny"
+
+    await run_async_gen_dialog(short_dialog(), persistence, "Again?")
+    assert persistence.saves == 2
+
+
+@pytest.mark.asyncio
+async def test_thread_pool_persistence_runs_provider_in_thread():
+    sync_persistence = SlowPersistence()
+    persistence = ThreadPoolPersistence(sync_persistence)
+
+    await run_async_gen_dialog(short_dialog(), persistence, "")
+    step = await run_async_gen_dialog(short_dialog(), persistence, "Johnny")
+
+    assert step.return_value == "Johnny"
+    assert sync_persistence.thread != threading.get_ident()
+
+
+@pytest.mark.asyncio
+async def test_thread_pool_persistence_does_not_block_event_loop():
+    conversations = [ThreadPoolPersistence(SlowPersistence()) for _ in range(5)]
+
+    start = time.monotonic()
+    steps = await asyncio.gather(
+        *(run_async_gen_dialog(short_dialog(), persistence, "") for persistence in conversations)
+    )
+
+    assert all(step.messages == ["What's your name?"] for step in steps)
+    assert time.monotonic() - start < 0.3
+
+
+@pytest.mark.asyncio
+async def test_thread_pool_persistence_is_bounded_by_executor():
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        conversations = [ThreadPoolPersistence(SlowPersistence(), executor) for _ in range(3)]
+
+        start = time.monotonic()
+        await asyncio.gather(
+            *(
+                run_async_gen_dialog(short_dialog(), persistence, "")
+                for persistence in conversations
+            )
+        )
+
+        assert time.monotonic() - start >= 0.3
@@ -1,5 +1,10 @@
-from dialogs_framework.types import dialog
-from dialogs_framework.persistence.in_memory import InMemoryPersistence
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+from dialogs_framework.types import dialog, send_message, get_client_response
+from dialogs_framework.persistence.in_memory import InMemoryPersistence, KeyedInMemoryPersistence
+from dialogs_framework.gen_dialogs import run_gen_dialog
 from dialogs_framework.dialog_state import new_empty_state, DialogState
 
 
@@ -23,3 +28,203 @@ def test_get_empty_state():
     persistence = InMemoryPersistence()
 
     assert persistence.get_state(some_dialog()) == new_empty_state(some_dialog())
+
+
+@dialog(version="1.0")
+def name_dialog():
+    yield send_message("What's your name?")
+    name = yield get_client_response()
+    return name
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def start_conversation(store, conversation_id):
+    run_gen_dialog(name_dialog(), store.for_conversation(conversation_id), "")
+
+
+def test_keyed_store_keeps_conversations_apart():
+    store = KeyedInMemoryPersistence()
+    start_conversation(store, "a")
+    start_conversation(store, "b")
+
+    step = run_gen_dialog(name_dialog(), store.for_conversation("a"), "Johnny")
+
+    assert step.return_value == "Johnny"
+    assert len(store) == 2
+    assert store.stats().hits == 1
+    assert store.stats().misses == 2
+
+
+def test_keyed_store_evicts_least_recently_used():
+    evicted = []
+    store = KeyedInMemoryPersistence(
+        shards=1, max_entries=2, on_evict=lambda key, state: evicted.append(key)
+    )
+    start_conversation(store, "a")
+    start_conversation(store, "b")
+    store.get_state("a", name_dialog())
+    start_conversation(store, "c")
+
+    assert evicted == ["b"]
+    assert store.stats().evictions == 1
+    assert len(store) == 2
+
+
+def test_keyed_store_evicts_idle_conversations():
+    clock = FakeClock()
+    store = KeyedInMemoryPersistence(shards=1, ttl=10, clock=clock)
+    start_conversation(store, "a")
+    clock.now = 11
+
+    step = run_gen_dialog(name_dialog(), store.for_conversation("a"), "Johnny")
+
+    assert step.messages == ["What's your name?"]
+    assert store.stats().evictions == 1
+
+
+def test_keyed_store_byte_budget():
+    store = KeyedInMemoryPersistence(shards=1, max_bytes=1, sizer=lambda state: 10)
+    start_conversation(store, "a")
+    start_conversation(store, "b")
+
+    assert len(store) == 1
+    assert store.stats().size == 10
+
+
+def test_keyed_store_default_sizer_estimates_state_size():
+    store = KeyedInMemoryPersistence(shards=1, max_bytes=10_000)
+    start_conversation(store, "a")
+
+    assert 0 < store.stats().size < 10_000
+
+
+@dialog(version="1.0")
+def today():
+    return date(2021, 5, 1)
+
+
+@dialog(version="1.0")
+def date_dialog():
+    day = yield today()
+    yield send_message(f"Today is {day}")
+    yield get_client_response()
+
+
+def test_keyed_store_byte_budget_saves_any_value():
+    store = KeyedInMemoryPersistence(shards=1, max_bytes=10_000)
+    step = run_gen_dialog(date_dialog(), store.for_conversation("a"), "")
+
+    assert step.messages == ["Today is 2021-05-01"]
+    assert store.stats().size > 0
+
+
+def test_keyed_store_failing_sizer_does_not_fail_save():
+    def sizer(state):
+        raise TypeError("cannot measure")
+
+    store = KeyedInMemoryPersistence(shards=1, max_bytes=10_000, sizer=sizer)
+    start_conversation(store, "a")
+
+    assert len(store) == 1
+    assert store.stats().size > 0
+
+
+def test_keyed_store_spills_to_colder_store():
+    cold_store = {}
+    store = KeyedInMemoryPersistence(
+        shards=1,
+        max_entries=1,
+        on_evict=cold_store.__setitem__,
+        on_miss=lambda key: cold_store.pop(key, None),
+    )
+    start_conversation(store, "a")
+    start_conversation(store, "b")
+
+    assert list(cold_store) == ["a"]
+
+    step = run_gen_dialog(name_dialog(), store.for_conversation("a"), "Johnny")
+
+    assert step.return_value == "Johnny"
+    assert list(cold_store) == ["b"]
+
+
+def test_keyed_store_is_thread_safe():
+    store = KeyedInMemoryPersistence(shards=4, max_entries=1000)
+
+    def converse(conversation_id):
+        persistence = store.for_conversation(conversation_id)
+        run_gen_dialog(name_dialog(), persistence, "")
+        return run_gen_dialog(name_dialog(), persistence, conversation_id).return_value
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(converse, range(200)))
+
+    assert results == list(range(200))
+    assert store.stats().hits == 200
+
+
+def test_keyed_store_limits_are_for_the_whole_store():
+    clock = FakeClock()
+    evicted = []
+    store = KeyedInMemoryPersistence(
+        shards=16, max_entries=4, clock=clock, on_evict=lambda key, state: evicted.append(key)
+    )
+    for conversation_id in range(10):
+        clock.now += 1
+        start_conversation(store, conversation_id)
+
+    assert len(store) == 4
+    assert evicted == list(range(6))
+
+
+def test_keyed_store_byte_budget_is_for_the_whole_store():
+    store = KeyedInMemoryPersistence(shards=16, max_bytes=25, sizer=lambda state: 10)
+    for conversation_id in range(10):
+        start_conversation(store, conversation_id)
+
+    assert len(store) == 2
+    assert store.stats().size == 20
+
+
+@dialog(version="1.0")
+def failing_dialog():
+    yield send_message("What's your name?")
+    name = yield get_client_response()
+    yield send_message(f"Hi {name}")
+    raise ValueError(name)
+
+
+def test_keyed_store_keeps_state_of_failed_turn():
+    store = KeyedInMemoryPersistence()
+    persistence = store.for_conversation("a")
+    run_gen_dialog(failing_dialog(), persistence, "")
+
+    with pytest.raises(ValueError):
+        run_gen_dialog(failing_dialog(), persistence, "Johnny")
+
+    state = store.get_state("a", failing_dialog())
+    assert len(state.subdialogs[0].subdialogs) == 2
+    assert not state.subdialogs[0].subdialogs[-1].is_done
+
+
+def test_keyed_store_without_copies_returns_stored_state():
+    store = KeyedInMemoryPersistence(copy_states=False)
+    start_conversation(store, "a")
+
+    assert store.get_state("a", name_dialog()) is store.get_state("a", name_dialog())
+
+
+def test_keyed_store_returns_copies():
+    store = KeyedInMemoryPersistence()
+    start_conversation(store, "a")
+
+    state = store.get_state("a", name_dialog())
+    assert state is not store.get_state("a", name_dialog())
+    assert state == store.get_state("a", name_dialog())
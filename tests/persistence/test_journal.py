@@ -0,0 +1,251 @@
+import os
+import time
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+
+from dialogs_framework.types import (
+    dialog,
+    send_message,
+    get_client_response,
+    checkpoint,
+    StaleStateException,
+)
+from dialogs_framework.dialog_state import state_to_dict
+from dialogs_framework.persistence.journal import JournalPersistence
+from dialogs_framework.persistence.in_memory import InMemoryPersistence
+from dialogs_framework.gen_dialogs import run_gen_dialog
+
+from ..test_gen_dialogs import (
+    topic_dialog,
+    name_getter_dialog,
+    name_getter_dialog_take_2,
+    fallback_with_client_response,
+)
+
+
+@dialog(version="1.0")
+def looping_dialog():
+    count = 0
+    while True:
+        count = yield checkpoint(count)
+        yield send_message(f"turn {count}")
+        yield get_client_response()
+        count += 1
+
+
+@dialog(version="1.0")
+def growing_dialog():
+    answers = []
+    while True:
+        yield send_message("Tell me more.")
+        answers.append((yield get_client_response()))
+        if answers[-1] == "bye":
+            return answers
+
+
+def converse(store, conversation_id, dialog, responses):
+    persistence = store.for_conversation(conversation_id)
+    return [run_gen_dialog(dialog(), persistence, response) for response in responses]
+
+
+def log_size(directory):
+    return sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+
+
+@pytest.mark.parametrize("snapshot_every", [1, 3, 100])
+def test_states_match_in_memory_persistence(tmp_path, snapshot_every):
+    store = JournalPersistence(str(tmp_path), snapshot_every=snapshot_every)
+    in_memory = InMemoryPersistence()
+    for response in ["", "a", "b", "c", "d", "e", "f", "g"]:
+        run_gen_dialog(growing_dialog(), in_memory, response)
+        run_gen_dialog(growing_dialog(), store.for_conversation("chat"), response)
+
+        state = store.get_state("chat", growing_dialog())
+        assert state_to_dict(state) == state_to_dict(in_memory.state)
+
+
+def test_states_survive_restart(tmp_path):
+    store = JournalPersistence(str(tmp_path), snapshot_every=4)
+    converse(store, "chat", looping_dialog, [""] * 10)
+    store.close()
+
+    store = JournalPersistence(str(tmp_path), snapshot_every=4)
+    [step] = converse(store, "chat", looping_dialog, [""])
+
+    assert step.messages == ["turn 10"]
+
+
+def test_ids_of_different_types_are_separate(tmp_path):
+    store = JournalPersistence(str(tmp_path))
+    for conversation_id in [1, "1", "#int:1"]:
+        converse(store, conversation_id, looping_dialog, [""] * 2)
+    converse(store, 1, looping_dialog, [""])
+    store.close()
+
+    store = JournalPersistence(str(tmp_path))
+    steps = [
+        converse(store, conversation_id, looping_dialog, [""])[0]
+        for conversation_id in [1, "1", "#int:1"]
+    ]
+
+    assert [step.messages for step in steps] == [["turn 3"], ["turn 2"], ["turn 2"]]
+
+
+def test_deltas_are_smaller_than_snapshots(tmp_path):
+    snapshots = JournalPersistence(str(tmp_path / "snapshots"), shards=1, snapshot_every=1)
+    deltas = JournalPersistence(str(tmp_path / "deltas"), shards=1, snapshot_every=100)
+    converse(snapshots, "chat", growing_dialog, ["x"] * 100)
+    converse(deltas, "chat", growing_dialog, ["x"] * 100)
+
+    assert log_size(tmp_path / "deltas") < log_size(tmp_path / "snapshots") / 4
+
+
+def test_torn_tail_record_is_ignored(tmp_path):
+    store = JournalPersistence(str(tmp_path), shards=1)
+    converse(store, "chat", topic_dialog, ["", "Johnny"])
+    store.close()
+    path = str(tmp_path / "shard-0.log")
+    whole_size = os.path.getsize(path)
+
+    store = JournalPersistence(str(tmp_path), shards=1)
+    converse(store, "chat", topic_dialog, ["Peanuts"])
+    store.close()
+    # Simulate a crash in the middle of writing the last record
+    with open(path, "r+b") as log:
+        log.truncate(os.path.getsize(path) - 3)
+
+    store = JournalPersistence(str(tmp_path), shards=1)
+
+    assert os.path.getsize(path) == whole_size
+    [step] = converse(store, "chat", topic_dialog, ["Peanuts"])
+    assert step.return_value == ("Johnny", "Peanuts")
+
+
+def test_corrupted_tail_record_is_ignored(tmp_path):
+    store = JournalPersistence(str(tmp_path), shards=1)
+    converse(store, "chat", topic_dialog, ["", "Johnny"])
+    store.close()
+    with open(str(tmp_path / "shard-0.log"), "ab") as log:
+        log.write(b"\x10\x00\x00\x00garbage garbage garbage")
+
+    store = JournalPersistence(str(tmp_path), shards=1)
+    [step] = converse(store, "chat", topic_dialog, ["Peanuts"])
+
+    assert step.return_value == ("Johnny", "Peanuts")
+
+
+def test_compaction_reclaims_space(tmp_path):
+    store = JournalPersistence(str(tmp_path), shards=1, retain_finished=False)
+    converse(store, "looping", looping_dialog, [""] * 20)
+    converse(store, "finished", topic_dialog, ["", "Johnny", "Peanuts"])
+    converse(store, "deleted", topic_dialog, [""])
+    store.delete("deleted")
+    size = log_size(tmp_path)
+
+    store.compact()
+
+    assert log_size(tmp_path) < size / 2
+    [step] = converse(store, "looping", looping_dialog, [""])
+    assert step.messages == ["turn 20"]
+    [step] = converse(store, "finished", topic_dialog, [""])
+    assert not step.is_done
+    [step] = converse(store, "deleted", topic_dialog, [""])
+    assert not step.is_done
+
+
+def test_compaction_retains_finished_conversations(tmp_path):
+    store = JournalPersistence(str(tmp_path), shards=1)
+    converse(store, "finished", topic_dialog, ["", "Johnny", "Peanuts"])
+
+    store.compact()
+    store.close()
+    store = JournalPersistence(str(tmp_path), shards=1)
+
+    [step] = converse(store, "finished", topic_dialog, [""])
+    assert step.return_value == ["Johnny", "Peanuts"]
+
+
+def test_background_compaction(tmp_path):
+    uncompacted = JournalPersistence(str(tmp_path / "uncompacted"), shards=1, snapshot_every=2)
+    store = JournalPersistence(
+        str(tmp_path / "compacted"), shards=1, snapshot_every=2, compaction_interval=0.01
+    )
+    converse(uncompacted, "chat", growing_dialog, ["x"] * 30)
+    converse(store, "chat", growing_dialog, ["x"] * 30)
+
+    time.sleep(0.1)
+
+    assert log_size(tmp_path / "compacted") < log_size(tmp_path / "uncompacted") / 2
+    [step] = converse(store, "chat", growing_dialog, ["bye"])
+    assert len(step.return_value) == 30
+    store.close()
+
+
+def test_concurrent_conversations(tmp_path):
+    store = JournalPersistence(str(tmp_path), snapshot_every=3)
+
+    def talk(conversation_id):
+        steps = converse(store, conversation_id, growing_dialog, ["", "a", "b", "bye"])
+        return steps[-1].return_value
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(talk, range(32)))
+
+    assert results == [["a", "b", "bye"]] * 32
+
+
+def test_stale_save_raises(tmp_path):
+    store = JournalPersistence(str(tmp_path), check_revisions=True)
+    converse(store, "chat", topic_dialog, [""])
+    first = store.get_state("chat", topic_dialog())
+    second = store.get_state("chat", topic_dialog())
+
+    store.save_state("chat", first)
+
+    with pytest.raises(StaleStateException):
+        store.save_state("chat", second)
+
+
+def test_revisions_survive_compaction_and_restart(tmp_path):
+    store = JournalPersistence(str(tmp_path), check_revisions=True)
+    converse(store, "chat", topic_dialog, ["", "Johnny"])
+    state = store.get_state("chat", topic_dialog())
+
+    store.compact()
+    store.close()
+    store = JournalPersistence(str(tmp_path), check_revisions=True)
+
+    store.save_state("chat", state)
+    assert store.get_state("chat", topic_dialog()).revision == 3
+
+
+@pytest.mark.parametrize("check_revisions", [False, True])
+def test_version_bump(tmp_path, check_revisions):
+    store = JournalPersistence(str(tmp_path), check_revisions=check_revisions)
+    persistence = store.for_conversation("chat")
+    run_gen_dialog(name_getter_dialog(), persistence, "")
+
+    step = run_gen_dialog(name_getter_dialog_take_2(), persistence, "Johnny")
+    assert step.messages == ["Tell me your name! Now!!!"]
+
+    step = run_gen_dialog(name_getter_dialog_take_2(), persistence, "Johnny")
+    assert step.return_value == "Johnny"
+
+
+def test_version_bump_with_fallback(tmp_path):
+    store = JournalPersistence(str(tmp_path))
+    persistence = store.for_conversation("chat")
+    fallback = fallback_with_client_response
+    run_gen_dialog(name_getter_dialog(), persistence, "", fallback())
+
+    step = run_gen_dialog(name_getter_dialog_take_2(), persistence, "Juanito", fallback())
+    assert step.messages == ["Falling back!"]
+
+    step = run_gen_dialog(name_getter_dialog_take_2(), persistence, "Julia", fallback())
+    assert step.messages == ["Get up fool", "Tell me your name! Now!!!"]
+
+    # the conversation is rebuilt from the log after a restart
+    store.close()
+    persistence = JournalPersistence(str(tmp_path)).for_conversation("chat")
+    step = run_gen_dialog(name_getter_dialog_take_2(), persistence, "Johnny", fallback())
+    assert step.return_value == "Johnny"
@@ -0,0 +1,192 @@
+import pytest
+from typing import List, Tuple
+
+from dialogs_framework.types import (
+    dialog,
+    send_message,
+    get_client_response,
+    checkpoint,
+    StaleStateException,
+)
+from dialogs_framework.persistence.in_memory import InMemoryPersistence
+from dialogs_framework.dialog_state import DialogState, StateChanges, _state_changes
+from dialogs_framework.dialogs import run_dialog, run
+from dialogs_framework.gen_dialogs import run_gen_dialog
+from dialogs_framework.async_gen_dialogs import run_async_gen_dialog
+from dialogs_framework.compact_state import new_compact_state
+
+
+class RecordingPersistence(InMemoryPersistence):
+    def __init__(self):
+        super().__init__()
+        self.saves: List[Tuple[List[str], List[str]]] = []
+        self.full_saves = 0
+
+    def save_state(self, state: DialogState) -> None:
+        self.full_saves += 1
+        super().save_state(state)
+
+    def save_changes(self, state: DialogState, changes: StateChanges) -> None:
+        self.saves.append(([s.name for s in changes.created], [s.name for s in changes.updated]))
+        super().save_changes(state, changes)
+
+
+@dialog(version="1.0")
+def short_dialog():
+    yield send_message("What's your name?")
+    name = yield get_client_response()
+    return name
+
+
+@dialog(version="1.0")
+def short_run_dialog():
+    run(send_message("What's your name?"))
+    return run(get_client_response())
+
+
+@dialog(version="1.0")
+def looping_dialog():
+    count = 0
+    while True:
+        count = yield checkpoint(count)
+        yield get_client_response()
+        count += 1
+
+
+def test_save_changes_records_created_and_updated_states():
+    persistence = RecordingPersistence()
+    run_gen_dialog(short_dialog(), persistence, "")
+
+    created, updated = persistence.saves[0]
+    assert created == ["short_dialog", "send_message", "get_client_response"]
+    assert updated == []
+
+    run_gen_dialog(short_dialog(), persistence, "Johnny")
+
+    created, updated = persistence.saves[1]
+    assert created == []
+    assert updated == ["get_client_response", "short_dialog"]
+
+
+def test_save_changes_records_folded_checkpoints():
+    persistence = RecordingPersistence()
+    run_gen_dialog(looping_dialog(), persistence, "")
+    run_gen_dialog(looping_dialog(), persistence, "")
+
+    created, updated = persistence.saves[1]
+    assert created == ["checkpoint", "get_client_response"]
+    assert updated == ["get_client_response", "looping_dialog"]
+
+
+@dialog(version="1.0")
+def failing_dialog():
+    yield send_message("What's your name?")
+    raise ValueError("failed")
+
+
+def test_failed_turn_stops_tracking_changes():
+    with pytest.raises(ValueError):
+        run_gen_dialog(failing_dialog(), RecordingPersistence(), "")
+
+    assert _state_changes.get() is None
+
+
+def test_done_dialog_is_not_saved_again():
+    persistence = RecordingPersistence()
+    run_gen_dialog(short_dialog(), persistence, "")
+    run_gen_dialog(short_dialog(), persistence, "Johnny")
+
+    step = run_gen_dialog(short_dialog(), persistence, "Again?")
+
+    assert step.return_value == "Johnny"
+    assert len(persistence.saves) == 2
+    assert persistence.full_saves == 2
+
+
+def test_done_run_dialog_is_not_saved_again():
+    persistence = RecordingPersistence()
+    run_dialog(short_run_dialog(), persistence, "")
+    run_dialog(short_run_dialog(), persistence, "Johnny")
+
+    run_dialog(short_run_dialog(), persistence, "Again?")
+
+    assert len(persistence.saves) == 2
+
+
+@pytest.mark.asyncio
+async def test_done_async_gen_dialog_is_not_saved_again():
+    persistence = RecordingPersistence()
+    await run_async_gen_dialog(short_dialog(), persistence, "")
+    await run_async_gen_dialog(short_dialog(), persistence, "Johnny")
+
+    await run_async_gen_dialog(short_dialog(), persistence, "Again?")
+
+    assert len(persistence.saves) == 2
+
+
+def test_compact_state_is_saved_every_turn():
+    persistence = RecordingPersistence()
+    persistence.state = new_compact_state(short_dialog())
+    run_gen_dialog(short_dialog(), persistence, "")
+    run_gen_dialog(short_dialog(), persistence, "Johnny")
+    run_gen_dialog(short_dialog(), persistence, "Again?")
+
+    assert persistence.saves == []
+    assert persistence.full_saves == 3
+
+
+class StalePersistence(InMemoryPersistence):
+    """
+    Fails the first saves, as if another turn was saved meanwhile.
+    """
+
+    def __init__(self, stale_saves):
+        super().__init__()
+        self.stale_saves = stale_saves
+        self.loads = 0
+
+    def get_state(self, dialog):
+        self.loads += 1
+        return super().get_state(dialog)
+
+    def save_state(self, state):
+        if self.stale_saves:
+            self.stale_saves -= 1
+            self.state = None
+            raise StaleStateException()
+        super().save_state(state)
+
+
+def test_stale_save_reruns_turn():
+    persistence = StalePersistence(stale_saves=2)
+
+    step = run_gen_dialog(short_dialog(), persistence, "")
+
+    assert step.messages == ["What's your name?"]
+    assert persistence.loads == 3
+
+
+def test_stale_save_gives_up_after_retries():
+    persistence = StalePersistence(stale_saves=2)
+
+    with pytest.raises(StaleStateException):
+        run_gen_dialog(short_dialog(), persistence, "", stale_retries=1)
+
+
+def test_stale_save_reruns_run_dialog_turn():
+    persistence = StalePersistence(stale_saves=1)
+
+    step = run_dialog(short_run_dialog(), persistence, "")
+
+    assert step.messages == ["What's your name?"]
+    assert persistence.loads == 2
+
+
+@pytest.mark.asyncio
+async def test_stale_save_reruns_async_gen_dialog_turn():
+    persistence = StalePersistence(stale_saves=1)
+
+    step = await run_async_gen_dialog(short_dialog(), persistence, "")
+
+    assert step.messages == ["What's your name?"]
+    assert persistence.loads == 2
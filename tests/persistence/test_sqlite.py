@@ -0,0 +1,229 @@
+import os
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+
+from dialogs_framework.types import dialog, send_message, get_client_response, StaleStateException
+from dialogs_framework.persistence.sqlite import SqlitePersistence
+from dialogs_framework.persistence.async_persistence import ThreadPoolPersistence
+from dialogs_framework.state_codecs import JsonStateCodec
+from dialogs_framework.gen_dialogs import run_gen_dialog
+from dialogs_framework.async_gen_dialogs import run_async_gen_dialog
+from dialogs_framework.dialogs import run_dialog
+
+from .. import test_dialogs as dialogs, test_gen_dialogs as gen_dialogs
+
+
+@dialog(version="1.0")
+def short_dialog():
+    yield send_message("What's your name?")
+    name = yield get_client_response()
+    return name
+
+
+@pytest.fixture
+def database_path(tmp_path):
+    return str(tmp_path / "dialogs.db")
+
+
+def test_states_survive_restart(database_path):
+    store = SqlitePersistence(database_path)
+    run_gen_dialog(short_dialog(), store.for_conversation("chat-1"), "")
+    store.close()
+
+    store = SqlitePersistence(database_path)
+    step = run_gen_dialog(short_dialog(), store.for_conversation("chat-1"), "Johnny")
+    store.close()
+
+    assert step.return_value == "Johnny"
+
+
+def test_conversations_are_separate(database_path):
+    store = SqlitePersistence(database_path, codec=JsonStateCodec())
+    run_gen_dialog(short_dialog(), store.for_conversation(1), "")
+    run_gen_dialog(short_dialog(), store.for_conversation(2), "")
+
+    step1 = run_gen_dialog(short_dialog(), store.for_conversation(1), "Johnny")
+    step2 = run_gen_dialog(short_dialog(), store.for_conversation(2), "Julia")
+
+    assert step1.return_value == "Johnny"
+    assert step2.return_value == "Julia"
+
+
+def test_ids_of_different_types_are_separate(database_path):
+    store = SqlitePersistence(database_path)
+    run_gen_dialog(short_dialog(), store.for_conversation(1), "")
+    run_gen_dialog(short_dialog(), store.for_conversation("1"), "")
+    run_gen_dialog(short_dialog(), store.for_conversation("#int:1"), "")
+
+    step1 = run_gen_dialog(short_dialog(), store.for_conversation(1), "Johnny")
+    step2 = run_gen_dialog(short_dialog(), store.for_conversation("1"), "Julia")
+    step3 = run_gen_dialog(short_dialog(), store.for_conversation("#int:1"), "Jane")
+
+    assert [step1.return_value, step2.return_value, step3.return_value] == [
+        "Johnny",
+        "Julia",
+        "Jane",
+    ]
+
+
+def test_delete(database_path):
+    store = SqlitePersistence(database_path)
+    run_gen_dialog(short_dialog(), store.for_conversation("chat"), "")
+    store.delete("chat")
+
+    step = run_gen_dialog(short_dialog(), store.for_conversation("chat"), "Johnny")
+
+    assert step.messages == ["What's your name?"]
+
+
+def test_sharding_spreads_conversations(database_path):
+    store = SqlitePersistence(database_path, shards=4)
+    for conversation_id in range(40):
+        run_gen_dialog(short_dialog(), store.for_conversation(conversation_id), "")
+
+    for conversation_id in range(40):
+        step = run_gen_dialog(short_dialog(), store.for_conversation(conversation_id), "Johnny")
+        assert step.return_value == "Johnny"
+
+    root, extension = os.path.splitext(database_path)
+    for shard in range(4):
+        assert os.path.exists(f"{root}-{shard}{extension}")
+    assert len({id(store._locate(i)[1]) for i in range(40)}) == 4
+
+
+@pytest.mark.parametrize("group_commit", [True, False])
+def test_concurrent_saves(database_path, group_commit):
+    store = SqlitePersistence(database_path, pool_size=2, group_commit=group_commit)
+
+    def converse(conversation_id):
+        persistence = store.for_conversation(conversation_id)
+        run_gen_dialog(short_dialog(), persistence, "")
+        return run_gen_dialog(short_dialog(), persistence, f"user {conversation_id}")
+
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        steps = list(executor.map(converse, range(64)))
+
+    assert [step.return_value for step in steps] == [f"user {i}" for i in range(64)]
+
+
+def test_failed_group_commit_raises(database_path):
+    store = SqlitePersistence(database_path)
+    store.shards[0].write = lambda rows: 1 / 0
+
+    with pytest.raises(ZeroDivisionError):
+        run_gen_dialog(short_dialog(), store.for_conversation("chat"), "")
+
+
+def test_in_memory_database_is_rejected():
+    with pytest.raises(ValueError):
+        SqlitePersistence(":memory:")
+
+
+@pytest.mark.asyncio
+async def test_with_async_gen_dialogs(database_path):
+    store = SqlitePersistence(database_path)
+    persistence = ThreadPoolPersistence(store.for_conversation("chat"))
+
+    await run_async_gen_dialog(short_dialog(), persistence, "")
+    step = await run_async_gen_dialog(short_dialog(), persistence, "Johnny")
+
+    assert step.return_value == "Johnny"
+
+
+@dialog(version="1.0")
+def collecting_dialog():
+    answers = []
+    while True:
+        answers.append((yield get_client_response()))
+        if len(answers) == 32:
+            return answers
+
+
+def test_stale_save_raises(database_path):
+    store = SqlitePersistence(database_path, check_revisions=True)
+    run_gen_dialog(short_dialog(), store.for_conversation("chat"), "")
+    first = store.get_state("chat", short_dialog())
+    second = store.get_state("chat", short_dialog())
+
+    store.save_state("chat", first)
+
+    with pytest.raises(StaleStateException):
+        store.save_state("chat", second)
+    assert first.revision == 2
+
+
+@pytest.mark.parametrize("group_commit", [True, False])
+def test_concurrent_turns_of_one_conversation(database_path, group_commit):
+    store = SqlitePersistence(database_path, check_revisions=True, group_commit=group_commit)
+    persistence = store.for_conversation("chat")
+    run_gen_dialog(collecting_dialog(), persistence, "")
+
+    def send(answer):
+        return run_gen_dialog(collecting_dialog(), persistence, answer, stale_retries=100)
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        steps = list(executor.map(send, range(32)))
+
+    [step] = [step for step in steps if step.is_done]
+    assert sorted(step.return_value) == list(range(32))
+
+
+def test_version_bump(database_path):
+    store = SqlitePersistence(database_path)
+    persistence = store.for_conversation("chat")
+    run_gen_dialog(gen_dialogs.name_getter_dialog(), persistence, "")
+
+    step = run_gen_dialog(gen_dialogs.name_getter_dialog_take_2(), persistence, "Johnny")
+    assert step.messages == ["Tell me your name! Now!!!"]
+
+    step = run_gen_dialog(gen_dialogs.name_getter_dialog_take_2(), persistence, "Johnny")
+    assert step.return_value == "Johnny"
+
+
+def test_version_bump_with_fallback(database_path):
+    store = SqlitePersistence(database_path, check_revisions=True)
+    persistence = store.for_conversation("chat")
+    fallback = gen_dialogs.fallback_with_client_response
+    run_gen_dialog(gen_dialogs.name_getter_dialog(), persistence, "", fallback())
+
+    step = run_gen_dialog(
+        gen_dialogs.name_getter_dialog_take_2(), persistence, "Juanito", fallback()
+    )
+    assert step.messages == ["Falling back!"]
+
+    step = run_gen_dialog(gen_dialogs.name_getter_dialog_take_2(), persistence, "Julia", fallback())
+    assert step.messages == ["Get up fool", "Tell me your name! Now!!!"]
+
+    step = run_gen_dialog(
+        gen_dialogs.name_getter_dialog_take_2(), persistence, "Johnny", fallback()
+    )
+    assert step.return_value == "Johnny"
+
+
+def test_run_dialog_version_bump_with_fallback(database_path):
+    persistence = SqlitePersistence(database_path).for_conversation("chat")
+    fallback = dialogs.fallback_without_client_response
+    run_dialog(dialogs.name_getter_dialog(), persistence, "", fallback())
+
+    step = run_dialog(dialogs.name_getter_dialog_take_2(), persistence, "Julia", fallback())
+    assert step.messages == ["Falling back!", "Tell me your name! Now!!!"]
+
+    step = run_dialog(dialogs.name_getter_dialog_take_2(), persistence, "Johnny", fallback())
+    assert step.return_value == "Johnny"
+
+
+@pytest.mark.asyncio
+async def test_async_gen_dialog_version_bump_with_fallback(database_path):
+    persistence = SqlitePersistence(database_path).for_conversation("chat")
+    fallback = gen_dialogs.fallback_without_client_response
+    await run_async_gen_dialog(gen_dialogs.name_getter_dialog(), persistence, "", fallback())
+
+    step = await run_async_gen_dialog(
+        gen_dialogs.name_getter_dialog_take_2(), persistence, "Julia", fallback()
+    )
+    assert step.messages == ["Falling back!", "Tell me your name! Now!!!"]
+
+    step = await run_async_gen_dialog(
+        gen_dialogs.name_getter_dialog_take_2(), persistence, "Johnny", fallback()
+    )
+    assert step.return_value == "Johnny"
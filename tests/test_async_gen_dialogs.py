@@ -1,12 +1,19 @@
 import pytest
 import asyncio
-from typing import Tuple
+import copy
+import sys
+from typing import List, Tuple
 from time import sleep
 
 from dialogs_framework.persistence.persistence import PersistenceProvider
 from dialogs_framework.persistence.in_memory import InMemoryPersistence
-from dialogs_framework.types import dialog, send_message, get_client_response
-from dialogs_framework.async_gen_dialogs import run_async_gen_dialog, dialog_result
+from dialogs_framework.types import (
+    dialog,
+    send_message,
+    get_client_response,
+    DialogTimeoutException,
+)
+from dialogs_framework.async_gen_dialogs import run_async_gen_dialog, dialog_result, gather
 from dialogs_framework.dialogs import run_dialog
 
 from .test_dialogs import topic_dialog as run_topic_dialog
@@ -373,3 +380,227 @@ async def test_async_dialog_yes_await_no_yield():
     step1 = await run_async_gen_dialog(async_dialog_await_no_yield(), persistence, "")
     assert step1.is_done
     assert step1.return_value == "done"
+
+
+@dialog(version="1.0")
+async def deeply_nested_async_dialog(depth: int):
+    if depth == 0:
+        result = yield get_client_response()
+    else:
+        result = yield deeply_nested_async_dialog(depth - 1)
+    yield dialog_result(result)
+
+
+@pytest.mark.asyncio
+async def test_deeply_nested_dialog_does_not_hit_recursion_limit():
+    persistence = InMemoryPersistence()
+    depth = sys.getrecursionlimit() * 2
+
+    step1 = await run_async_gen_dialog(deeply_nested_async_dialog(depth), persistence, "")
+    assert not step1.is_done
+
+    step2 = await run_async_gen_dialog(deeply_nested_async_dialog(depth), persistence, "Johnny")
+    assert step2.is_done
+    assert step2.return_value == "Johnny"
+
+
+lookups: List[str] = []
+
+
+@dialog(version="1.0")
+async def lookup(key: str, delay: float):
+    lookups.append(key)
+    await asyncio.sleep(delay)
+    return key.upper()
+
+
+@dialog(version="1.0")
+def lookups_dialog():
+    values = yield gather([lookup("a", 0.05), lookup("b", 0.05), lookup("c", 0.05)])
+    yield send_message(",".join(values))
+    return values
+
+
+@dialog(version="1.0")
+def confirm(key: str):
+    yield send_message(f"confirm {key}?")
+    answer = yield get_client_response()
+    return f"{key}:{answer}"
+
+
+@dialog(version="1.0")
+def interrupted_gather_dialog():
+    values = yield gather([lookup("x", 0), confirm("y")])
+    return values
+
+
+@pytest.mark.asyncio
+async def test_gather_runs_subdialogs_concurrently():
+    lookups.clear()
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+
+    step = await run_async_gen_dialog(lookups_dialog(), InMemoryPersistence(), "")
+
+    assert loop.time() - start < 0.12
+    assert step.return_value == ["A", "B", "C"]
+    assert step.messages == ["A,B,C"]
+
+
+@pytest.mark.asyncio
+async def test_gather_does_not_rerun_finished_subdialogs():
+    lookups.clear()
+    persistence = InMemoryPersistence()
+
+    step1 = await run_async_gen_dialog(interrupted_gather_dialog(), persistence, "")
+    assert step1.messages == ["confirm y?"]
+    gather_state = persistence.state.subdialogs[0].subdialogs[0]
+    assert [state.name for state in gather_state.subdialogs] == ["lookup", "confirm"]
+
+    step2 = await run_async_gen_dialog(interrupted_gather_dialog(), persistence, "yes")
+    assert step2.return_value == ["X", "y:yes"]
+    assert lookups == ["x"]
+
+
+@dialog(version="1.0", timeout=0.01, timeout_result="timed out")
+async def slow_lookup():
+    await asyncio.sleep(1)
+    return "found"
+
+
+@dialog(version="1.0", timeout=0.01)
+async def slow_gen_lookup():
+    yield send_message("looking")
+    await asyncio.sleep(1)
+    yield dialog_result("found")
+
+
+@dialog(version="1.0")
+def timeout_dialog():
+    value = yield slow_lookup()
+    gen_value = yield slow_gen_lookup()
+    yield send_message(f"{value}, {gen_value}")
+    yield get_client_response()
+    return value, gen_value
+
+
+@pytest.mark.asyncio
+async def test_step_timeout_returns_timeout_result():
+    persistence = InMemoryPersistence()
+
+    step1 = await run_async_gen_dialog(timeout_dialog(), persistence, "")
+    assert step1.messages == ["looking", "timed out, None"]
+
+    # the timeout results are saved, so the steps are not run again
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    step2 = await run_async_gen_dialog(timeout_dialog(), persistence, "")
+    assert loop.time() - start < 0.5
+    assert step2.return_value == ("timed out", None)
+
+
+def test_timeout_of_sync_dialog_is_rejected():
+    with pytest.raises(ValueError):
+
+        @dialog(version="1.0", timeout=1)
+        def sync_dialog():
+            pass
+
+
+@dialog(version="1.0")
+async def sleep_for(delay: float):
+    await asyncio.sleep(delay)
+
+
+@dialog(version="1.0")
+def slow_turn_dialog():
+    yield send_message("first")
+    yield sleep_for(0)
+    yield send_message("second")
+    yield sleep_for(1)
+    yield send_message("third")
+
+
+@pytest.mark.asyncio
+async def test_turn_deadline():
+    persistence = InMemoryPersistence()
+
+    with pytest.raises(DialogTimeoutException) as error:
+        await run_async_gen_dialog(slow_turn_dialog(), persistence, "", deadline=0.05)
+
+    assert error.value.messages == []
+    assert persistence.state is None
+
+
+@pytest.mark.asyncio
+async def test_turn_deadline_flushes_messages():
+    persistence = InMemoryPersistence()
+
+    with pytest.raises(DialogTimeoutException) as error:
+        await run_async_gen_dialog(
+            slow_turn_dialog(), persistence, "", deadline=0.05, flush_on_timeout=True
+        )
+
+    assert error.value.messages == ["first", "second"]
+    steps = persistence.state.subdialogs[0].subdialogs
+    assert [step.is_done for step in steps] == [True, True, True, False]
+
+
+@dialog(version="1.0")
+def slow_answer_dialog():
+    yield send_message("How long should I think?")
+    delay = yield get_client_response()
+    yield send_message("Thinking")
+    yield sleep_for(float(delay))
+    yield send_message("Done")
+
+
+@pytest.mark.asyncio
+async def test_turn_deadline_leaves_in_memory_state_unchanged():
+    persistence = InMemoryPersistence()
+    await run_async_gen_dialog(slow_answer_dialog(), persistence, "", deadline=1)
+    loaded_state = persistence.state
+    expected = copy.deepcopy(loaded_state)
+
+    with pytest.raises(DialogTimeoutException):
+        await run_async_gen_dialog(slow_answer_dialog(), persistence, "1", deadline=0.05)
+
+    assert persistence.state == expected
+    step = await run_async_gen_dialog(slow_answer_dialog(), persistence, "0", deadline=1)
+    assert step.messages == ["Thinking", "Done"]
+
+
+@dialog(version="1.0")
+async def failing_lookup():
+    raise asyncio.TimeoutError()
+
+
+@dialog(version="1.0")
+def failing_lookup_dialog():
+    yield failing_lookup()
+
+
+@pytest.mark.asyncio
+async def test_timeout_error_of_a_step_is_not_the_deadline():
+    persistence = InMemoryPersistence()
+
+    with pytest.raises(asyncio.TimeoutError):
+        await run_async_gen_dialog(failing_lookup_dialog(), persistence, "", deadline=1)
+
+
+@dialog(version="1.0", timeout=1, timeout_result="timed out")
+async def failing_lookup_with_timeout():
+    raise asyncio.TimeoutError()
+
+
+@dialog(version="1.0")
+def failing_lookup_with_timeout_dialog():
+    yield failing_lookup_with_timeout()
+
+
+@pytest.mark.asyncio
+async def test_timeout_error_of_a_step_is_not_its_timeout():
+    persistence = InMemoryPersistence()
+
+    with pytest.raises(asyncio.TimeoutError):
+        await run_async_gen_dialog(failing_lookup_with_timeout_dialog(), persistence, "")
@@ -0,0 +1,117 @@
+import asyncio
+import pytest
+from typing import List
+
+from dialogs_framework.types import dialog, send_message, get_client_response
+from dialogs_framework.persistence.in_memory import KeyedInMemoryPersistence
+from dialogs_framework.persistence.async_persistence import ThreadPoolPersistence
+from dialogs_framework.batch import run_many
+
+
+running = 0
+max_running = 0
+
+
+@dialog(version="1.0")
+async def slow_step(delay: float):
+    global running, max_running
+    running += 1
+    max_running = max(max_running, running)
+    await asyncio.sleep(delay)
+    running -= 1
+
+
+@dialog(version="1.0")
+def collecting_dialog():
+    answers: List[str] = []
+    while True:
+        answer = yield get_client_response()
+        yield slow_step(0.01)
+        if answer == "bye":
+            return answers
+        answers.append(answer)
+        yield send_message(f"got {answer}")
+
+
+@dialog(version="1.0")
+def failing_dialog():
+    answer = yield get_client_response()
+    if answer == "boom":
+        raise ValueError(answer)
+    return answer
+
+
+async def collect(results):
+    return [result async for result in results]
+
+
+@pytest.mark.asyncio
+async def test_run_many_keeps_order_within_conversations():
+    store = KeyedInMemoryPersistence()
+    messages = [(i % 5, "") for i in range(5)]
+    messages += [(i % 5, str(i)) for i in range(50)]
+    messages += [(i, "bye") for i in range(5)]
+
+    results = await collect(run_many(collecting_dialog, store, messages, concurrency=4))
+
+    assert len(results) == len(messages)
+    done = {
+        result.conversation_id: result.step.return_value
+        for result in results
+        if result.step.is_done
+    }
+    assert done == {i: [str(n) for n in range(i, 50, 5)] for i in range(5)}
+
+
+@pytest.mark.asyncio
+async def test_run_many_limits_concurrency():
+    global max_running
+    max_running = 0
+    store = KeyedInMemoryPersistence()
+    messages = [(i, "") for i in range(20)] + [(i, "hi") for i in range(20)]
+
+    await collect(run_many(collecting_dialog, store, messages, concurrency=3))
+
+    assert max_running == 3
+
+
+@pytest.mark.asyncio
+async def test_run_many_streams_results():
+    store = KeyedInMemoryPersistence()
+    messages = [("fast", "")] + [("slow", "")] + [("slow", str(i)) for i in range(10)]
+
+    results = run_many(collecting_dialog, store, messages, concurrency=2)
+    first = await results.__anext__()
+
+    assert first.conversation_id == "fast"
+    await results.aclose()
+
+
+@pytest.mark.asyncio
+async def test_run_many_reports_errors():
+    store = KeyedInMemoryPersistence()
+    messages = [(1, ""), (2, ""), (1, "boom"), (2, "fine")]
+
+    results = await collect(run_many(failing_dialog, store, messages))
+
+    [failed] = [result for result in results if result.error is not None]
+    assert failed.conversation_id == 1
+    assert isinstance(failed.error, ValueError)
+    [last] = [result for result in results if result.client_response == "fine"]
+    assert last.step.return_value == "fine"
+
+
+@pytest.mark.asyncio
+async def test_run_many_with_persistence_factory():
+    store = KeyedInMemoryPersistence()
+    messages = [("chat", ""), ("chat", "hello"), ("chat", "bye")]
+
+    results = await collect(
+        run_many(
+            collecting_dialog,
+            lambda conversation_id: ThreadPoolPersistence(store.for_conversation(conversation_id)),
+            messages,
+        )
+    )
+
+    assert results[-1].step.return_value == ["hello"]
@@ -0,0 +1,124 @@
+from typing import List
+import pytest
+
+from dialogs_framework.blobs import InMemoryBlobStore, DirectoryBlobStore
+from dialogs_framework.dialog_state import BlobResult, DialogStateException
+from dialogs_framework.gen_dialogs import run_gen_dialog
+from dialogs_framework.persistence.in_memory import InMemoryPersistence
+from dialogs_framework.persistence.sqlite import SqlitePersistence
+from dialogs_framework.state_codecs import BinaryStateCodec, JsonStateCodec
+from dialogs_framework.types import dialog, send_message, get_client_response
+
+records = [{"id": i, "text": "a fetched record"} for i in range(100)]
+
+
+@dialog(version="1.0")
+def fetch_records():
+    fetches.append(1)
+    return records
+
+
+fetches: List[int] = []
+
+
+@dialog(version="1.0")
+def records_dialog():
+    fetched = yield fetch_records()
+    small = yield get_client_response()
+    yield send_message(f"{len(fetched)} records, {small}")
+    return (yield get_client_response())
+
+
+def records_state():
+    persistence = InMemoryPersistence()
+    run_gen_dialog(records_dialog(), persistence, "")
+    run_gen_dialog(records_dialog(), persistence, "hi")
+    return persistence.state
+
+
+blob_codecs = [
+    lambda store: BinaryStateCodec(blob_store=store),
+    lambda store: JsonStateCodec(blob_store=store),
+    lambda store: JsonStateCodec(blob_store=store, lazy=True),
+]
+
+
+@pytest.mark.parametrize("make_codec", blob_codecs)
+def test_large_results_are_offloaded(make_codec):
+    store = InMemoryBlobStore()
+    codec = make_codec(store)
+    state = records_state()
+
+    data = codec.encode(state)
+    decoded = codec.decode(data)
+
+    assert len(store) == 1
+    assert len(data) * 3 < len(make_codec(None).encode(state))
+    fetched = decoded.subdialogs[0].subdialogs[0]
+    small = decoded.subdialogs[0].subdialogs[1]
+    assert isinstance(fetched.result, BlobResult)
+    assert not isinstance(small.result, BlobResult)
+    assert fetched.return_value == records
+    assert small.return_value == "hi"
+
+
+@pytest.mark.parametrize("make_codec", blob_codecs)
+def test_blob_results_load_lazily(make_codec):
+    store = InMemoryBlobStore()
+    codec = make_codec(store)
+    decoded = codec.decode(codec.encode(records_state()))
+    result = decoded.subdialogs[0].subdialogs[0].result
+
+    # encoding the state again keeps the key, without loading the value
+    assert codec.encode(decoded) == codec.encode(decoded)
+    assert not result.is_loaded
+
+    assert result.return_value == records
+    assert result.is_loaded
+
+
+def test_identical_results_are_stored_once():
+    store = InMemoryBlobStore()
+    codec = BinaryStateCodec(blob_store=store)
+
+    state = records_state()
+    codec.encode(records_state())
+    decoded = codec.decode(codec.encode(state))
+
+    assert len(store) == 1
+    assert decoded == state
+
+
+def test_blob_result_without_store():
+    codec = BinaryStateCodec(blob_store=InMemoryBlobStore())
+    decoded = BinaryStateCodec().decode(codec.encode(records_state()))
+
+    with pytest.raises(DialogStateException):
+        decoded.subdialogs[0].subdialogs[0].return_value
+
+
+def test_directory_blob_store(tmp_path):
+    store = DirectoryBlobStore(str(tmp_path / "blobs"))
+
+    store.put("abcdef", b"data")
+
+    assert "abcdef" in store
+    assert "abcdeg" not in store
+    assert store.get("abcdef") == b"data"
+
+
+def test_replay_with_offloaded_results(tmp_path):
+    store = DirectoryBlobStore(str(tmp_path / "blobs"))
+    codec = BinaryStateCodec(blob_store=store)
+    sqlite = SqlitePersistence(str(tmp_path / "dialogs.db"), codec=codec)
+    persistence = sqlite.for_conversation("chat")
+    fetches.clear()
+
+    run_gen_dialog(records_dialog(), persistence, "")
+    step = run_gen_dialog(records_dialog(), persistence, "hi")
+    assert step.messages == ["100 records, hi"]
+
+    step = run_gen_dialog(records_dialog(), persistence, "bye")
+    assert step.return_value == "bye"
+    assert len(fetches) == 1
+    sqlite.close()
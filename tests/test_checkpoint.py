@@ -0,0 +1,317 @@
+import pytest
+import asyncio
+
+from dialogs_framework.persistence.in_memory import InMemoryPersistence
+from dialogs_framework.types import (
+    dialog,
+    send_message,
+    get_client_response,
+    checkpoint,
+    DialogStateException,
+)
+from dialogs_framework.dialog_state import new_empty_state
+from dialogs_framework.dialogs import run_dialog, run
+from dialogs_framework.gen_dialogs import run_gen_dialog
+from dialogs_framework.async_gen_dialogs import run_async_gen_dialog
+from dialogs_framework.session_cache import SessionCache
+
+
+@dialog(version="1.0")
+def secret():
+    return 7
+
+
+@dialog(version="1.0")
+def guess_game():
+    yield send_message("Guess a number.")
+    correct_number = yield secret()
+
+    while True:
+        correct_number = yield checkpoint(correct_number)
+        guess = yield get_client_response()
+        if int(guess) == correct_number:
+            break
+        yield send_message("That's not it...")
+
+    yield send_message(f"Awesome! The number is {correct_number}")
+    return correct_number
+
+
+@dialog(version="1.0")
+def run_guess_game():
+    run(send_message("Guess a number."))
+    correct_number = run(secret())
+
+    while True:
+        correct_number = run(checkpoint(correct_number))
+        guess = run(get_client_response())
+        if int(guess) == correct_number:
+            break
+        run(send_message("That's not it..."))
+
+    run(send_message(f"Awesome! The number is {correct_number}"))
+    return correct_number
+
+
+@dialog(version="1.0")
+async def async_secret():
+    await asyncio.sleep(0)
+    return 7
+
+
+@dialog(version="1.0")
+def async_guess_game():
+    yield send_message("Guess a number.")
+    correct_number = yield async_secret()
+
+    while True:
+        correct_number = yield checkpoint(correct_number)
+        guess = yield get_client_response()
+        if int(guess) == correct_number:
+            break
+        yield send_message("That's not it...")
+
+    yield send_message(f"Awesome! The number is {correct_number}")
+    return correct_number
+
+
+@dialog(version="1.0")
+def ask(question: str):
+    yield send_message(question)
+    return (yield get_client_response())
+
+
+@dialog(version="1.0")
+def two_questions():
+    answers: list = []
+    while True:
+        # Steps skipped on replay return None, so the values are only read from the checkpoints
+        answers = yield checkpoint(answers, label="first")
+        a = yield ask(f"Q1 ({len(answers or [])})")
+        answers, a = yield checkpoint((answers, a), label="second")
+        b = yield ask(f"Q2 ({len(answers)})")
+        answers = answers + [a, b]
+        if len(answers) == 4:
+            return answers
+
+
+@dialog(version="1.0")
+def run_ask(question: str):
+    run(send_message(question))
+    return run(get_client_response())
+
+
+@dialog(version="1.0")
+def run_two_questions():
+    answers: list = []
+    while True:
+        answers = run(checkpoint(answers, label="first"))
+        a = run(run_ask(f"Q1 ({len(answers or [])})"))
+        answers, a = run(checkpoint((answers, a), label="second"))
+        b = run(run_ask(f"Q2 ({len(answers)})"))
+        answers = answers + [a, b]
+        if len(answers) == 4:
+            return answers
+
+
+def count_states(state):
+    return 1 + sum(count_states(subdialog) for subdialog in state.subdialogs)
+
+
+def test_checkpoint_keeps_state_size_constant():
+    persistence = InMemoryPersistence()
+    step = run_gen_dialog(guess_game(), persistence, "")
+    assert step.messages == ["Guess a number."]
+
+    sizes = []
+    for _ in range(10):
+        step = run_gen_dialog(guess_game(), persistence, "1")
+        assert step.messages == ["That's not it..."]
+        sizes.append(count_states(persistence.state))
+
+    assert len(set(sizes)) == 1
+
+    step = run_gen_dialog(guess_game(), persistence, "7")
+    assert step.is_done
+    assert step.return_value == 7
+    assert step.messages == ["Awesome! The number is 7"]
+
+
+def test_checkpoint_with_run():
+    persistence = InMemoryPersistence()
+    run_dialog(run_guess_game(), persistence, "")
+
+    sizes = []
+    for _ in range(5):
+        step = run_dialog(run_guess_game(), persistence, "1")
+        assert step.messages == ["That's not it..."]
+        sizes.append(count_states(persistence.state))
+
+    assert len(set(sizes)) == 1
+
+    step = run_dialog(run_guess_game(), persistence, "7")
+    assert step.is_done
+    assert step.return_value == 7
+
+
+@pytest.mark.asyncio
+async def test_checkpoint_with_async():
+    persistence = InMemoryPersistence()
+    await run_async_gen_dialog(async_guess_game(), persistence, "")
+
+    sizes = []
+    for _ in range(5):
+        step = await run_async_gen_dialog(async_guess_game(), persistence, "1")
+        assert step.messages == ["That's not it..."]
+        sizes.append(count_states(persistence.state))
+
+    assert len(set(sizes)) == 1
+
+    step = await run_async_gen_dialog(async_guess_game(), persistence, "7")
+    assert step.is_done
+    assert step.return_value == 7
+
+
+def test_checkpoint_with_session_cache():
+    persistence = InMemoryPersistence()
+    cache = SessionCache()
+    run_gen_dialog(guess_game(), persistence, "", session_cache=cache, conversation_id=1)
+    run_gen_dialog(guess_game(), persistence, "1", session_cache=cache, conversation_id=1)
+
+    # Replay without the cache, then resume with it
+    run_gen_dialog(guess_game(), persistence, "2")
+    step = run_gen_dialog(guess_game(), persistence, "7", session_cache=cache, conversation_id=1)
+
+    assert step.is_done
+    assert step.return_value == 7
+
+
+def test_fold_checkpoint_keeps_only_the_checkpoint():
+    state = new_empty_state(guess_game())
+    state.get_subdialog_state(0, send_message("Hi!")).return_value = None
+    checkpoint_state = state.get_subdialog_state(1, checkpoint(6))
+    checkpoint_state.return_value = 6
+
+    state.fold_checkpoint()
+
+    assert state.subdialogs == [checkpoint_state]
+    assert state.skips_to_checkpoint(0, send_message("Hi!"))
+    assert not state.skips_to_checkpoint(0, checkpoint(6))
+    assert not state.skips_to_checkpoint(1, send_message("Hi!"))
+
+
+def test_fold_checkpoint_before_done_raises_exception():
+    state = new_empty_state(guess_game())
+    state.get_subdialog_state(0, checkpoint(6))
+
+    with pytest.raises(DialogStateException):
+        state.fold_checkpoint()
+
+
+def test_replay_resumes_from_the_checkpoint_that_ran_last():
+    persistence = InMemoryPersistence()
+    messages = [run_gen_dialog(two_questions(), persistence, "").messages]
+    for answer in ["a1", "b1", "a2"]:
+        messages.append(run_gen_dialog(two_questions(), persistence, answer).messages)
+    step = run_gen_dialog(two_questions(), persistence, "b2")
+
+    assert messages == [["Q1 (0)"], ["Q2 (0)"], ["Q1 (2)"], ["Q2 (2)"]]
+    assert step.is_done
+    assert step.return_value == ["a1", "b1", "a2", "b2"]
+
+
+def test_replay_resumes_from_the_checkpoint_that_ran_last_with_run():
+    persistence = InMemoryPersistence()
+    messages = [run_dialog(run_two_questions(), persistence, "").messages]
+    for answer in ["a1", "b1", "a2"]:
+        messages.append(run_dialog(run_two_questions(), persistence, answer).messages)
+    step = run_dialog(run_two_questions(), persistence, "b2")
+
+    assert messages == [["Q1 (0)"], ["Q2 (0)"], ["Q1 (2)"], ["Q2 (2)"]]
+    assert step.return_value == ["a1", "b1", "a2", "b2"]
+
+
+def test_labeled_checkpoint_skips_other_checkpoints():
+    state = new_empty_state(two_questions())
+    checkpoint_state = state.get_subdialog_state(0, checkpoint(6, label="second"))
+    checkpoint_state.return_value = 6
+    state.fold_checkpoint()
+
+    assert checkpoint_state.name == "checkpoint:second"
+    assert state.skips_to_checkpoint(0, checkpoint(6))
+    assert state.skips_to_checkpoint(0, checkpoint(6, label="first"))
+    assert not state.skips_to_checkpoint(0, checkpoint(6, label="second"))
+
+
+@dialog(version="1.0")
+def two_unlabeled_checkpoints():
+    answers: list = []
+    while True:
+        answers = yield checkpoint(answers)
+        a = yield ask("Q1")
+        answers = yield checkpoint(answers + [a])
+        b = yield ask("Q2")
+        answers = answers + [b]
+
+
+@dialog(version="1.0")
+def run_two_unlabeled_checkpoints():
+    answers = run(checkpoint([]))
+    a = run(run_ask("Q1"))
+    return run(checkpoint(answers + [a]))
+
+
+def test_two_unlabeled_checkpoints_raise_exception():
+    persistence = InMemoryPersistence()
+    run_gen_dialog(two_unlabeled_checkpoints(), persistence, "")
+
+    with pytest.raises(DialogStateException):
+        run_gen_dialog(two_unlabeled_checkpoints(), persistence, "a")
+
+
+def test_two_unlabeled_checkpoints_raise_exception_with_run():
+    persistence = InMemoryPersistence()
+    run_dialog(run_two_unlabeled_checkpoints(), persistence, "")
+
+    with pytest.raises(DialogStateException):
+        run_dialog(run_two_unlabeled_checkpoints(), persistence, "a")
+
+
+@dialog(version="1.0")
+def collect_answers():
+    answers: list = []
+    while True:
+        answers = yield checkpoint(answers)
+        yield send_message(f"{len(answers)} answers")
+        answers.append((yield get_client_response()))
+        answers.append((yield get_client_response()))
+
+
+def test_changing_the_value_of_a_checkpoint_does_not_change_its_state():
+    persistence = InMemoryPersistence()
+    messages = [run_gen_dialog(collect_answers(), persistence, "").messages]
+    for answer in ["a", "b", "c", "d"]:
+        messages.append(run_gen_dialog(collect_answers(), persistence, answer).messages)
+
+    assert messages == [["0 answers"], [], ["2 answers"], [], ["4 answers"]]
+
+
+@dialog(version="1.0")
+def wait_at_checkpoint():
+    yield checkpoint(0)
+    yield send_message("At the checkpoint")
+    return (yield get_client_response())
+
+
+@dialog(version="1.0")
+def fallback():
+    yield send_message("Falling back!")
+
+
+def test_checkpoint_in_place_of_another_step_runs_fallback():
+    persistence = InMemoryPersistence()
+    run_gen_dialog(ask("Question"), persistence, "", fallback())
+
+    step = run_gen_dialog(wait_at_checkpoint(), persistence, "a", fallback())
+
+    assert step.messages == ["Falling back!", "At the checkpoint"]
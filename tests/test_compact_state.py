@@ -0,0 +1,135 @@
+import pytest
+
+from dialogs_framework.persistence.in_memory import InMemoryPersistence
+from dialogs_framework.types import dialog, send_message, get_client_response, checkpoint
+from dialogs_framework.dialog_state import DialogStateException
+from dialogs_framework.gen_dialogs import run_gen_dialog
+from dialogs_framework.compact_state import compact_state, new_compact_state
+
+from .test_checkpoint import two_questions
+from .test_gen_dialogs import (
+    topic_dialog,
+    name_getter_dialog,
+    name_getter_dialog_take_2,
+    fallback_with_client_response,
+)
+
+
+@dialog(version="1.0")
+def looping_dialog():
+    count = 0
+    while True:
+        count = yield checkpoint(count)
+        yield send_message(f"turn {count}")
+        yield get_client_response()
+        count += 1
+
+
+def test_run_dialog_with_compact_state():
+    persistence = InMemoryPersistence(new_compact_state(topic_dialog()))
+    step1 = run_gen_dialog(topic_dialog(), persistence, "")
+    assert len(step1.messages) == 3
+
+    step2 = run_gen_dialog(topic_dialog(), persistence, "Johnny")
+    assert step2.messages[0] == "Hi Johnny!"
+
+    step3 = run_gen_dialog(topic_dialog(), persistence, "Peanuts")
+    assert step3.is_done
+    assert step3.return_value == ("Johnny", "Peanuts")
+
+
+def test_run_dialog_with_fallback_with_compact_state():
+    persistence = InMemoryPersistence(new_compact_state(name_getter_dialog()))
+    run_gen_dialog(name_getter_dialog(), persistence, "", fallback_with_client_response())
+
+    step2 = run_gen_dialog(
+        name_getter_dialog_take_2(), persistence, "Juanito", fallback_with_client_response()
+    )
+    assert step2.messages == ["Falling back!"]
+
+    step3 = run_gen_dialog(
+        name_getter_dialog_take_2(), persistence, "Julia", fallback_with_client_response()
+    )
+    assert step3.messages == ["Get up fool", "Tell me your name! Now!!!"]
+
+
+def test_compact_state_round_trip():
+    persistence = InMemoryPersistence()
+    run_gen_dialog(topic_dialog(), persistence, "")
+    run_gen_dialog(topic_dialog(), persistence, "Johnny")
+    state = persistence.state
+
+    compact = compact_state(state)
+
+    assert compact.to_state() == state
+    assert compact.name == "topic_dialog"
+    assert compact.subdialogs[0].subdialogs[0].is_done
+    assert compact.subdialogs[0].subdialogs[-1].sent_to_client
+    assert compact.subdialogs[0].name is state.subdialogs[0].name
+
+
+def test_compacted_drops_folded_states():
+    state = new_compact_state(looping_dialog())
+    persistence = InMemoryPersistence(state)
+    for _ in range(10):
+        run_gen_dialog(looping_dialog(), persistence, "")
+
+    compacted = state.compacted()
+
+    assert len(compacted.tree) < len(state.tree)
+    assert compacted.to_state() == state.to_state()
+
+    persistence.state = compacted
+    step = run_gen_dialog(looping_dialog(), persistence, "")
+    assert step.messages == ["turn 10"]
+
+
+def test_compact_state_resumes_from_the_checkpoint_that_ran_last():
+    persistence = InMemoryPersistence(new_compact_state(two_questions()))
+    run_gen_dialog(two_questions(), persistence, "")
+    run_gen_dialog(two_questions(), persistence, "a1")
+    step = run_gen_dialog(two_questions(), persistence, "b1")
+
+    assert step.messages == ["Q1 (2)"]
+
+
+def test_checkpoint_loop_keeps_compact_tree_bounded():
+    state = new_compact_state(looping_dialog())
+    persistence = InMemoryPersistence(state)
+    sizes = []
+    for _ in range(200):
+        run_gen_dialog(looping_dialog(), persistence, "")
+        sizes.append(len(state.tree))
+
+    assert max(sizes) == sizes[10]
+    assert len(state.tree) - len(state.tree.free) == len(state.compacted().tree)
+
+    step = run_gen_dialog(looping_dialog(), persistence, "")
+    assert step.messages == ["turn 200"]
+
+
+def test_compact_return_value():
+    state = new_compact_state(looping_dialog())
+
+    with pytest.raises(DialogStateException):
+        _ = state.return_value
+
+    state.return_value = None
+    assert state.is_done
+    assert state.return_value is None
+
+    with pytest.raises(DialogStateException):
+        state.return_value = 6
+
+
+def test_compact_copy_leaves_the_state_unchanged():
+    state = new_compact_state(looping_dialog())
+    persistence = InMemoryPersistence(state)
+    run_gen_dialog(looping_dialog(), persistence, "")
+    expected = state.to_state()
+
+    persistence.state = state.copy()
+    run_gen_dialog(looping_dialog(), persistence, "")
+
+    assert state.to_state() == expected
+    assert persistence.state.to_state() != expected
@@ -1,8 +1,18 @@
 import pytest
+from dataclasses import asdict
 
 from dialogs_framework.types import get_client_response, send_message, dialog
-from dialogs_framework.dialog_state import new_empty_state, DialogStateException, state_from_dict
+from dialogs_framework.dialog_state import (
+    new_empty_state,
+    DialogStateException,
+    state_from_dict,
+    lazy_state_from_dict,
+)
 from dialogs_framework.dialogs import run
+from dialogs_framework.gen_dialogs import run_gen_dialog
+from dialogs_framework.persistence.in_memory import InMemoryPersistence
+
+from .test_gen_dialogs import topic_dialog
 
 
 @dialog(version="1.0")
@@ -156,3 +166,72 @@ def test_version_property():
     state = new_empty_state(some_dialog())
 
     assert state.version == "123"
+
+
+def test_lazy_state_from_dict_builds_subdialogs_on_access():
+    raw_subdialog = {
+        "version": "1.0",
+        "name": "fun_subdialog",
+        "result": {"return_value": 6},
+        "subdialogs": [],
+        "sent_to_client": False,
+    }
+    raw = {
+        "version": "1.0",
+        "name": "fun_dialog",
+        "result": None,
+        "subdialogs": [raw_subdialog],
+        "sent_to_client": True,
+        "handling_fallback": True,
+    }
+
+    state = lazy_state_from_dict(raw)
+
+    assert not state.is_loaded
+    assert state.sent_to_client
+    assert state.handling_fallback
+    assert state.subdialogs[0].return_value == 6
+    assert state.is_loaded
+    assert asdict(state) == asdict(state_from_dict(raw))
+
+
+def test_lazy_state_skips_done_subtrees_on_replay():
+    persistence = InMemoryPersistence()
+    run_gen_dialog(topic_dialog(), persistence, "")
+    run_gen_dialog(topic_dialog(), persistence, "Johnny")
+    raw = asdict(persistence.state)
+
+    persistence.state = lazy_state_from_dict(raw)
+    step = run_gen_dialog(topic_dialog(), persistence, "Peanuts")
+
+    assert step.return_value == ("Johnny", "Peanuts")
+    name_getter_state = persistence.state.subdialogs[0].subdialogs[0]
+    assert name_getter_state.is_done
+    assert not name_getter_state.is_loaded
+    assert asdict(name_getter_state) == raw["subdialogs"][0]["subdialogs"][0]
+
+
+def test_copy_leaves_the_state_unchanged():
+    persistence = InMemoryPersistence()
+    run_gen_dialog(topic_dialog(), persistence, "")
+    state = persistence.state
+    expected = asdict(state)
+
+    persistence.state = state.copy()
+    run_gen_dialog(topic_dialog(), persistence, "Johnny")
+
+    assert asdict(state) == expected
+    assert persistence.state != state
+
+
+def test_copy_of_lazy_state_does_not_build_subdialogs():
+    persistence = InMemoryPersistence()
+    run_gen_dialog(topic_dialog(), persistence, "")
+    run_gen_dialog(topic_dialog(), persistence, "Johnny")
+    state = lazy_state_from_dict(asdict(persistence.state))
+
+    state_copy = state.copy()
+
+    assert not state.is_loaded
+    assert not state_copy.is_loaded
+    assert asdict(state_copy) == asdict(state)
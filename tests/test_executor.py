@@ -0,0 +1,187 @@
+import asyncio
+import threading
+import time
+import pytest
+from contextvars import ContextVar
+
+from dialogs_framework.persistence.in_memory import InMemoryPersistence
+from dialogs_framework.types import dialog, send_message, get_client_response
+from dialogs_framework.dialogs import run, dialog_context
+from dialogs_framework.executor import (
+    DialogExecutor,
+    run_dialog_in_executor,
+    run_gen_dialog_in_executor,
+)
+
+request_id: ContextVar[str] = ContextVar("request_id", default="")
+
+
+@dialog(version="1.0")
+def echo_dialog():
+    name = run(get_client_response())
+    run(send_message(f"{request_id.get()}: hi {name}"))
+    return name
+
+
+@dialog(version="1.0")
+def gen_echo_dialog():
+    name = yield get_client_response()
+    yield send_message(f"{request_id.get()}: hi {name}")
+    return name
+
+
+@pytest.mark.asyncio
+async def test_run_dialog_in_executor():
+    persistence = InMemoryPersistence()
+    request_id.set("r1")
+    context_before = dialog_context.get(None)
+
+    await run_dialog_in_executor(echo_dialog(), persistence, "")
+    step = await run_dialog_in_executor(echo_dialog(), persistence, "Johnny")
+
+    assert step.messages == ["r1: hi Johnny"]
+    assert step.return_value == "Johnny"
+    # the context set by the engine stays in the thread's copy
+    assert dialog_context.get(None) is context_before
+
+
+@pytest.mark.asyncio
+async def test_run_gen_dialog_in_executor():
+    persistence = InMemoryPersistence()
+    request_id.set("r2")
+
+    await run_gen_dialog_in_executor(gen_echo_dialog(), persistence, "")
+    step = await run_gen_dialog_in_executor(gen_echo_dialog(), persistence, "Julia")
+
+    assert step.messages == ["r2: hi Julia"]
+
+
+@pytest.mark.asyncio
+async def test_max_in_flight():
+    executor = DialogExecutor(max_workers=8, max_in_flight=2)
+    release = threading.Event()
+    running = []
+
+    def blocking_call(i):
+        running.append(i)
+        release.wait()
+        return i
+
+    calls = [asyncio.ensure_future(executor.run(blocking_call, i)) for i in range(5)]
+    try:
+        while len(running) < 2:
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.05)
+        stats = executor.stats()
+    finally:
+        release.set()
+
+    assert len(running) == 2
+    assert stats.running == 2
+    assert stats.queued == 3
+    assert stats.max_queued >= 3
+    assert await asyncio.gather(*calls) == list(range(5))
+    stats = executor.stats()
+    assert (stats.queued, stats.running, stats.completed) == (0, 0, 5)
+    executor.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_cancelled_call_is_not_counted():
+    executor = DialogExecutor(max_workers=1, max_in_flight=1)
+    release = threading.Event()
+
+    first = asyncio.ensure_future(executor.run(release.wait))
+    second = asyncio.ensure_future(executor.run(release.wait))
+    await asyncio.sleep(0.05)
+    second.cancel()
+    release.set()
+    await first
+
+    with pytest.raises(asyncio.CancelledError):
+        await second
+    assert executor.stats().queued == 0
+    assert executor.stats().completed == 1
+    executor.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_call_cancelled_in_the_pool_is_dequeued_once():
+    executor = DialogExecutor(max_workers=1)
+    release = threading.Event()
+
+    first = asyncio.ensure_future(executor.run(release.wait))
+    calls = [asyncio.ensure_future(executor.run(release.wait)) for _ in range(3)]
+    await asyncio.sleep(0.05)
+    for call in calls:
+        call.cancel()
+    await asyncio.sleep(0)
+    release.set()
+    await first
+
+    for call in calls:
+        with pytest.raises(asyncio.CancelledError):
+            await call
+    stats = executor.stats()
+    assert (stats.queued, stats.running, stats.completed) == (0, 0, 1)
+    executor.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_turns_of_a_conversation_run_one_at_a_time():
+    executor = DialogExecutor(max_workers=4)
+    release = threading.Event()
+    running = []
+
+    def blocking_call(conversation_id, i):
+        running.append((conversation_id, i))
+        release.wait()
+        return i
+
+    calls = [
+        asyncio.ensure_future(executor.run_in_conversation("a", blocking_call, "a", 1)),
+        asyncio.ensure_future(executor.run_in_conversation("a", blocking_call, "a", 2)),
+        asyncio.ensure_future(executor.run_in_conversation("b", blocking_call, "b", 3)),
+    ]
+    try:
+        while len(running) < 2:
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.05)
+        started = list(running)
+    finally:
+        release.set()
+
+    assert sorted(started) == [("a", 1), ("b", 3)]
+    assert await asyncio.gather(*calls) == [1, 2, 3]
+    assert running[-1] == ("a", 2)
+    executor.shutdown()
+
+
+@dialog(version="1.0")
+def slow_increment(count):
+    time.sleep(0.01)
+    return count + 1
+
+
+@dialog(version="1.0")
+def counting_dialog():
+    count = 0
+    while True:
+        run(get_client_response())
+        count = run(slow_increment(count))
+        run(send_message(str(count)))
+
+
+@pytest.mark.asyncio
+async def test_concurrent_turns_of_a_conversation_keep_its_state():
+    persistence = InMemoryPersistence()
+    await run_dialog_in_executor(counting_dialog(), persistence, "", conversation_id=1)
+
+    steps = await asyncio.gather(
+        *(
+            run_dialog_in_executor(counting_dialog(), persistence, "", conversation_id=1)
+            for _ in range(10)
+        )
+    )
+
+    assert [step.messages for step in steps] == [[str(i)] for i in range(1, 11)]
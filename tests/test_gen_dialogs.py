@@ -1,3 +1,4 @@
+import sys
 from typing import Tuple, Generator
 from time import sleep
 from concurrent.futures.thread import ThreadPoolExecutor
@@ -76,6 +77,20 @@ def dialog_with_subdialog_take_2():
     return result
 
 
+@dialog(version="1.0")
+def renamed_subdialog():
+    yield send_message("I took the place of another dialog")
+    result = yield get_client_response()
+    return result
+
+
+@dialog(version="1.0")
+def dialog_with_renamed_subdialog():
+    yield renamed_subdialog()
+    result = yield get_client_response()
+    return result
+
+
 @dialog(version="1.0")
 def name_getter_dialog_take_3():
     yield send_message("I need to know your name")
@@ -205,6 +220,17 @@ def test_run_dialog_with_fallback_on_subdialog_version_mismatch():
     assert step2.messages == ["Falling back!", "I have a different version, HA! HA! HA!"]
 
 
+def test_run_dialog_replays_renamed_subdialog_of_same_version():
+    persistence = InMemoryPersistence()
+    run_gen_dialog(dialog_with_subdialog(), persistence, "", fallback_without_client_response())
+
+    step2 = run_gen_dialog(
+        dialog_with_renamed_subdialog(), persistence, "Julia", fallback_without_client_response()
+    )
+    # only the version is matched, so the state of the old subdialog is replayed
+    assert step2.messages == []
+
+
 def test_run_dialog_with_fallback_truncates_leftover_messages():
     persistence = InMemoryPersistence()
     step1 = run_gen_dialog(
@@ -268,3 +294,25 @@ def test_run_dialog_with_gen_dialog():
     step3 = run_gen_dialog(topic_dialog(), persistence, "Peanuts")
     assert step3.is_done
     assert step3.return_value == ("Johnny", "Peanuts")
+
+
+@dialog(version="1.0")
+def deeply_nested_dialog(depth: int):
+    if depth == 0:
+        result = yield get_client_response()
+        return result
+
+    result = yield deeply_nested_dialog(depth - 1)
+    return result
+
+
+def test_deeply_nested_dialog_does_not_hit_recursion_limit():
+    persistence = InMemoryPersistence()
+    depth = sys.getrecursionlimit() * 2
+
+    step1 = run_gen_dialog(deeply_nested_dialog(depth), persistence, "")
+    assert not step1.is_done
+
+    step2 = run_gen_dialog(deeply_nested_dialog(depth), persistence, "Johnny")
+    assert step2.is_done
+    assert step2.return_value == "Johnny"
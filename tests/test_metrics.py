@@ -0,0 +1,192 @@
+import sys
+import threading
+import pytest
+from datetime import date
+
+from dialogs_framework.persistence.in_memory import InMemoryPersistence
+from dialogs_framework.types import dialog, send_message, get_client_response
+from dialogs_framework.gen_dialogs import run_gen_dialog
+from dialogs_framework.async_gen_dialogs import run_async_gen_dialog
+from dialogs_framework.metrics import DialogMetrics, MetricsRegistry, set_metrics
+
+
+@dialog(version="1.0")
+def greeting():
+    yield send_message("What's your name?")
+    name = yield get_client_response()
+    yield send_message(f"Hi {name}")
+
+
+@dialog(version="2.0")
+def greeting_v2():
+    yield send_message("What's your name?")
+    name = yield get_client_response()
+    yield send_message(f"Hello {name}")
+
+
+@dialog(version="1.0")
+def fallback():
+    yield send_message("We have updated our conversation")
+
+
+def current_tracer():
+    return sys.modules["dialogs_framework.tracing"].active_tracer
+
+
+@pytest.fixture
+def metrics():
+    metrics = DialogMetrics(state_sizes=1)
+    set_metrics(metrics)
+    yield metrics
+    set_metrics(None)
+
+
+def test_registry_render():
+    registry = MetricsRegistry()
+    requests = registry.counter("requests_total", "Requests", ("path",))
+    latency = registry.histogram("latency_seconds", "Latency", (), buckets=(0.1, 1))
+
+    requests.inc("/a")
+    requests.inc("/a", amount=2)
+    requests.inc('/"b"')
+    latency.observe(0.05)
+    latency.observe(0.5)
+    latency.observe(5)
+
+    assert registry.render() == (
+        "# HELP requests_total Requests\n"
+        "# TYPE requests_total counter\n"
+        'requests_total{path="/\\"b\\""} 1\n'
+        'requests_total{path="/a"} 3\n'
+        "# HELP latency_seconds Latency\n"
+        "# TYPE latency_seconds histogram\n"
+        'latency_seconds_bucket{le="0.1"} 1\n'
+        'latency_seconds_bucket{le="1"} 2\n'
+        'latency_seconds_bucket{le="+Inf"} 3\n'
+        "latency_seconds_sum 5.55\n"
+        "latency_seconds_count 3\n"
+    )
+
+
+def test_registry_merges_threads():
+    registry = MetricsRegistry()
+    counter = registry.counter("count_total", "Count")
+
+    def count():
+        for _ in range(1000):
+            counter.inc()
+
+    threads = [threading.Thread(target=count) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    count()
+    assert registry.collect()["count_total"][()] >= 1000
+    for thread in threads:
+        thread.join()
+
+    assert registry.collect()["count_total"][()] == 5000
+    # the shards of the threads that ended are folded, and still counted
+    assert len(registry._shards) == 1
+    assert registry.collect()["count_total"][()] == 5000
+
+
+def test_label_count_is_checked():
+    counter = MetricsRegistry().counter("count_total", "Count", ("a",))
+    with pytest.raises(ValueError):
+        counter.inc()
+
+
+def test_gen_dialog_metrics(metrics):
+    persistence = InMemoryPersistence()
+    run_gen_dialog(greeting(), persistence, "")
+    run_gen_dialog(greeting(), persistence, "Johnny")
+
+    collected = metrics.registry.collect()
+    turns = collected["dialogs_turn_seconds"]
+    assert turns[("greeting", "run_gen_dialog", "not_done")][-2] == 0
+    assert sum(turns[("greeting", "run_gen_dialog", "not_done")][:-1]) == 1
+    assert sum(turns[("greeting", "run_gen_dialog", "done")][:-1]) == 1
+
+    steps = collected["dialogs_steps_total"]
+    assert steps[("send_message", "replayed")] == 1
+    assert steps[("send_message", "executed")] == 2
+    assert steps[("get_client_response", "executed")] == 2
+
+    nodes = collected["dialogs_state_nodes"][("greeting",)]
+    assert sum(nodes[:-1]) == 2
+    assert nodes[-1] == 4 + 5
+    assert sum(collected["dialogs_state_bytes"][("greeting",)][:-1]) == 2
+
+
+def test_state_sizes_are_not_measured_by_default():
+    metrics = DialogMetrics()
+    set_metrics(metrics)
+    try:
+        run_gen_dialog(greeting(), InMemoryPersistence(), "")
+    finally:
+        set_metrics(None)
+
+    collected = metrics.registry.collect()
+    assert sum(collected["dialogs_turn_seconds"][("greeting", "run_gen_dialog", "not_done")][:-1])
+    assert collected["dialogs_state_nodes"] == {}
+    assert collected["dialogs_state_bytes"] == {}
+
+
+@dialog(version="1.0")
+def today():
+    return date(2021, 5, 1)
+
+
+@dialog(version="1.0")
+def date_dialog():
+    day = yield today()
+    yield send_message(f"Today is {day}")
+    yield get_client_response()
+
+
+def test_state_that_cannot_be_encoded_is_not_measured(metrics):
+    step = run_gen_dialog(date_dialog(), InMemoryPersistence(), "")
+
+    assert step.messages == ["Today is 2021-05-01"]
+    collected = metrics.registry.collect()
+    assert collected["dialogs_state_nodes"] == {}
+    assert collected["dialogs_state_bytes"] == {}
+
+
+def test_version_mismatch_and_fallback(metrics):
+    persistence = InMemoryPersistence()
+    run_gen_dialog(greeting(), persistence, "")
+    run_gen_dialog(greeting_v2(), persistence, "Johnny", fallback())
+
+    collected = metrics.registry.collect()
+    assert collected["dialogs_version_mismatches_total"] == {("greeting_v2",): 1}
+    assert collected["dialogs_fallback_turns_total"] == {("greeting_v2",): 1}
+    # the fallback dialog is part of the turn
+    turns = collected["dialogs_turn_seconds"]
+    assert {dialog for dialog, _, _ in turns} == {"greeting", "greeting_v2"}
+    assert sum(turns[("greeting_v2", "run_gen_dialog", "not_done")][:-1]) == 1
+
+
+@pytest.mark.asyncio
+async def test_async_gen_dialog_metrics(metrics):
+    persistence = InMemoryPersistence()
+    await run_async_gen_dialog(greeting(), persistence, "")
+
+    rendered = metrics.render()
+    assert (
+        'dialogs_turn_seconds_count{dialog="greeting",engine="run_async_gen_dialog",'
+        'outcome="not_done"} 1' in rendered
+    )
+    assert 'dialogs_steps_total{mode="executed",step="send_message"}' not in rendered
+    assert 'dialogs_steps_total{step="send_message",mode="executed"} 1' in rendered
+
+
+def test_set_metrics_installs_tracer():
+    metrics = DialogMetrics()
+    set_metrics(metrics)
+    assert current_tracer() is metrics
+    set_metrics(None)
+    assert current_tracer() is None
+
+    run_gen_dialog(greeting(), InMemoryPersistence(), "")
+    assert metrics.registry.collect()["dialogs_turn_seconds"] == {}
@@ -0,0 +1,93 @@
+import os
+import pytest
+from functools import partial
+
+from dialogs_framework.persistence.in_memory import InMemoryPersistence, KeyedInMemoryPersistence
+from dialogs_framework.persistence.async_persistence import ThreadPoolPersistence
+from dialogs_framework.process_pool import ProcessPoolEngine
+from dialogs_framework.types import dialog, send_message, get_client_response
+
+from .persistence.test_persistence import StalePersistence
+
+
+@dialog(version="1.0")
+def pid_dialog():
+    answers = []
+    while True:
+        answer = yield get_client_response()
+        if answer == "bye":
+            return answers
+        answers.append(answer)
+        yield send_message(os.getpid())
+
+
+@dialog(version="1.0")
+def crashing_dialog(marker: str):
+    yield get_client_response()
+    if not os.path.exists(marker):
+        open(marker, "w").close()
+        os._exit(1)
+    yield send_message("survived")
+    return (yield get_client_response())
+
+
+@pytest.fixture
+def engine():
+    with ProcessPoolEngine(workers=2) as engine:
+        yield engine
+
+
+def test_turns_of_a_conversation_run_in_the_same_worker(engine):
+    store = KeyedInMemoryPersistence()
+    pids = {}
+    for conversation_id in range(6):
+        persistence = store.for_conversation(conversation_id)
+        engine.run(pid_dialog, persistence, "", conversation_id)
+        steps = [engine.run(pid_dialog, persistence, str(i), conversation_id) for i in range(3)]
+        pids[conversation_id] = {step.messages[0] for step in steps}
+
+        done = engine.run(pid_dialog, persistence, "bye", conversation_id)
+        assert done.return_value == ["0", "1", "2"]
+
+    assert all(len(worker_pids) == 1 for worker_pids in pids.values())
+    assert len(set.union(*pids.values())) == 2
+    assert os.getpid() not in set.union(*pids.values())
+
+
+def test_state_is_saved_by_the_calling_process(engine):
+    persistence = InMemoryPersistence()
+    engine.run(pid_dialog, persistence, "", "chat")
+    engine.run(pid_dialog, persistence, "hello", "chat")
+
+    assert persistence.state.subdialogs[0].subdialogs[0].return_value == "hello"
+
+
+def test_crashed_worker_is_replaced(engine, tmp_path):
+    persistence = InMemoryPersistence()
+    dialog_factory = partial(crashing_dialog, str(tmp_path / "crashed"))
+    engine.run(dialog_factory, persistence, "", "chat")
+
+    step = engine.run(dialog_factory, persistence, "hi", "chat")
+    assert step.messages == ["survived"]
+
+    step = engine.run(dialog_factory, persistence, "bye", "chat")
+    assert step.return_value == "bye"
+
+
+def test_stale_turn_is_run_again(engine):
+    persistence = StalePersistence(stale_saves=1)
+    engine.run(pid_dialog, persistence, "", "chat")
+
+    step = engine.run(pid_dialog, persistence, "bye", "chat")
+    assert step.return_value == []
+
+
+@pytest.mark.asyncio
+async def test_run_async(engine):
+    store = KeyedInMemoryPersistence()
+    persistence = ThreadPoolPersistence(store.for_conversation("chat"))
+    await engine.run_async(pid_dialog, persistence, "", "chat")
+    await engine.run_async(pid_dialog, persistence, "hello", "chat")
+
+    step = await engine.run_async(pid_dialog, persistence, "bye", "chat")
+    assert step.return_value == ["hello"]
@@ -0,0 +1,175 @@
+import pytest
+import asyncio
+from typing import List
+
+from dialogs_framework.persistence.in_memory import InMemoryPersistence
+from dialogs_framework.types import dialog, send_message, get_client_response
+from dialogs_framework.gen_dialogs import run_gen_dialog
+from dialogs_framework.async_gen_dialogs import run_async_gen_dialog, dialog_result
+from dialogs_framework.session_cache import SessionCache
+
+started: List[str] = []
+
+
+@dialog(version="1.0")
+def counted_prompt(text):
+    started.append(text)
+    yield send_message(text)
+    response = yield get_client_response()
+    return response
+
+
+@dialog(version="1.0")
+def counted_dialog():
+    started.append("root")
+    name = yield counted_prompt("name?")
+    color = yield counted_prompt("color?")
+    yield send_message(f"{name} likes {color}")
+    return name, color
+
+
+@dialog(version="1.1")
+def counted_dialog_take_2():
+    yield send_message("New version!")
+    response = yield get_client_response()
+    return response
+
+
+@dialog(version="1.0")
+async def async_prompt(text):
+    started.append(text)
+    await asyncio.sleep(0)
+    yield send_message(text)
+    response = yield get_client_response()
+    yield dialog_result(response)
+
+
+@dialog(version="1.0")
+def counted_dialog_with_async():
+    started.append("root")
+    name = yield async_prompt("name?")
+    color = yield async_prompt("color?")
+    return name, color
+
+
+@pytest.fixture(autouse=True)
+def reset_started():
+    started.clear()
+
+
+def test_session_is_resumed_instead_of_replayed():
+    persistence = InMemoryPersistence()
+    cache = SessionCache()
+
+    step1 = run_gen_dialog(counted_dialog(), persistence, "", None, cache, "chat")
+    step2 = run_gen_dialog(counted_dialog(), persistence, "Johnny", None, cache, "chat")
+    step3 = run_gen_dialog(counted_dialog(), persistence, "blue", None, cache, "chat")
+
+    assert step1.messages == ["name?"]
+    assert step2.messages == ["color?"]
+    assert step3.messages == ["Johnny likes blue"]
+    assert step3.is_done
+    assert step3.return_value == ("Johnny", "blue")
+    assert started == ["root", "name?", "color?"]
+    assert len(cache) == 0
+
+
+def test_cache_miss_falls_back_to_replay():
+    persistence = InMemoryPersistence()
+
+    run_gen_dialog(counted_dialog(), persistence, "", None, SessionCache(), "chat")
+    step2 = run_gen_dialog(counted_dialog(), persistence, "Johnny", None, SessionCache(), "chat")
+
+    assert step2.messages == ["color?"]
+    assert started == ["root", "name?", "root", "name?", "color?"]
+
+
+def test_changed_state_falls_back_to_replay():
+    cache = SessionCache()
+    persistence = InMemoryPersistence()
+    run_gen_dialog(counted_dialog(), persistence, "", None, cache, "chat")
+    run_gen_dialog(counted_dialog(), persistence, "Johnny", None, cache, "chat")
+
+    # A different persistence, one turn behind the cached session
+    other_persistence = InMemoryPersistence()
+    run_gen_dialog(counted_dialog(), other_persistence, "", None, None, "chat")
+    started.clear()
+
+    step = run_gen_dialog(counted_dialog(), other_persistence, "Julia", None, cache, "chat")
+
+    assert step.messages == ["color?"]
+    assert started == ["root", "name?", "color?"]
+
+
+def test_changed_root_version_falls_back_to_replay():
+    persistence = InMemoryPersistence()
+    cache = SessionCache()
+    run_gen_dialog(counted_dialog(), persistence, "", None, cache, "chat")
+
+    step = run_gen_dialog(counted_dialog_take_2(), persistence, "Johnny", None, cache, "chat")
+
+    assert step.messages == ["New version!"]
+    assert not step.is_done
+
+
+def test_least_recently_used_session_is_evicted():
+    cache = SessionCache(max_sessions=1)
+    first, second = InMemoryPersistence(), InMemoryPersistence()
+    run_gen_dialog(counted_dialog(), first, "", None, cache, "first")
+    run_gen_dialog(counted_dialog(), second, "", None, cache, "second")
+    started.clear()
+
+    run_gen_dialog(counted_dialog(), first, "Johnny", None, cache, "first")
+
+    assert started == ["root", "name?", "color?"]
+
+
+def test_expired_session_is_not_resumed():
+    now = [0.0]
+    cache = SessionCache(ttl=10, clock=lambda: now[0])
+    persistence = InMemoryPersistence()
+    run_gen_dialog(counted_dialog(), persistence, "", None, cache, "chat")
+    started.clear()
+    now[0] = 11.0
+
+    run_gen_dialog(counted_dialog(), persistence, "Johnny", None, cache, "chat")
+
+    assert started == ["root", "name?", "color?"]
+
+
+def test_session_cache_requires_conversation_id():
+    with pytest.raises(ValueError):
+        run_gen_dialog(counted_dialog(), InMemoryPersistence(), "", None, SessionCache())
+
+
+@pytest.mark.asyncio
+async def test_async_session_is_resumed_instead_of_replayed():
+    persistence = InMemoryPersistence()
+    cache = SessionCache()
+
+    step1 = await run_async_gen_dialog(counted_dialog_with_async(), persistence, "", None, cache, 1)
+    step2 = await run_async_gen_dialog(
+        counted_dialog_with_async(), persistence, "Johnny", None, cache, 1
+    )
+    step3 = await run_async_gen_dialog(
+        counted_dialog_with_async(), persistence, "blue", None, cache, 1
+    )
+
+    assert step1.messages == ["name?"]
+    assert step2.messages == ["color?"]
+    assert step3.is_done
+    assert step3.return_value == ("Johnny", "blue")
+    assert started == ["root", "name?", "color?"]
+
+
+@pytest.mark.asyncio
+async def test_async_session_is_not_resumed_by_sync_engine():
+    persistence = InMemoryPersistence()
+    cache = SessionCache()
+    await run_async_gen_dialog(counted_dialog_with_async(), persistence, "", None, cache, 1)
+    state = persistence.get_state(counted_dialog_with_async())
+
+    frames = cache.resume(1, counted_dialog_with_async(), state)
+
+    assert frames is None
+    assert len(cache) == 0
@@ -0,0 +1,143 @@
+import json
+import pytest
+from dataclasses import asdict
+
+from dialogs_framework.persistence.in_memory import InMemoryPersistence
+from dialogs_framework.types import dialog, send_message, get_client_response
+from dialogs_framework.dialog_state import (
+    DialogState,
+    state_to_dict,
+    state_from_dict,
+    lazy_state_from_dict,
+)
+from dialogs_framework.gen_dialogs import run_gen_dialog
+from dialogs_framework.compact_state import compact_state
+from dialogs_framework.state_codecs import BinaryStateCodec, JsonStateCodec
+
+from .test_gen_dialogs import (
+    topic_dialog,
+    name_getter_dialog,
+    name_getter_dialog_take_2,
+    fallback_with_client_response,
+)
+
+codecs = [JsonStateCodec(), JsonStateCodec(interned=False), BinaryStateCodec()]
+
+
+@dialog(version="1.0")
+def chatty_dialog():
+    while True:
+        for i in range(5):
+            yield send_message(f"Message number {i}")
+        yield name_getter_dialog()
+        yield get_client_response()
+
+
+def conversation(turns: int) -> DialogState:
+    persistence = InMemoryPersistence[dict]()
+    for i in range(turns):
+        run_gen_dialog(chatty_dialog(), persistence, {"turn": i, "text": "ünïcode"})
+    assert persistence.state is not None
+    return persistence.state
+
+
+def fallback_conversation() -> DialogState:
+    persistence = InMemoryPersistence[str]()
+    run_gen_dialog(name_getter_dialog(), persistence, "", fallback_with_client_response())
+    run_gen_dialog(
+        name_getter_dialog_take_2(), persistence, "Juanito", fallback_with_client_response()
+    )
+    assert persistence.state is not None
+    return persistence.state
+
+
+def as_json(state: DialogState) -> dict:
+    return json.loads(json.dumps(state_to_dict(state)))
+
+
+def test_state_to_dict_matches_asdict():
+    state = conversation(3)
+
+    assert state_to_dict(state) == asdict(state)
+
+
+def test_state_to_dict_keeps_lazy_subdialogs():
+    raw = state_to_dict(conversation(3))
+    state = lazy_state_from_dict(raw)
+
+    assert state_to_dict(state) == raw
+    assert not state.is_loaded
+
+
+def test_state_to_dict_of_deep_state():
+    state = DialogState("1.0", "root")
+    node = state
+    for _ in range(5000):
+        node.subdialogs.append(DialogState("1.0", "nested"))
+        node = node.subdialogs[0]
+
+    raw = state_to_dict(state)
+
+    assert raw["subdialogs"][0]["subdialogs"][0]["name"] == "nested"
+
+
+@pytest.mark.parametrize("codec", codecs)
+def test_round_trip(codec):
+    state = conversation(20)
+
+    decoded = codec.decode(codec.encode(state))
+
+    assert as_json(decoded) == as_json(state)
+
+
+@pytest.mark.parametrize("codec", codecs)
+def test_round_trip_keeps_fallback_state(codec):
+    state = fallback_conversation()
+
+    decoded = codec.decode(codec.encode(state))
+
+    assert as_json(decoded) == as_json(state)
+    assert decoded.handling_fallback
+
+
+@pytest.mark.parametrize("codec", codecs)
+def test_decoded_state_resumes_dialog(codec):
+    persistence = InMemoryPersistence()
+    run_gen_dialog(topic_dialog(), persistence, "")
+    persistence.state = codec.decode(codec.encode(persistence.state))
+    run_gen_dialog(topic_dialog(), persistence, "Johnny")
+    persistence.state = codec.decode(memoryview(codec.encode(persistence.state)))
+
+    step = run_gen_dialog(topic_dialog(), persistence, "Peanuts")
+
+    assert step.return_value == ("Johnny", "Peanuts")
+
+
+def test_encode_compact_state():
+    state = conversation(5)
+    codec = BinaryStateCodec()
+
+    assert codec.encode(compact_state(state)) == codec.encode(state)
+
+
+def test_binary_is_smaller_than_json():
+    state = conversation(50)
+
+    binary_size = len(BinaryStateCodec().encode(state))
+    json_size = len(JsonStateCodec().encode(state))
+
+    assert binary_size < json_size / 2
+
+
+def test_binary_rejects_other_data():
+    with pytest.raises(ValueError):
+        BinaryStateCodec().decode(json.dumps(state_to_dict(conversation(1))).encode())
+
+
+def test_json_codec_decodes_lazily():
+    codec = JsonStateCodec(lazy=True)
+
+    decoded = codec.decode(codec.encode(conversation(3)))
+
+    assert not decoded.is_loaded
+    assert as_json(decoded) == as_json(state_from_dict(state_to_dict(conversation(3))))
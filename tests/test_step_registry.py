@@ -0,0 +1,173 @@
+import pytest
+import asyncio
+from dataclasses import dataclass
+
+from dialogs_framework.persistence.in_memory import InMemoryPersistence
+from dialogs_framework.types import dialog, send_message, get_client_response, BaseDialog
+from dialogs_framework.dialogs import run_dialog, run, step_handlers
+from dialogs_framework.gen_dialogs import run_gen_dialog, gen_step_handlers
+from dialogs_framework.async_gen_dialogs import run_async_gen_dialog, async_gen_step_handlers
+from dialogs_framework.step_registry import StepRegistry
+from dialogs_framework.generic_types import StepContext
+
+
+@dataclass
+class shout(BaseDialog[str]):
+    text: str
+    name: str = "shout"
+    version: str = "1.0"
+
+
+@dataclass
+class fetch_upper(BaseDialog[str]):
+    text: str
+    name: str = "fetch_upper"
+    version: str = "1.0"
+
+
+@dataclass
+class echo(BaseDialog[str]):
+    name: str = "echo"
+    version: str = "1.0"
+
+
+class loud_message(send_message):
+    pass
+
+
+@pytest.fixture
+def registered_shout():
+    @step_handlers.register(shout)
+    def run_shout(step, step_state, context):
+        loud = step.text.upper()
+        context.send(loud)
+        return loud
+
+    yield
+    step_handlers.unregister(shout)
+
+
+@pytest.fixture
+def registered_echo():
+    contexts = []
+
+    @step_handlers.register(echo)
+    def run_echo(step, step_state, context: StepContext):
+        contexts.append(context)
+        context.send(f"you said {context.client_response}")
+        return context.client_response
+
+    yield contexts
+    step_handlers.unregister(echo)
+
+
+@dialog(version="1.0")
+def run_shouting_dialog():
+    loud = run(shout("hello"))
+    return loud + "!"
+
+
+@dialog(version="1.0")
+def shouting_dialog():
+    loud = yield shout("hello")
+    name = yield get_client_response()
+    return loud, name
+
+
+def test_custom_step_with_run(registered_shout):
+    step = run_dialog(run_shouting_dialog(), InMemoryPersistence(), "")
+
+    assert step.messages == ["HELLO"]
+    assert step.return_value == "HELLO!"
+
+
+def test_custom_step_with_gen_dialogs(registered_shout):
+    persistence = InMemoryPersistence()
+    step1 = run_gen_dialog(shouting_dialog(), persistence, "")
+    assert step1.messages == ["HELLO"]
+
+    # The custom step is not run again on replay
+    step2 = run_gen_dialog(shouting_dialog(), persistence, "Johnny")
+    assert step2.messages == []
+    assert step2.return_value == ("HELLO", "Johnny")
+
+
+@pytest.mark.asyncio
+async def test_custom_step_with_async_gen_dialogs(registered_shout):
+    persistence = InMemoryPersistence()
+    step1 = await run_async_gen_dialog(shouting_dialog(), persistence, "")
+    assert step1.messages == ["HELLO"]
+
+    step2 = await run_async_gen_dialog(shouting_dialog(), persistence, "Johnny")
+    assert step2.return_value == ("HELLO", "Johnny")
+
+
+@dialog(version="1.0")
+def run_echo_dialog():
+    return run(echo())
+
+
+@dialog(version="1.0")
+def echo_dialog():
+    return (yield echo())
+
+
+@pytest.mark.asyncio
+async def test_custom_step_gets_a_step_context_in_every_engine(registered_echo):
+    steps = [
+        run_dialog(run_echo_dialog(), InMemoryPersistence(), "hi"),
+        run_gen_dialog(echo_dialog(), InMemoryPersistence(), "hi"),
+        await run_async_gen_dialog(echo_dialog(), InMemoryPersistence(), "hi"),
+    ]
+
+    assert [(step.messages, step.return_value) for step in steps] == [(["you said hi"], "hi")] * 3
+    assert len(registered_echo) == 3
+    assert all(isinstance(context, StepContext) for context in registered_echo)
+
+
+@pytest.mark.asyncio
+async def test_custom_async_step():
+    @async_gen_step_handlers.register(fetch_upper)
+    async def run_fetch_upper(step, step_state, turn):
+        await asyncio.sleep(0)
+        return step.text.upper()
+
+    try:
+        step = await run_async_gen_dialog(fetch_upper("hello"), InMemoryPersistence(), "")
+        assert step.return_value == "HELLO"
+
+        with pytest.raises(Exception, match="Unsupported dialog type"):
+            run_gen_dialog(fetch_upper("hello"), InMemoryPersistence(), "")
+    finally:
+        async_gen_step_handlers.unregister(fetch_upper)
+
+
+def test_subclass_falls_back_to_base_class_handler():
+    step = run_gen_dialog(loud_message("hi"), InMemoryPersistence(), "")
+
+    assert step.messages == ["hi"]
+
+
+def test_unregistered_step_raises_exception():
+    with pytest.raises(Exception, match="Unsupported dialog type"):
+        run_gen_dialog(shout("hello"), InMemoryPersistence(), "")
+
+
+def test_lookup_is_cached_and_invalidated_by_parent():
+    parent = StepRegistry()
+    child = StepRegistry(parent=parent)
+    parent.register(BaseDialog, len)
+
+    assert child.lookup(shout) == (len, False)
+
+    parent.register(shout, repr)
+
+    assert child.lookup(shout) == (repr, False)
+
+
+def test_child_registry_overrides_parent():
+    handler, _ = gen_step_handlers.lookup(send_message)
+    assert handler is step_handlers.lookup(send_message)[0]
+
+    dialog_handler, _ = gen_step_handlers.lookup(type(run_shouting_dialog()))
+    assert dialog_handler is not step_handlers.lookup(type(run_shouting_dialog()))[0]
@@ -0,0 +1,120 @@
+import asyncio
+import time
+import pytest
+
+from dialogs_framework.persistence.in_memory import InMemoryPersistence
+from dialogs_framework.types import dialog, send_message, get_client_response, DialogStepNotDone
+from dialogs_framework.streaming import stream_async_gen_dialog, stream_gen_dialog
+from dialogs_framework.executor import DialogExecutor
+
+from .persistence.test_persistence import RecordingPersistence
+
+
+@dialog(version="1.0")
+async def think(delay: float):
+    await asyncio.sleep(delay)
+
+
+@dialog(version="1.0")
+def thinking_dialog():
+    yield send_message("thinking...")
+    yield think(0.2)
+    yield send_message("done thinking")
+    answer = yield get_client_response()
+    return answer
+
+
+@dialog(version="1.0")
+def think_sync(delay: float):
+    time.sleep(delay)
+
+
+@dialog(version="1.0")
+def sync_thinking_dialog():
+    yield send_message("thinking...")
+    yield think_sync(0.2)
+    yield send_message("done thinking")
+    answer = yield get_client_response()
+    return answer
+
+
+@pytest.mark.asyncio
+async def test_stream_async_gen_dialog_yields_messages_as_they_are_sent():
+    persistence = RecordingPersistence()
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    received = []
+
+    async for item in stream_async_gen_dialog(thinking_dialog(), persistence, ""):
+        received.append((item, loop.time() - start))
+
+    assert [item for item, _ in received[:2]] == ["thinking...", "done thinking"]
+    assert received[0][1] < 0.1
+    assert received[1][1] >= 0.2
+    step = received[-1][0]
+    assert isinstance(step, DialogStepNotDone)
+    assert step.messages == ["thinking...", "done thinking"]
+    assert len(persistence.saves) == 1
+
+
+@pytest.mark.asyncio
+async def test_stream_async_gen_dialog_last_item_is_the_step():
+    persistence = InMemoryPersistence()
+    [_ async for _ in stream_async_gen_dialog(thinking_dialog(), persistence, "")]
+
+    items = [item async for item in stream_async_gen_dialog(thinking_dialog(), persistence, "hi")]
+
+    assert len(items) == 1
+    assert items[0].return_value == "hi"
+
+
+@pytest.mark.asyncio
+async def test_stopping_the_stream_cancels_the_turn():
+    persistence = InMemoryPersistence()
+    stream = stream_async_gen_dialog(thinking_dialog(), persistence, "")
+
+    assert await stream.__anext__() == "thinking..."
+    await stream.aclose()
+
+    assert persistence.state is None
+
+
+def test_stream_gen_dialog_yields_messages_as_they_are_sent():
+    persistence = RecordingPersistence()
+    start = time.monotonic()
+    received = []
+
+    for item in stream_gen_dialog(sync_thinking_dialog(), persistence, ""):
+        received.append((item, time.monotonic() - start))
+
+    assert received[0][0] == "thinking..."
+    assert received[0][1] < 0.1
+    assert received[-1][0].messages == ["thinking...", "done thinking"]
+    assert len(persistence.saves) == 1
+
+
+@dialog(version="1.0")
+def failing_dialog():
+    yield send_message("about to fail")
+    raise ValueError("failed")
+
+
+def test_stream_gen_dialog_raises_errors_of_the_turn():
+    stream = stream_gen_dialog(failing_dialog(), InMemoryPersistence(), "")
+
+    assert next(stream) == "about to fail"
+    with pytest.raises(ValueError):
+        next(stream)
+
+
+def test_stopping_the_sync_stream_still_saves_the_turn():
+    persistence = RecordingPersistence()
+    executor = DialogExecutor(max_workers=1)
+    stream = stream_gen_dialog(sync_thinking_dialog(), persistence, "", executor=executor)
+
+    assert next(stream) == "thinking..."
+    stream.close()
+    executor.shutdown(wait=True)
+
+    assert len(persistence.saves) == 1
+    assert executor.stats().completed == 1
@@ -0,0 +1,79 @@
+import json
+from dataclasses import asdict
+
+from dialogs_framework.persistence.in_memory import InMemoryPersistence
+from dialogs_framework.types import dialog, send_message, get_client_response
+from dialogs_framework.dialog_state import (
+    DialogState,
+    new_empty_state,
+    state_from_dict,
+    intern_state_dict,
+)
+from dialogs_framework.gen_dialogs import run_gen_dialog
+from dialogs_framework.symbols import SymbolTable, dialog_symbols
+
+
+@dialog(version="1.0")
+def chatty_dialog():
+    for i in range(20):
+        yield send_message(f"Message number {i}")
+        yield get_client_response()
+
+
+def test_symbol_table_interns_symbols():
+    table = SymbolTable()
+
+    assert table.intern("send_message") == 0
+    assert table.intern("1.0") == 1
+    assert table.intern("send_message") == 0
+    assert table[1] == "1.0"
+    assert table.symbols == ["send_message", "1.0"]
+
+
+def test_canonical_returns_shared_copy():
+    symbol = "".join(["some_", "dialog"])
+
+    assert dialog_symbols.canonical(symbol) is dialog_symbols.canonical("some_dialog")
+
+
+def test_states_share_names_and_versions():
+    state = state_from_dict(
+        {
+            "name": "".join(["chatty_", "dialog"]),
+            "version": "".join(["1.", "0"]),
+            "result": None,
+            "sent_to_client": False,
+            "subdialogs": [],
+        }
+    )
+
+    # the state of the dialog itself has the names given by the dialog decorator
+    expected = new_empty_state(chatty_dialog())
+    assert state.name is expected.name
+    assert state.version is expected.version
+
+
+def test_interned_state_dict_round_trip():
+    persistence = InMemoryPersistence()
+    for _ in range(10):
+        run_gen_dialog(chatty_dialog(), persistence, "")
+    raw_state = asdict(persistence.state)
+
+    interned = intern_state_dict(raw_state)
+    restored = state_from_dict(json.loads(json.dumps(interned)))
+
+    assert asdict(restored) == raw_state
+    assert sorted(interned["symbols"]) == [
+        "1.0",
+        "chatty_dialog",
+        "get_client_response",
+        "send_message",
+    ]
+    assert len(json.dumps(interned)) < len(json.dumps(raw_state))
+
+
+def test_reset_uses_shared_names():
+    state = DialogState("1.0", "root")
+    state.reset(chatty_dialog(), fallback_mode=False)
+
+    assert state.name is dialog_symbols.canonical("chatty_dialog")
@@ -0,0 +1,143 @@
+import asyncio
+import pytest
+
+from dialogs_framework.persistence.in_memory import InMemoryPersistence
+from dialogs_framework.types import dialog, send_message, get_client_response
+from dialogs_framework.dialogs import run, run_dialog
+from dialogs_framework.gen_dialogs import run_gen_dialog
+from dialogs_framework.async_gen_dialogs import run_async_gen_dialog
+from dialogs_framework.tracing import AggregatingTracer, Tracer, tracing
+
+
+class RecordingTracer(Tracer):
+    def __init__(self):
+        self.events = []
+
+    def enter(self, event):
+        self.events.append(("enter", event.name, event.call_index, event.depth, event.replayed))
+
+    def exit(self, event):
+        assert event.end is not None and event.end >= event.start
+        error = type(event.error).__name__ if event.error else None
+        self.events.append(("exit", event.name, event.replayed, error))
+
+
+@dialog(version="1.0")
+def name_getter():
+    yield send_message("What's your name?")
+    return (yield get_client_response())
+
+
+@dialog(version="1.0")
+def greeting():
+    name = yield name_getter()
+    yield send_message(f"Hi {name}")
+    return name
+
+
+@dialog(version="1.0")
+async def fetch():
+    await asyncio.sleep(0.01)
+    return 1
+
+
+@dialog(version="1.0")
+def fetching():
+    value = yield fetch()
+    yield get_client_response()
+    return value
+
+
+@dialog(version="1.0")
+def run_name_getter():
+    run(send_message("What's your name?"))
+    return run(get_client_response())
+
+
+@dialog(version="1.0")
+def run_greeting():
+    name = run(run_name_getter())
+    run(send_message(f"Hi {name}"))
+    return name
+
+
+def test_gen_dialog_events():
+    persistence = InMemoryPersistence()
+    tracer = RecordingTracer()
+    with tracing(tracer):
+        run_gen_dialog(greeting(), persistence, "")
+        turn1 = tracer.events
+        tracer.events = []
+        run_gen_dialog(greeting(), persistence, "Johnny")
+        turn2 = tracer.events
+
+    assert turn1 == [
+        ("enter", "greeting", 0, 0, False),
+        ("enter", "name_getter", 0, 1, False),
+        ("enter", "send_message", 0, 2, False),
+        ("exit", "send_message", False, None),
+        ("enter", "get_client_response", 1, 2, False),
+        ("exit", "get_client_response", False, "SendToClientException"),
+        ("exit", "name_getter", False, "SendToClientException"),
+        ("exit", "greeting", False, "SendToClientException"),
+    ]
+    assert turn2 == [
+        ("enter", "greeting", 0, 0, False),
+        ("enter", "name_getter", 0, 1, False),
+        ("enter", "send_message", 0, 2, True),
+        ("exit", "send_message", True, None),
+        ("enter", "get_client_response", 1, 2, False),
+        ("exit", "get_client_response", False, None),
+        ("exit", "name_getter", False, None),
+        ("enter", "send_message", 1, 1, False),
+        ("exit", "send_message", False, None),
+        ("exit", "greeting", False, None),
+    ]
+
+
+def test_run_dialog_events():
+    persistence = InMemoryPersistence()
+    tracer = RecordingTracer()
+    run_dialog(run_greeting(), persistence, "")
+    with tracing(tracer):
+        run_dialog(run_greeting(), persistence, "Johnny")
+
+    assert tracer.events == [
+        ("enter", "run_greeting", 0, 0, False),
+        ("enter", "run_name_getter", 0, 1, False),
+        ("enter", "send_message", 0, 2, True),
+        ("exit", "send_message", True, None),
+        ("enter", "get_client_response", 1, 2, False),
+        ("exit", "get_client_response", False, None),
+        ("exit", "run_name_getter", False, None),
+        ("enter", "send_message", 1, 1, False),
+        ("exit", "send_message", False, None),
+        ("exit", "run_greeting", False, None),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_aggregating_tracer():
+    persistence = InMemoryPersistence()
+    tracer = AggregatingTracer()
+    with tracing(tracer):
+        await run_async_gen_dialog(fetching(), persistence, "")
+        await run_async_gen_dialog(fetching(), persistence, "")
+
+    stats = tracer.stats()
+    fetch_stats = stats[("fetch", "1.0")]
+    assert (fetch_stats.executed, fetch_stats.replayed, fetch_stats.errors) == (1, 1, 0)
+    assert fetch_stats.total_time >= 0.01
+    assert fetch_stats.max_depth == 1
+    assert stats[("fetching", "1.0")].executed == 2
+    assert "fetch 1.0" in tracer.report()
+
+
+def test_no_events_without_tracer():
+    tracer = RecordingTracer()
+    with tracing(tracer):
+        pass
+
+    run_gen_dialog(greeting(), InMemoryPersistence(), "")
+
+    assert tracer.events == []